@@ -0,0 +1,415 @@
+import re
+import json
+import time
+import uuid
+import bisect
+import hashlib
+import socket
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+from common.registry_client import MANIFEST_V2
+
+LOG = logging.getLogger(__name__)
+CONFIG_TYPE = "application/vnd.docker.container.image.v1+json"
+LAYER_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+MANIFEST_PATH = re.compile(r"^/v2/(.+)/manifests/([^/]+)$")
+BLOB_PATH = re.compile(r"^/v2/(.+)/blobs/(sha256:[0-9a-f]{64})$")
+UPLOADS_PATH = re.compile(r"^/v2/(.+)/blobs/uploads/$")
+UPLOAD_PATH = re.compile(r"^/v2/(.+)/blobs/uploads/([0-9a-f]+)$")
+TAGS_PATH = re.compile(r"^/v2/(.+)/tags/list$")
+SCOPE_PATH = re.compile(r"^/v2/(.+?)/(?:manifests|blobs|tags)/")
+# timeUploadedMs of the first tag, later tags are one second apart
+UPLOADED_AT_MS = 1500000000000
+
+
+def blob_content(seed, size):
+    block = hashlib.sha256(seed.encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def tag_names(count):
+    """"latest" plus semver-like names, in registry (sorted) order."""
+    names = ["latest"] + ["v1.{}.{}".format(i // 100, i % 100) for i in range(count - 1)]
+    return sorted(names[:count])
+
+
+class SyntheticCatalog(object):
+    """A GCR-like source registry generated on demand.
+
+    ``namespaces`` namespaces hold ``projects`` projects each, with
+    ``tags`` tags per project. Every image has ``shared_layers`` layers
+    common to the whole catalog and ``layers`` layers of its own, all of
+    ``layer_size`` bytes. Manifests and blobs are only built when asked
+    for, so large catalogs cost nothing until they are copied.
+    """
+
+    def __init__(self, namespaces=1, projects=10, tags=10, layers=1,
+                 shared_layers=2, layer_size=1024 * 1024):
+        self.namespaces = ["ns{}".format(i) for i in range(namespaces)]
+        self.projects = ["project{}".format(i) for i in range(projects)]
+        self.tags = tag_names(tags)
+        self._tag_index = {name: i for i, name in enumerate(self.tags)}
+        self.layers = layers
+        self.shared_layers = shared_layers
+        self.layer_size = layer_size
+        self._blobs = {}
+        self._manifests = {}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    @property
+    def tag_count(self):
+        return len(self.namespaces) * len(self.projects) * len(self.tags)
+
+    def repositories(self):
+        for namespace in self.namespaces:
+            for project in self.projects:
+                yield "{}/{}".format(namespace, project)
+
+    def children(self, repository):
+        """Listing of ``repository``: (key, names) or None if unknown."""
+        parts = repository.split("/")
+        if len(parts) == 1 and parts[0] in self.namespaces:
+            return "child", self.projects
+        if len(parts) == 2 and parts[0] in self.namespaces and parts[1] in self.projects:
+            return "tags", self.tags
+        return None
+
+    def _add_blob(self, seed, size):
+        content = blob_content(seed, size)
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        self._blobs[digest] = (seed, size)
+        return digest, len(content)
+
+    def manifest(self, repository, reference):
+        """Return (content, media_type) or None."""
+        if reference.startswith("sha256:"):
+            with self._lock:
+                return self._manifests.get(reference)
+        listing = self.children(repository)
+        if not listing or listing[0] != "tags" or reference not in self.tags:
+            return None
+        with self._lock:
+            image = "{}:{}".format(repository, reference)
+            if image in self._images:
+                return self._images[image]
+            config = json.dumps({"architecture": "amd64", "os": "linux",
+                                 "image": image}).encode()
+            config_digest = "sha256:" + hashlib.sha256(config).hexdigest()
+            self._blobs[config_digest] = (config, len(config))
+            layers = []
+            seeds = ["shared:{}".format(i) for i in range(self.shared_layers)] + \
+                ["{}:{}".format(image, i) for i in range(self.layers)]
+            for seed in seeds:
+                digest, size = self._add_blob(seed, self.layer_size)
+                layers.append({"mediaType": LAYER_TYPE, "size": size, "digest": digest})
+            content = json.dumps({
+                "schemaVersion": 2, "mediaType": MANIFEST_V2,
+                "config": {"mediaType": CONFIG_TYPE, "size": len(config),
+                           "digest": config_digest},
+                "layers": layers,
+            }).encode()
+            digest = "sha256:" + hashlib.sha256(content).hexdigest()
+            self._manifests[digest] = self._images[image] = (content, MANIFEST_V2)
+            return content, MANIFEST_V2
+
+    def add_manifest(self, content, media_type):
+        """Serve an extra manifest by digest, e.g. a list of the generated ones."""
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        with self._lock:
+            self._manifests[digest] = (content, media_type)
+        return digest
+
+    def listing_manifests(self, repository, names):
+        """GCR's manifest map of a tag listing.
+
+        Building every manifest would hash all layers, so the digests here
+        are placeholders and do not match the manifests served.
+        """
+        manifests = {}
+        for name in names:
+            digest = "sha256:" + hashlib.sha256(
+                "{}:{}".format(repository, name).encode()).hexdigest()
+            uploaded = str(UPLOADED_AT_MS + self._tag_index[name] * 1000)
+            manifests[digest] = {"mediaType": MANIFEST_V2, "tag": [name],
+                                 "timeCreatedMs": uploaded, "timeUploadedMs": uploaded}
+        return manifests
+
+    def has_blob(self, digest):
+        with self._lock:
+            return digest in self._blobs
+
+    def blob(self, digest):
+        with self._lock:
+            entry = self._blobs.get(digest)
+        if entry is None:
+            return None
+        seed, size = entry
+        return seed if isinstance(seed, bytes) else blob_content(seed, size)
+
+
+class TargetStore(object):
+    """An empty registry accepting pushes, blob data is hashed and dropped."""
+
+    def __init__(self):
+        self.manifests = {}
+        self.blobs = set()
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+
+class FakeRegistry(object):
+    """Registry v2 server on localhost, serving ``catalog`` read-only or
+    acting as a push target when no catalog is given.
+
+    ``latency`` seconds are added to every request to mimic a remote link.
+
+    With ``token_auth`` every request needs a bearer token holding the
+    scopes of its repositories, issued by the "/token" realm and valid for
+    ``token_expires_in`` seconds.
+    """
+
+    def __init__(self, catalog=None, latency=0, token_auth=False, token_expires_in=300):
+        self.catalog = catalog
+        self.store = TargetStore()
+        self.latency = latency
+        self.token_auth = token_auth
+        self.token_expires_in = token_expires_in
+        # token -> (set of (repository, action), expires at)
+        self.tokens = {}
+        self.token_requests = 0
+        self.challenges = 0
+        self.requests = 0
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def listing(self, repository):
+        if self.catalog is not None:
+            return self.catalog.children(repository)
+        with self.store.lock:
+            tags = sorted({ref for repo, ref in self.store.manifests
+                           if repo == repository and not ref.startswith("sha256:")})
+        return ("tags", tags) if tags else None
+
+    def manifest(self, repository, reference):
+        if self.catalog is not None:
+            return self.catalog.manifest(repository, reference)
+        with self.store.lock:
+            return self.store.manifests.get((repository, reference))
+
+    def issue_token(self, scopes):
+        granted = set()
+        for scope in scopes:
+            kind, _, rest = scope.partition(":")
+            repository, _, actions = rest.rpartition(":")
+            if kind == "repository" and repository:
+                granted.update((repository, action) for action in actions.split(","))
+        token = uuid.uuid4().hex
+        with self.store.lock:
+            self.token_requests += 1
+            self.tokens[token] = (granted, time.time() + self.token_expires_in)
+        return token
+
+    def authorized(self, authorization, required):
+        scheme, _, token = (authorization or "").partition(" ")
+        with self.store.lock:
+            entry = self.tokens.get(token) if scheme == "Bearer" else None
+        if entry is None or entry[1] <= time.time():
+            return False
+        return set(required) <= entry[0]
+
+    def has_blob(self, repository, digest):
+        if self.catalog is not None:
+            return self.catalog.has_blob(digest)
+        with self.store.lock:
+            return (repository, digest) in self.store.blobs
+
+
+def make_handler(registry):
+    store = registry.store
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super(Handler, self).setup()
+            # Headers and body are written separately, avoid the delayed-ACK stall
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, code, body=b"", headers=None):
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def handle_request(self):
+            registry.requests += 1
+            if registry.latency:
+                time.sleep(registry.latency)
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = self.read_body() if self.command in ("PUT", "POST", "PATCH") else b""
+            if registry.token_auth:
+                if url.path == "/token":
+                    return self.token(query)
+                required = self.required_scopes(url, query)
+                if not registry.authorized(self.headers.get("Authorization"), required):
+                    return self.unauthorized(required)
+            if url.path == "/v2/":
+                return self.send(200, b"{}")
+            for pattern, handler in ((TAGS_PATH, self.tags),
+                                     (MANIFEST_PATH, self.manifest),
+                                     (UPLOADS_PATH, self.start_upload),
+                                     (UPLOAD_PATH, self.upload),
+                                     (BLOB_PATH, self.blob)):
+                match = pattern.match(url.path)
+                if match:
+                    return handler(url, query, body, *match.groups())
+            return self.not_found()
+
+        def required_scopes(self, url, query):
+            match = SCOPE_PATH.match(url.path)
+            if not match:
+                return []
+            action = "pull" if self.command in ("GET", "HEAD") else "push"
+            required = [(match.group(1), "pull"), (match.group(1), action)]
+            if "mount" in query and "from" in query:
+                required.append((query["from"][0], "pull"))
+            return required
+
+        def unauthorized(self, required):
+            registry.challenges += 1
+            challenge = 'Bearer realm="{}/token",service="fake-registry"'.format(registry.url)
+            if required:
+                # 和 GCR 一样只给出请求路径的 scope
+                repository = required[0][0]
+                actions = ",".join(sorted({a for r, a in required if r == repository}))
+                challenge += ',scope="repository:{}:{}"'.format(repository, actions)
+            return self.send(401, b'{"errors": [{"code": "UNAUTHORIZED"}]}', {
+                "Content-Type": "application/json", "WWW-Authenticate": challenge})
+
+        def token(self, query):
+            token = registry.issue_token(query.get("scope", []))
+            return self.send(200, json.dumps({
+                "token": token, "expires_in": registry.token_expires_in,
+            }).encode(), {"Content-Type": "application/json"})
+
+        def not_found(self):
+            return self.send(404, b'{"errors": [{"code": "NOT_FOUND"}]}',
+                             {"Content-Type": "application/json"})
+
+        def tags(self, url, query, body, repository):
+            listing = registry.listing(repository)
+            if listing is None:
+                return self.not_found()
+            key, names = listing
+            start = bisect.bisect_right(names, query["last"][0]) if "last" in query else 0
+            size = int(query["n"][0]) if "n" in query else len(names)
+            page = names[start:start + size]
+            result = {"name": repository, "child": [], "tags": [], "manifest": {}}
+            result[key] = page
+            if key == "tags" and registry.catalog is not None:
+                result["manifest"] = registry.catalog.listing_manifests(repository, page)
+            content = json.dumps(result).encode()
+            etag = '"{}"'.format(hashlib.sha256(content).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                return self.send(304, b"", {"ETag": etag})
+            headers = {"Content-Type": "application/json", "ETag": etag}
+            if page and start + size < len(names):
+                headers["Link"] = '<{}?{}>; rel="next"'.format(
+                    url.path, urlencode({"n": size, "last": page[-1]}))
+            return self.send(200, content, headers)
+
+        def manifest(self, url, query, body, repository, reference):
+            if self.command == "PUT":
+                digest = "sha256:" + hashlib.sha256(body).hexdigest()
+                media_type = self.headers.get("Content-Type")
+                with store.lock:
+                    store.manifests[(repository, reference)] = (body, media_type)
+                    store.manifests[(repository, digest)] = (body, media_type)
+                return self.send(201, b"", {"Docker-Content-Digest": digest})
+            manifest = registry.manifest(repository, reference)
+            if manifest is None:
+                return self.not_found()
+            content, media_type = manifest
+            return self.send(200, content, {
+                "Content-Type": media_type,
+                "Docker-Content-Digest": "sha256:" + hashlib.sha256(content).hexdigest(),
+            })
+
+        def blob(self, url, query, body, repository, digest):
+            if self.command == "HEAD" and registry.catalog is None:
+                return self.send(200 if registry.has_blob(repository, digest) else 404)
+            content = registry.catalog.blob(digest) if registry.catalog else None
+            if content is None:
+                return self.not_found()
+            return self.send(200, content, {"Content-Type": "application/octet-stream",
+                                            "Docker-Content-Digest": digest})
+
+        def start_upload(self, url, query, body, repository):
+            if "mount" in query:
+                digest = query["mount"][0]
+                if registry.has_blob(query.get("from", [""])[0], digest):
+                    with store.lock:
+                        store.blobs.add((repository, digest))
+                    return self.send(201, b"", {
+                        "Location": "/v2/{}/blobs/{}".format(repository, digest)})
+            upload_id = uuid.uuid4().hex
+            with store.lock:
+                store.uploads[upload_id] = hashlib.sha256()
+            return self.send(202, b"", {
+                "Location": "/v2/{}/blobs/uploads/{}".format(repository, upload_id)})
+
+        def upload(self, url, query, body, repository, upload_id):
+            with store.lock:
+                if self.command == "DELETE":
+                    hasher = store.uploads.pop(upload_id, None)
+                else:
+                    hasher = store.uploads.get(upload_id)
+            if hasher is None:
+                return self.not_found()
+            if self.command == "DELETE":
+                return self.send(204)
+            hasher.update(body)
+            if self.command == "PATCH":
+                return self.send(202, b"", {"Location": url.path})
+            digest = query.get("digest", [""])[0]
+            with store.lock:
+                store.uploads.pop(upload_id, None)
+                if digest != "sha256:" + hasher.hexdigest():
+                    return self.send(400, b'{"errors": [{"code": "DIGEST_INVALID"}]}')
+                store.blobs.add((repository, digest))
+            return self.send(201, b"", {
+                "Location": "/v2/{}/blobs/{}".format(repository, digest)})
+
+        do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = do_DELETE = handle_request
+
+    return Handler
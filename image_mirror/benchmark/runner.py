@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import platform
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import connection, connections
+
+from common import rate_limit, utils
+from .fake_registry import FakeRegistry, SyntheticCatalog
+
+LOG = logging.getLogger(__name__)
+UNLIMITED_RATE = {"rate": 1e6, "min_rate": 1e6, "max_rate": 1e6, "burst": 1e6}
+LOOKUPS = 1000
+
+
+@contextmanager
+def test_database():
+    """Run against a throwaway copy of the configured database."""
+    tmp_dir = None
+    if connection.vendor == "sqlite":
+        # 拷贝阶段多线程写库，不能用内存数据库
+        tmp_dir = tempfile.mkdtemp(prefix="benchmark-db-")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = \
+            os.path.join(tmp_dir, "benchmark.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                                  serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class Benchmark(object):
+    """Time the crawl, dispatch and copy paths against local fake registries.
+
+    Stages run in order on one synthetic catalog and each records its
+    wall time, database queries and registry requests:
+
+    * ``flush_namespaces``: ``Namespace.objects.flush_namespace_project``
+    * ``flush_projects``: ``Project.objects.flush_projects_tag``
+    * ``reflush_projects``: the same flush again, on unchanged listings
+    * ``lookup``: uncached single-image lookups, up to ``LOOKUPS`` of them
+    * ``dispatch``: ``MigrationScheduler.dispatch`` to an in-memory broker
+    * ``copy``: ``sync_image`` run in-process for ``copy_tags`` tags
+    """
+
+    def __init__(self, namespaces=1, projects=100, tags=100, layers=1,
+                 shared_layers=2, layer_size=1024 * 1024, latency=0,
+                 concurrency=None, host_concurrency=None, dispatch_budget=None,
+                 copy_tags=50, copy_concurrency=4, rate_limits=False):
+        self.catalog = SyntheticCatalog(
+            namespaces=namespaces, projects=projects, tags=tags, layers=layers,
+            shared_layers=shared_layers, layer_size=layer_size)
+        self.options = {
+            "namespaces": namespaces, "projects": projects, "tags": tags,
+            "layers": layers, "shared_layers": shared_layers,
+            "layer_size": layer_size, "latency": latency,
+            "concurrency": concurrency, "host_concurrency": host_concurrency,
+            "dispatch_budget": dispatch_budget, "copy_tags": copy_tags,
+            "copy_concurrency": copy_concurrency, "rate_limits": rate_limits,
+        }
+        self.source = FakeRegistry(self.catalog, latency=latency)
+        self.target = FakeRegistry(latency=latency)
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        result = {}
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        requests = self.source.requests + self.target.requests
+        started_at = time.monotonic()
+        # 只统计主线程连接上的查询
+        with connection.execute_wrapper(count_queries):
+            yield result
+        seconds = time.monotonic() - started_at
+        result.update({
+            "seconds": round(seconds, 3),
+            "queries": queries[0],
+            "registry_requests": self.source.requests + self.target.requests - requests,
+        })
+        self.stages[name] = result
+        LOG.info("Benchmark {}: {}".format(name, result))
+
+    def configure(self, cache_dir):
+        from image_mirror.celery import app as celery_app
+
+        settings.TARGET_REGISTRY_API = self.target.url
+        settings.SYNC_ENGINE = "registry"
+        settings.SYNC_PIPELINE = False
+        settings.BLOB_CACHE_DIR = cache_dir
+        # 配置来自 Django settings，键名带 CELERY_ 前缀
+        settings.CELERY_BROKER_URL = celery_app.conf.CELERY_BROKER_URL = "memory://"
+        if not self.options["rate_limits"]:
+            rate_limit.configure({"default": UNLIMITED_RATE})
+
+    def run(self):
+        cache_dir = tempfile.mkdtemp(prefix="benchmark-blobs-")
+        self.source.start()
+        self.target.start()
+        try:
+            self.configure(cache_dir)
+            with test_database():
+                self.run_stages()
+        finally:
+            self.source.stop()
+            self.target.stop()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            if not self.options["rate_limits"]:
+                rate_limit.configure(settings.REGISTRY_RATE_LIMITS)
+        return self.result()
+
+    def run_stages(self):
+        from project import lookup
+        from project.models import Namespace, Project, Tag
+        from project.scheduler import MigrationScheduler
+
+        for name in self.catalog.namespaces:
+            Namespace.objects.create(name=name, registry_host=self.source.url)
+        # save() 会刷新 updated_at，置零使其都进入本轮 flush
+        Namespace.objects.update(updated_at=0)
+
+        with self.stage("flush_namespaces") as result:
+            Namespace.objects.flush_namespace_project(
+                concurrency=self.options["concurrency"],
+                host_concurrency=self.options["host_concurrency"])
+        result["projects"] = Project.objects.count()
+        Project.objects.update(updated_at=0)
+
+        with self.stage("flush_projects") as result:
+            Project.objects.flush_projects_tag(
+                concurrency=self.options["concurrency"],
+                host_concurrency=self.options["host_concurrency"])
+        result["tags"] = Tag.objects.count()
+        result["tags_per_second"] = rate(result["tags"], result["seconds"])
+        Project.objects.update(updated_at=0)
+
+        with self.stage("reflush_projects"):
+            Project.objects.flush_projects_tag(
+                concurrency=self.options["concurrency"],
+                host_concurrency=self.options["host_concurrency"])
+
+        references = ["{}:{}".format(source_image, name) for source_image
+                      in Project.objects.values_list("source_image", flat=True)
+                      for name in self.catalog.tags][:LOOKUPS]
+        lookup.CACHE.clear()
+        with self.stage("lookup") as result:
+            for reference in references:
+                lookup.lookup([reference])
+        result["lookups"] = len(references)
+        result["lookups_per_second"] = rate(len(references), result["seconds"])
+
+        with self.stage("dispatch") as result:
+            result["tasks"] = MigrationScheduler(
+                budget=self.options["dispatch_budget"]).dispatch()
+        result["tasks_per_second"] = rate(result["tasks"], result["seconds"])
+
+        tags = list(Tag.objects.filter(status="queued")
+                    .order_by("project_id", "name")[:self.options["copy_tags"]])
+        with self.stage("copy") as result:
+            with ThreadPoolExecutor(max_workers=self.options["copy_concurrency"]) as pool:
+                list(pool.map(self.sync, tags))
+        synced = Tag.objects.filter(id__in=[t.id for t in tags], status="synced")
+        size = sum(synced.values_list("transfer_bytes", flat=True))
+        result.update({
+            "tags": len(tags),
+            "synced": synced.count(),
+            "bytes": size,
+            "tags_per_second": rate(synced.count(), result["seconds"]),
+            "bytes_per_second": rate(size, result["seconds"]),
+        })
+
+    @classmethod
+    def sync(cls, tag):
+        from worker import sync_image
+
+        try:
+            sync_image.apply((tag.project_id, tag.id))
+        finally:
+            connections.close_all()
+
+    def result(self):
+        return {
+            "created_at": utils.get_time(),
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "platform": sys.platform,
+            },
+            "options": self.options,
+            "catalog_tags": self.catalog.tag_count,
+            "stages": self.stages,
+        }
+
+
+def rate(count, seconds):
+    return round(count / seconds, 2) if seconds else 0
+
+
+def compare(baseline, current):
+    """Return [(stage, metric, baseline, current, ratio)] for the timed stages."""
+    rows = []
+    for stage, result in current.get("stages", {}).items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before:
+            continue
+        for metric in ("seconds", "queries", "registry_requests"):
+            if metric in result and metric in before:
+                ratio = round(result[metric] / before[metric], 2) if before[metric] else None
+                rows.append((stage, metric, before[metric], result[metric], ratio))
+    return rows
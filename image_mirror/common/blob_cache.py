@@ -0,0 +1,152 @@
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+LOG = logging.getLogger(__name__)
+READ_SIZE = 1024 * 1024
+# Evict down to this fraction of max_size so eviction does not run on every write
+LOW_WATER = 0.9
+
+
+class BlobCache(object):
+    """Content-addressable blob store on local disk, keyed by digest.
+
+    Several processes can share one ``root``: blobs are written to a
+    temporary file, verified against their digest and atomically renamed
+    into place. Reads refresh the file mtime, which eviction uses as the
+    LRU order once the cache grows past ``max_size`` bytes.
+
+    The processes keep a shared estimate of the cache size in a small
+    file, increased on every commit. The cache is only walked when the
+    estimate passes ``max_size``, and the walk corrects it.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.size_path = os.path.join(root, ".size")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        algorithm, _, hex_digest = digest.partition(":")
+        return os.path.join(self.root, algorithm, hex_digest[:2], hex_digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest):
+        """Return the cached blob opened for reading, or None."""
+        path = self.path(digest)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return f
+
+    def discard(self, digest):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def writer(self, digest):
+        return BlobWriter(self, digest)
+
+    def update_size(self, added=0, total=None):
+        """Add ``added`` bytes to the size estimate, or set it to ``total``.
+
+        Returns the new estimate, None when it is unknown (new cache).
+        """
+        fd = os.open(self.size_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if total is None:
+                try:
+                    total = int(f.read()) + added
+                except ValueError:
+                    return None
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+            return total
+
+    def added(self, size):
+        """Account a committed blob, evict once the estimate passes max_size."""
+        estimate = self.update_size(added=size)
+        if estimate is None or estimate > self.max_size:
+            self.evict()
+
+    def evict(self):
+        lock_path = os.path.join(self.root, ".evict.lock")
+        with open(lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already evicting
+                return
+            files, total = [], 0
+            for dir_path, _, names in os.walk(self.root):
+                if dir_path == self.root or dir_path.startswith(self.tmp_dir):
+                    continue
+                for name in names:
+                    path = os.path.join(dir_path, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+            if total > self.max_size:
+                target = self.max_size * LOW_WATER
+                for _, size, path in sorted(files):
+                    if total <= target:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        continue
+                    total -= size
+                LOG.info("Blob cache evicted down to {} bytes".format(total))
+            # 遍历期间其他进程提交的 blob 没有计入，下次遍历时修正
+            self.update_size(total=total)
+
+
+class BlobWriter(object):
+    def __init__(self, cache, digest):
+        self.cache = cache
+        self.digest = digest
+        algorithm, _, self.expected = digest.partition(":")
+        self.hasher = hashlib.new(algorithm)
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self.file = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        if self.hasher.hexdigest() != self.expected:
+            self.abort()
+            return False
+        path = self.cache.path(self.digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp_path, path)
+        self.cache.added(self.size)
+        return True
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,57 @@
+import bisect
+import hashlib
+
+DEFAULT_REPLICAS = 128
+
+
+def hash_key(key):
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes.
+
+    Each node is placed ``replicas`` times on the ring and a key belongs to
+    the first node clockwise from its hash. Adding or removing a node only
+    moves the keys of that node, about 1/len(nodes) of them.
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._nodes = set()
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            h = hash_key("{}#{}".format(node, i))
+            index = bisect.bisect(self._hashes, h)
+            self._hashes.insert(index, h)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(h, n) for h, n in zip(self._hashes, self._owners) if n != node]
+        self._hashes = [h for h, _ in kept]
+        self._owners = [n for _, n in kept]
+
+    def get(self, key):
+        """Return the node owning ``key``, or None if the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def __len__(self):
+        return len(self._nodes)
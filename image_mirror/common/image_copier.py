@@ -0,0 +1,361 @@
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from contextlib import closing
+
+from common.registry_client import (
+    MANIFEST_V1, MANIFEST_V1_SIGNED, MANIFEST_V2, MANIFEST_LIST_V2, OCI_MANIFEST, OCI_INDEX,
+)
+
+LOG = logging.getLogger(__name__)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# 上传当前块时最多预先下载的块数
+DEFAULT_READ_AHEAD = 2
+READ_AHEAD_POLL = 0.1
+MAX_MOUNT_CANDIDATES = 3
+MANIFEST_LIST_TYPES = (MANIFEST_LIST_V2, OCI_INDEX)
+IMAGE_MANIFEST_TYPES = (MANIFEST_V2, OCI_MANIFEST)
+SCHEMA1_TYPES = (MANIFEST_V1, MANIFEST_V1_SIGNED)
+
+
+class CopyError(Exception):
+    def __init__(self, msg, retryable=False):
+        super(CopyError, self).__init__(msg)
+        self.retryable = retryable
+
+
+def parse_platforms(value):
+    """Parse "linux/amd64,linux/arm64" into a list, None means all platforms."""
+    if isinstance(value, (list, tuple)):
+        value = ",".join(value)
+    platforms = [p.strip() for p in str(value or "").split(",") if p.strip()]
+    if not platforms or "all" in platforms or "*" in platforms:
+        return None
+    return platforms
+
+
+def match_platform(platform, platforms):
+    if platforms is None:
+        return True
+    platform = platform or {}
+    for p in platforms:
+        parts = p.split("/")
+        if parts[0] != platform.get("os"):
+            continue
+        if len(parts) > 1 and parts[1] != platform.get("architecture"):
+            continue
+        if len(parts) > 2 and parts[2] != platform.get("variant"):
+            continue
+        return True
+    return False
+
+
+def read_ahead(chunks, depth):
+    """Yield ``chunks`` while a thread reads up to ``depth`` of them ahead.
+
+    The download of the next chunks overlaps with the upload of the
+    current one. Errors of the reader are raised in the caller. Closing
+    the generator stops and joins the reader, so ``chunks`` can be closed
+    afterwards.
+    """
+    if depth <= 0:
+        yield from chunks
+        return
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=READ_AHEAD_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((None, None))
+        except BaseException as e:
+            put((None, e))
+
+    thread = threading.Thread(target=reader, name="blob-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk, error = buffer.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ImageCopier(object):
+    """Copy an image between two registries through the Registry v2 API.
+
+    Blobs are streamed from ``source`` to ``target`` in ``chunk_size``
+    pieces, so memory use does not depend on layer size and nothing is
+    written to local disk. A reader thread downloads up to ``read_ahead``
+    chunks ahead of the upload, so both links stay busy.
+
+    ``blob_index`` is an optional persistent map of blob digest to the
+    target repositories holding it (``repositories(digest)`` and
+    ``add(digest, repository)``). It is used to mount blobs from sibling
+    repositories instead of uploading them again.
+
+    ``blob_cache`` is an optional ``BlobCache``; blobs are read from it
+    when present and written to it while being fetched from the source.
+
+    ``copy`` does everything in one go. It can also be split in stages
+    running on different hosts that share the blob cache volume:
+    ``resolve`` and ``fetch`` download the blobs into the cache, then
+    ``publish`` uploads them from it and pushes the manifests.
+
+    ``stats`` is an optional ``TransferStats`` receiving the bytes and
+    time spent per blob.
+    """
+
+    def __init__(self, source, target, chunk_size=DEFAULT_CHUNK_SIZE,
+                 blob_index=None, blob_cache=None, stats=None,
+                 read_ahead=DEFAULT_READ_AHEAD):
+        self.source = source
+        self.target = target
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.blob_index = blob_index
+        self.blob_cache = blob_cache
+        self.stats = stats
+
+    def copy(self, source_repository, target_repository, reference,
+             target_reference=None, platforms=None):
+        """Copy ``reference`` and return the digest pushed to the target.
+
+        Manifest lists and OCI indexes are copied natively. Only the child
+        manifests matching ``platforms`` (e.g. ``["linux/amd64"]``, None
+        for all) are transferred, and the list is rewritten to contain just
+        those children when some were left out.
+        """
+        image = self.resolve(source_repository, reference, platforms)
+        return self.publish(image, source_repository, target_repository,
+                            target_reference)
+
+    def resolve(self, source_repository, reference, platforms=None):
+        """Read the manifests to copy for ``reference``.
+
+        Returns a JSON-serializable dict, so it can be handed from the
+        fetch stage to the publish stage through the broker. Its
+        ``manifests`` are in push order: children first, then the one
+        tagged as ``reference``.
+        """
+        content, media_type, _ = self.source.get_manifest(
+            source_repository, reference)
+        manifests = []
+        if media_type in MANIFEST_LIST_TYPES:
+            manifest_list = json.loads(content.decode())
+            children = manifest_list.get("manifests", [])
+            selected = [m for m in children
+                        if match_platform(m.get("platform"), platforms)]
+            if not selected:
+                raise CopyError("No manifest for platforms {}".format(
+                    ",".join(platforms or [])))
+            for child in selected:
+                child_content, child_type, _ = self.source.get_manifest(
+                    source_repository, child["digest"])
+                manifests.append(self.manifest_entry(
+                    child["digest"], child_content, child_type))
+            if len(selected) != len(children):
+                manifest_list["manifests"] = selected
+                content = json.dumps(manifest_list, indent=3).encode()
+            manifests.append({"reference": reference, "content": content.decode(),
+                              "media_type": media_type, "blobs": []})
+        else:
+            manifests.append(self.manifest_entry(reference, content, media_type))
+        return {"reference": reference, "manifests": manifests}
+
+    @classmethod
+    def manifest_entry(cls, reference, content, media_type):
+        if media_type in SCHEMA1_TYPES:
+            # schema1 的内容带签名，不能改写；registry 只接受签名的类型
+            media_type = MANIFEST_V1_SIGNED
+        elif media_type not in IMAGE_MANIFEST_TYPES:
+            raise CopyError("Unsupported manifest type: {}".format(media_type))
+        manifest = json.loads(content.decode())
+        return {"reference": reference, "content": content.decode(),
+                "media_type": media_type, "blobs": cls.blob_digests(manifest)}
+
+    def fetch(self, image, source_repository, target_repository=None):
+        """Download the blobs of a resolved ``image`` into the blob cache.
+
+        Blobs already cached, or already present in ``target_repository``,
+        are skipped. Returns the number of bytes downloaded.
+        """
+        if self.blob_cache is None:
+            raise CopyError("Fetching requires a blob cache")
+        size = 0
+        for entry in image["manifests"]:
+            for digest in entry["blobs"]:
+                if self.blob_cache.has(digest):
+                    continue
+                if target_repository and \
+                        self.target.blob_exists(target_repository, digest):
+                    continue
+                size += self.fetch_blob(source_repository, digest)
+        return size
+
+    def fetch_blob(self, source_repository, digest):
+        LOG.debug("Fetch blob {} from {}".format(digest, source_repository))
+        started_at = time.monotonic()
+        writer = self.blob_cache.writer(digest)
+        size = 0
+        try:
+            with closing(self.source.get_blob(source_repository, digest)) as rsp:
+                for chunk in rsp.iter_content(chunk_size=self.chunk_size):
+                    writer.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        if not writer.commit():
+            raise CopyError("Blob {} digest mismatch".format(digest), retryable=True)
+        self.record(digest, size, started_at, "fetched")
+        return size
+
+    def publish(self, image, source_repository, target_repository,
+                target_reference=None):
+        """Push a resolved ``image`` and return the digest of its top manifest.
+
+        Blobs come from the cache when the fetch stage left them there,
+        otherwise (e.g. evicted in between) they are streamed from the source.
+        """
+        digest = None
+        manifests = image["manifests"]
+        for i, entry in enumerate(manifests):
+            for blob in entry["blobs"]:
+                self.copy_blob(source_repository, target_repository, blob)
+            reference = entry["reference"]
+            if i == len(manifests) - 1:
+                reference = target_reference or reference
+            digest = self.target.put_manifest(
+                target_repository, reference, entry["content"].encode(),
+                entry["media_type"])
+        return digest
+
+    @classmethod
+    def blob_digests(cls, manifest):
+        if manifest.get("schemaVersion") == 1:
+            # schema1 没有 config，空层的 blobSum 会重复出现
+            digests = []
+            for layer in manifest.get("fsLayers", []):
+                if layer["blobSum"] not in digests:
+                    digests.append(layer["blobSum"])
+            return digests
+        digests = [manifest["config"]["digest"]]
+        for layer in manifest.get("layers", []):
+            # Foreign layers (windows base images) are never pushed
+            if layer.get("urls"):
+                continue
+            digests.append(layer["digest"])
+        return digests
+
+    def copy_blob(self, source_repository, target_repository, digest):
+        """Make ``digest`` present in the target, return the bytes uploaded."""
+        if self.target.blob_exists(target_repository, digest):
+            LOG.debug("Blob {} already in {}".format(digest, target_repository))
+            self.index_blob(digest, target_repository)
+            self.record(digest, 0, None, "exists")
+            return 0
+
+        location = None
+        for repository in self.mount_candidates(digest, target_repository):
+            if location:
+                # 被拒绝的 mount 会开一个上传会话，只保留最后一个用来上传
+                self.target.cancel_upload(location)
+            mounted, location = self.target.mount_blob(
+                target_repository, digest, repository)
+            if mounted:
+                LOG.debug("Blob {} mounted from {}".format(digest, repository))
+                self.index_blob(digest, target_repository)
+                self.record(digest, 0, None, "mounted")
+                return 0
+
+        LOG.debug("Copy blob {} to {}".format(digest, target_repository))
+        started_at = time.monotonic()
+        algorithm, _, expected = digest.partition(":")
+        hasher = hashlib.new(algorithm) if algorithm == "sha256" else None
+        try:
+            with closing(self.iter_blob(source_repository, digest)) as blob, \
+                    closing(read_ahead(blob, self.read_ahead)) as chunks:
+                location = location or self.target.start_upload(target_repository)
+                offset = 0
+                for chunk in chunks:
+                    location = self.target.upload_chunk(location, chunk, offset)
+                    offset += len(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+            if hasher and hasher.hexdigest() != expected:
+                if self.blob_cache is not None:
+                    self.blob_cache.discard(digest)
+                raise CopyError("Blob {} digest mismatch, got sha256:{}"
+                                .format(digest, hasher.hexdigest()), retryable=True)
+            self.target.finish_upload(location, digest)
+        except BaseException:
+            # 失败的上传会话不会被重用，关掉它
+            if location:
+                self.target.cancel_upload(location)
+            raise
+        self.index_blob(digest, target_repository)
+        self.record(digest, offset, started_at, "uploaded")
+        return offset
+
+    def iter_blob(self, source_repository, digest):
+        """Yield the blob in chunks, from the cache when possible."""
+        cached = self.blob_cache.open(digest) if self.blob_cache else None
+        if cached is not None:
+            LOG.debug("Blob {} served from cache".format(digest))
+            with cached:
+                yield from iter(lambda: cached.read(self.chunk_size), b"")
+            return
+
+        writer = self.blob_cache.writer(digest) if self.blob_cache else None
+        committed = False
+        try:
+            with closing(self.source.get_blob(source_repository, digest)) as rsp:
+                for chunk in rsp.iter_content(chunk_size=self.chunk_size):
+                    if not chunk:
+                        continue
+                    if writer:
+                        writer.write(chunk)
+                    yield chunk
+            if writer:
+                committed = writer.commit()
+        finally:
+            if writer and not committed:
+                writer.abort()
+
+    def mount_candidates(self, digest, target_repository):
+        if self.blob_index is None:
+            return []
+        repositories = [r for r in self.blob_index.repositories(digest)
+                        if r != target_repository]
+        return repositories[:MAX_MOUNT_CANDIDATES]
+
+    def record(self, digest, size, started_at, status):
+        """Add a blob to ``stats``. ``copy_blob`` marks it "uploaded",
+        "mounted" or "exists", the fetch stage "fetched"."""
+        if self.stats is not None:
+            duration = time.monotonic() - started_at if started_at else 0
+            self.stats.add(digest, size, duration, status)
+
+    def index_blob(self, digest, repository):
+        if self.blob_index is not None:
+            self.blob_index.add(digest, repository)
@@ -0,0 +1,178 @@
+import json
+import bisect
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = tuple(1024 ** 2 * 4 ** i for i in range(8))
+
+
+class Metric(object):
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self):
+        """Return {label values as JSON: value}, JSON-serializable."""
+        with self._lock:
+            return {json.dumps(k): self._dump(v) for k, v in self._values.items()}
+
+    @classmethod
+    def _dump(cls, value):
+        return value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                data["buckets"][i] += 1
+            data["sum"] += value
+            data["count"] += 1
+
+    @classmethod
+    def _dump(cls, value):
+        return {"buckets": list(value["buckets"]), "sum": value["sum"],
+                "count": value["count"]}
+
+
+class Registry(object):
+    """The metrics of this process.
+
+    Each process only sees its own counters; ``snapshot`` returns them in a
+    JSON-serializable form so they can be stored, and ``merge`` adds up the
+    snapshots of all processes before ``render`` prints them.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        return {m.name: m.samples() for m in self.metrics}
+
+    @classmethod
+    def merge(cls, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                target = merged.setdefault(name, {})
+                for key, value in samples.items():
+                    if key not in target:
+                        target[key] = Histogram._dump(value) \
+                            if isinstance(value, dict) else value
+                    elif isinstance(value, dict):
+                        current = target[key]
+                        if len(current["buckets"]) != len(value["buckets"]):
+                            continue
+                        current["buckets"] = [a + b for a, b in
+                                              zip(current["buckets"], value["buckets"])]
+                        current["sum"] += value["sum"]
+                        current["count"] += value["count"]
+                    else:
+                        target[key] += value
+        return merged
+
+    def render(self, merged):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for key, value in sorted(merged.get(metric.name, {}).items()):
+                labels = list(zip(metric.labelnames, json.loads(key)))
+                if metric.type == "histogram":
+                    lines.extend(render_histogram(metric, labels, value))
+                else:
+                    lines.append(sample_line(metric.name, labels, value))
+        return lines
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def sample_line(name, labels, value):
+    if labels:
+        name = "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(k, escape(v)) for k, v in labels))
+    return "{} {}".format(name, value)
+
+
+def render_histogram(metric, labels, value):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets, value["buckets"]):
+        cumulative += count
+        lines.append(sample_line(metric.name + "_bucket",
+                                 labels + [("le", bound)], cumulative))
+    lines.append(sample_line(metric.name + "_bucket",
+                             labels + [("le", "+Inf")], value["count"]))
+    lines.append(sample_line(metric.name + "_sum", labels, value["sum"]))
+    lines.append(sample_line(metric.name + "_count", labels, value["count"]))
+    return lines
+
+
+REGISTRY = Registry()
+REGISTRY_REQUESTS = REGISTRY.counter(
+    "mirror_registry_requests_total",
+    "Requests sent to registries, by host and status code",
+    ("host", "code"))
+REGISTRY_LATENCY = REGISTRY.histogram(
+    "mirror_registry_request_duration_seconds",
+    "Latency of registry requests until response headers, by host",
+    ("host",))
+SYNCS = REGISTRY.counter(
+    "mirror_syncs_total",
+    "Finished sync tasks, by task and result (synced, error, retry)",
+    ("task", "result"))
+SYNC_DURATION = REGISTRY.histogram(
+    "mirror_sync_duration_seconds",
+    "Transfer time of successful Tag syncs",
+    ("engine",))
+SYNC_BYTES = REGISTRY.histogram(
+    "mirror_sync_bytes",
+    "Bytes transferred by successful Tag syncs",
+    ("engine",), buckets=BYTES_BUCKETS)
+FLUSH_DURATION = REGISTRY.histogram(
+    "mirror_flush_duration_seconds",
+    "Time spent reading a namespace catalog from its registry",
+    ("namespace",))
@@ -0,0 +1,110 @@
+import time
+import logging
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+# docker pull/push progress events that describe a layer
+TRANSFER_STATUS = ("Downloading", "Pushing")
+DONE_STATUS = ("Download complete", "Pushed")
+SKIPPED_STATUS = ("Already exists", "Layer already exists", "Mounted from")
+LAYER_STATUS = TRANSFER_STATUS + DONE_STATUS + SKIPPED_STATUS + (
+    "Pulling fs layer", "Waiting", "Preparing", "Verifying Checksum",
+    "Extracting", "Pull complete",
+)
+
+
+class DockerStreamError(Exception):
+    pass
+
+
+class TransferStats(object):
+    """Bytes moved and time spent by one transfer, overall and per layer."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.layers = OrderedDict()
+
+    def layer(self, layer_id):
+        layer = self.layers.get(layer_id)
+        if layer is None:
+            layer = self.layers[layer_id] = {
+                "bytes": 0, "started_at": None, "duration": 0.0, "status": ""}
+        return layer
+
+    def add(self, layer_id, size, duration, status):
+        layer = self.layer(layer_id)
+        layer["bytes"] += size
+        layer["duration"] += duration
+        layer["status"] = status
+
+    def finish(self):
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    @property
+    def bytes(self):
+        return sum(layer["bytes"] for layer in self.layers.values())
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def to_dict(self):
+        duration = self.duration
+        return {
+            "bytes": self.bytes,
+            "duration": round(duration, 3),
+            "rate": int(self.bytes / duration) if duration > 0 else 0,
+            "layers": [
+                {"id": layer_id, "bytes": layer["bytes"],
+                 "duration": round(layer["duration"], 3), "status": layer["status"]}
+                for layer_id, layer in self.layers.items()
+            ],
+        }
+
+
+class DockerProgress(object):
+    """Consume the decoded JSON events of ``docker pull`` / ``docker push``.
+
+    Failures are reported by the daemon as ``errorDetail`` events, which
+    raise ``DockerStreamError``; everything else is progress and is
+    accumulated into ``stats``.
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats or TransferStats()
+
+    def feed(self, event):
+        LOG.debug(event)
+        if not isinstance(event, dict):
+            return
+        if event.get("errorDetail") or event.get("error"):
+            detail = event.get("errorDetail") or {}
+            raise DockerStreamError(detail.get("message") or event.get("error"))
+        layer_id, status = event.get("id"), event.get("status") or ""
+        # "Mounted from xxx" 等状态带有后缀
+        if not layer_id or not status.startswith(LAYER_STATUS):
+            return
+        layer = self.stats.layer(layer_id)
+        now = time.monotonic()
+        if status in TRANSFER_STATUS:
+            if layer["started_at"] is None:
+                layer["started_at"] = now
+            current = (event.get("progressDetail") or {}).get("current") or 0
+            layer["bytes"] = max(layer["bytes"], current)
+            layer["status"] = status
+        elif status in DONE_STATUS:
+            if layer["started_at"] is not None:
+                layer["duration"] = now - layer["started_at"]
+            layer["status"] = status
+        elif status.startswith(SKIPPED_STATUS):
+            layer["status"] = status
+
+    def consume(self, events):
+        try:
+            for event in events:
+                self.feed(event)
+        finally:
+            self.stats.finish()
+        return self.stats
@@ -0,0 +1,105 @@
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+LOG = logging.getLogger(__name__)
+DEFAULT_LIMIT = {
+    # requests per second
+    'rate': 5.0,
+    'min_rate': 0.2,
+    'max_rate': 50.0,
+    'burst': 10,
+}
+# Multiplicative decrease on throttling, additive increase while healthy
+DECREASE_FACTOR = 0.5
+INCREASE_STEP = 0.5
+INCREASE_AFTER = 20
+MAX_RETRY_AFTER = 600
+
+_limits = {}
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket whose rate adapts to registry responses."""
+
+    def __init__(self, rate, min_rate, max_rate, burst):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.healthy = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def feedback(self, status_code=None, retry_after=None):
+        """Record a response, ``status_code`` is None for a network error."""
+        throttled = status_code is None or status_code == 429 or status_code >= 500
+        with self.lock:
+            if not throttled:
+                self.healthy += 1
+                if self.healthy >= INCREASE_AFTER and self.rate < self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + INCREASE_STEP)
+                    self.healthy = 0
+                return
+            self.healthy = 0
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0)
+            delay = parse_retry_after(retry_after)
+            if delay:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        LOG.warning("Registry throttled [{}], rate now {:.2f}/s"
+                    .format(status_code, self.rate))
+
+
+def parse_retry_after(value):
+    if not value:
+        return 0
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+
+def configure(limits):
+    """Set per-host limits, ``limits`` maps host (or "default") to a dict
+    with any of rate, min_rate, max_rate and burst."""
+    with _buckets_lock:
+        _limits.clear()
+        _limits.update(limits or {})
+        _buckets.clear()
+
+
+def get_bucket(host):
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            limit = dict(DEFAULT_LIMIT)
+            limit.update(_limits.get("default", {}))
+            limit.update(_limits.get(host, {}))
+            bucket = _buckets[host] = TokenBucket(**limit)
+        return bucket
@@ -1,12 +1,31 @@
+import re
+import time
+import itertools
 import requests
 import logging
-from urllib.parse import urljoin
+import threading
+from urllib.parse import urljoin, urlparse
 from requests.adapters import HTTPAdapter
+from requests.auth import _basic_auth_str
 
 from urllib3 import disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 
+from common import metrics
+from common.rate_limit import get_bucket
+
 LOG = logging.getLogger(__name__)
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_PAGE_SIZE = 1000
+POOL_SIZE = 32
+# Refresh bearer tokens a little before they expire
+TOKEN_EXPIRE_MARGIN = 10
+DEFAULT_TOKEN_EXPIRES_IN = 60
+# Bearer tokens cached per scope, the first to expire are dropped beyond this
+MAX_CACHED_TOKENS = 1024
+SCOPE_PATH = re.compile(r"^/v2/(.+?)/(?:manifests|blobs|tags)/")
+CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
 disable_warnings(InsecureRequestWarning)
 DEFAULT_HEADERS = {
     'User-Agent': "docker/19.01.0-ce",
@@ -16,37 +35,191 @@ DEFAULT_HEADERS = {
     'Content-Type': 'application/json',
 }
 
+MANIFEST_V1 = "application/vnd.docker.distribution.manifest.v1+json"
+MANIFEST_V1_SIGNED = "application/vnd.docker.distribution.manifest.v1+prettyjws"
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+MANIFEST_ACCEPT = ', '.join(
+    (MANIFEST_LIST_V2, OCI_INDEX, MANIFEST_V2, OCI_MANIFEST, MANIFEST_V1_SIGNED, MANIFEST_V1))
+
 
 class ClientError(ConnectionError):
-    pass
+    def __init__(self, msg, status_code=None, retry_after=None):
+        super(ClientError, self).__init__(msg)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url, username=None, password=None):
+    """Return the process-wide client for a registry and credentials.
+
+    Clients keep their connection pool and bearer tokens for the life of
+    the process, so they must not be closed by callers.
+    """
+    key = (str(base_url).rstrip("/"), username or None, password or None)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = GcrClient(
+                base_url, username=username, password=password)
+        return client
 
 
 class GcrClient(requests.Session):
-    def __init__(self, base_url, headers: dict = None):
+    def __init__(self, base_url, headers: dict = None,
+                 username=None, password=None, timeout=DEFAULT_TIMEOUT):
         super(GcrClient, self).__init__()
         self.base_url = base_url
+        self.timeout = timeout
         self.verify = False
         if not headers:
             headers = {}
         self.headers.update(DEFAULT_HEADERS)
         self.headers.update(headers)
-        self.mount("http://", HTTPAdapter(max_retries=3))
-        self.mount("https://", HTTPAdapter(max_retries=3))
+        self.username = username or None
+        self.password = password or ""
+        # Docker token auth: scope -> (Authorization header, expires at)
+        self._tokens = {}
+        self._basic_auth = False
+        self._auth_lock = threading.Lock()
+        self.mount("http://", HTTPAdapter(max_retries=3, pool_maxsize=POOL_SIZE))
+        self.mount("https://", HTTPAdapter(max_retries=3, pool_maxsize=POOL_SIZE))
+
+    def request(self, method, url, scope=None, **kwargs):
+        """Send a request, answering auth challenges.
+
+        ``scope`` is the space separated token scope, guessed from the
+        URL when not given.
+        """
+        if scope is None:
+            scope = self.guess_scope(method, url)
+        headers = dict(kwargs.pop('headers', None) or {})
+        authorization = self.authorization(scope)
+        if authorization:
+            headers['Authorization'] = authorization
+        rsp = self._limited_request(method, url, headers=headers, **kwargs)
+        if rsp.status_code == 401 and self.authenticate(rsp, scope):
+            rsp.close()
+            headers['Authorization'] = self.authorization(scope)
+            rsp = self._limited_request(method, url, headers=headers, **kwargs)
+        return rsp
+
+    @classmethod
+    def guess_scope(cls, method, url):
+        match = SCOPE_PATH.match(urlparse(url).path)
+        if not match:
+            return ""
+        actions = "pull" if method.upper() in ("GET", "HEAD") else "pull,push"
+        return "repository:{}:{}".format(match.group(1), actions)
+
+    def authorization(self, scope):
+        with self._auth_lock:
+            token = self._tokens.get(scope)
+            if token and token[1] > time.time():
+                return token[0]
+            if self._basic_auth:
+                return _basic_auth_str(self.username, self.password)
+        return None
+
+    def authenticate(self, response, scope):
+        """Handle a 401 challenge, returns True if the request can be retried."""
+        challenge = response.headers.get('WWW-Authenticate', '')
+        scheme = challenge.split(' ', 1)[0].lower()
+        if scheme == 'basic':
+            if not self.username or self._basic_auth:
+                return False
+            self._basic_auth = True
+            return True
+        if scheme != 'bearer':
+            return False
+
+        params = dict(CHALLENGE_PARAM.findall(challenge))
+        if 'realm' not in params:
+            return False
+        query = {'service': params.get('service', '')}
+        # 请求需要的 scope 都要带上，例如 mount 还需要源仓库的 pull
+        scopes = scope.split()
+        for extra in params.get('scope', '').split():
+            if extra not in scopes:
+                scopes.append(extra)
+        if scopes:
+            query['scope'] = scopes
+        auth = (self.username, self.password) if self.username else None
+        try:
+            rsp = super(GcrClient, self).request(
+                'GET', params['realm'], params=query, auth=auth, timeout=self.timeout)
+            result = self.result_or_raise(rsp)
+        except (requests.RequestException, ClientError, ValueError) as e:
+            LOG.warning("Get registry token error: {}".format(e))
+            return False
+        token = result.get('token') or result.get('access_token')
+        if not token:
+            return False
+        expires_in = int(result.get('expires_in') or DEFAULT_TOKEN_EXPIRES_IN)
+        expires_at = time.time() + max(expires_in - TOKEN_EXPIRE_MARGIN, 1)
+        self.store_token(scope, "Bearer {}".format(token), expires_at)
+        return True
+
+    def store_token(self, scope, authorization, expires_at):
+        with self._auth_lock:
+            now = time.time()
+            for key in [k for k, (_, expires) in self._tokens.items() if expires <= now]:
+                del self._tokens[key]
+            if len(self._tokens) >= MAX_CACHED_TOKENS:
+                # 仍然太多时丢掉最先过期的
+                del self._tokens[min(self._tokens, key=lambda k: self._tokens[k][1])]
+            self._tokens[scope] = (authorization, expires_at)
+
+    def _limited_request(self, method, url, **kwargs):
+        # 所有请求都经过该 Registry 的令牌桶，防止 ban
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).netloc
+        bucket = get_bucket(host)
+        bucket.acquire()
+        started_at = time.monotonic()
+        try:
+            rsp = super(GcrClient, self).request(method, url, **kwargs)
+        except requests.RequestException:
+            bucket.feedback()
+            metrics.REGISTRY_REQUESTS.inc(host=host, code="error")
+            raise
+        finally:
+            metrics.REGISTRY_LATENCY.observe(time.monotonic() - started_at, host=host)
+        bucket.feedback(rsp.status_code, rsp.headers.get('Retry-After'))
+        metrics.REGISTRY_REQUESTS.inc(host=host, code=rsp.status_code)
+        return rsp
 
     def url(self, path):
         return urljoin(self.base_url, path)
 
     @classmethod
     def result_or_raise(cls, response, json=True):
+        cls.raise_for_status(response)
+        if json:
+            return response.json()
+        return response.text
+
+    @classmethod
+    def raise_for_status(cls, response):
+        """Raise ClientError on a non-2xx response, without reading a 2xx body.
+
+        Accessing ``text`` would load streamed blobs into memory and run
+        charset detection over them.
+        """
         status_code = response.status_code
 
         if status_code // 100 != 2:
             msg = "[Status Code {}]: {}".format(status_code, response.text)
             LOG.warning(msg)
-            raise ClientError(msg)
-        if json:
-            return response.json()
-        return response.text
+            raise ClientError(msg, status_code=status_code,
+                              retry_after=response.headers.get('Retry-After'))
+        return response
 
     def is_valid(self):
         path = "/v2/"
@@ -58,20 +231,166 @@ class GcrClient(requests.Session):
             return False
         return True
 
-    def get_project_by_namespace(self, namespace):
+    def iter_responses(self, path, page_size=DEFAULT_PAGE_SIZE, headers=None):
+        """Yield the response of each page of a paginated listing.
+
+        ``headers`` are only sent with the first request.
+        """
+        url = self.url(path)
+        params = {'n': page_size} if page_size else None
+        while url:
+            rsp = self.get(url, params=params, headers=headers)
+            yield rsp
+            next_page = rsp.links.get('next')
+            # The next link already carries n and last
+            url = self.url(next_page['url']) if next_page else None
+            params = headers = None
+
+    def iter_pages(self, path, page_size=DEFAULT_PAGE_SIZE):
+        """Yield each page of a paginated listing, following the Link header."""
+        for rsp in self.iter_responses(path, page_size=page_size):
+            yield self.result_or_raise(rsp)
+
+    def iter_catalog(self, page_size=DEFAULT_PAGE_SIZE):
+        for page in self.iter_pages("/v2/_catalog", page_size=page_size):
+            yield from page.get('repositories') or []
+
+    def iter_project_by_namespace(self, namespace, page_size=DEFAULT_PAGE_SIZE):
         path = "/v2/{namespace}/tags/list".format(namespace=namespace)
-        result = self.result_or_raise(self.get(self.url(path)))
-        return result['child']
+        for page in self.iter_pages(path, page_size=page_size):
+            yield from page.get('child') or []
 
-    def get_project_tags(self, project_name, namespace=None):
+    @classmethod
+    def tags_path(cls, project_name, namespace=None):
         if namespace:
-            path = "/v2/{namespace}/{project}/tags/list" \
+            return "/v2/{namespace}/{project}/tags/list" \
                 .format(namespace=namespace, project=project_name)
-        else:
-            path = "/v2/{project}/tags/list" \
-                .format(namespace=namespace, project=project_name)
-        result = self.result_or_raise(self.get(self.url(path)))
-        return result['tags']
+        return "/v2/{project}/tags/list".format(project=project_name)
+
+    def iter_project_tags(self, project_name, namespace=None,
+                          page_size=DEFAULT_PAGE_SIZE):
+        path = self.tags_path(project_name, namespace)
+        for page in self.iter_pages(path, page_size=page_size):
+            yield from page.get('tags') or []
+
+    def list_project_tags(self, project_name, namespace=None, etag=None,
+                          page_size=DEFAULT_PAGE_SIZE):
+        """Request the first page of a project's tag listing.
+
+        Returns None if the listing still matches ``etag``, otherwise a
+        dict of ``pages``, ``etag`` and ``gcr``. ``pages`` yields the
+        first page and requests the next ones as it is consumed. On GCR
+        (``gcr`` is True) each page carries a digest -> {"tag": [...]}
+        ``manifest`` map. ``etag`` is only kept for listings of one page,
+        a change on a later page does not show on the first.
+        """
+        path = self.tags_path(project_name, namespace)
+        headers = {'If-None-Match': etag} if etag else None
+        responses = self.iter_responses(path, page_size=page_size, headers=headers)
+        rsp = next(responses)
+        if etag and rsp.status_code == 304:
+            rsp.close()
+            return None
+        first = self.result_or_raise(rsp)
+        return {
+            'pages': itertools.chain([first], (self.result_or_raise(r) for r in responses)),
+            'etag': "" if rsp.links.get('next') else rsp.headers.get('ETag', ""),
+            'gcr': 'manifest' in first,
+        }
+
+    def get_project_by_namespace(self, namespace):
+        return list(self.iter_project_by_namespace(namespace))
+
+    def get_project_tags(self, project_name, namespace=None):
+        return list(self.iter_project_tags(project_name, namespace=namespace))
+
+    def get_manifest(self, repository, reference):
+        """Return (content, media_type, digest) of a manifest."""
+        path = "/v2/{}/manifests/{}".format(repository, reference)
+        rsp = self.get(self.url(path), headers={'Accept': MANIFEST_ACCEPT})
+        self.raise_for_status(rsp)
+        media_type = rsp.headers.get('Content-Type', '').split(';')[0]
+        return rsp.content, media_type, rsp.headers.get('Docker-Content-Digest')
+
+    def head_manifest(self, repository, reference):
+        """Return the manifest digest, or None if it does not exist."""
+        path = "/v2/{}/manifests/{}".format(repository, reference)
+        rsp = self.head(self.url(path), headers={'Accept': MANIFEST_ACCEPT})
+        if rsp.status_code == 404:
+            return None
+        self.raise_for_status(rsp)
+        return rsp.headers.get('Docker-Content-Digest')
+
+    def put_manifest(self, repository, reference, content, media_type):
+        path = "/v2/{}/manifests/{}".format(repository, reference)
+        rsp = self.put(self.url(path), data=content,
+                       headers={'Content-Type': media_type})
+        self.raise_for_status(rsp)
+        return rsp.headers.get('Docker-Content-Digest')
+
+    def blob_exists(self, repository, digest):
+        path = "/v2/{}/blobs/{}".format(repository, digest)
+        rsp = self.head(self.url(path), allow_redirects=True)
+        if rsp.status_code == 404:
+            return False
+        self.raise_for_status(rsp)
+        return True
+
+    def get_blob(self, repository, digest):
+        """Return a streaming response, the caller must close it."""
+        path = "/v2/{}/blobs/{}".format(repository, digest)
+        rsp = self.get(self.url(path), stream=True)
+        self.raise_for_status(rsp)
+        return rsp
+
+    def start_upload(self, repository):
+        path = "/v2/{}/blobs/uploads/".format(repository)
+        rsp = self.post(self.url(path), headers={'Content-Length': '0'})
+        self.raise_for_status(rsp)
+        return self.url(rsp.headers['Location'])
+
+    def mount_blob(self, repository, digest, from_repository):
+        """Cross-repository mount, returns (mounted, upload location).
+
+        When the registry refuses the mount it opens a normal upload
+        session instead, which the caller can use to push the blob.
+        """
+        path = "/v2/{}/blobs/uploads/".format(repository)
+        scope = "repository:{}:pull,push repository:{}:pull".format(
+            repository, from_repository)
+        rsp = self.post(self.url(path), scope=scope,
+                        params={'mount': digest, 'from': from_repository},
+                        headers={'Content-Length': '0'})
+        self.raise_for_status(rsp)
+        if rsp.status_code == 201:
+            return True, None
+        return False, self.url(rsp.headers['Location'])
+
+    def cancel_upload(self, location):
+        """Close an unused upload session, errors are only logged."""
+        try:
+            rsp = self.delete(location)
+            rsp.close()
+        except requests.RequestException as e:
+            LOG.warning("Cancel upload {} error: {}".format(location, e))
+            return
+        if rsp.status_code // 100 != 2 and rsp.status_code != 404:
+            LOG.warning("Cancel upload {} error: [Status Code {}]"
+                        .format(location, rsp.status_code))
+
+    def upload_chunk(self, location, data, offset):
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Range': '{}-{}'.format(offset, offset + len(data) - 1),
+        }
+        rsp = self.patch(location, data=data, headers=headers)
+        self.raise_for_status(rsp)
+        return self.url(rsp.headers['Location'])
+
+    def finish_upload(self, location, digest):
+        rsp = self.put(location, params={'digest': digest},
+                       headers={'Content-Type': 'application/octet-stream'})
+        self.raise_for_status(rsp)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import random
+
+from requests import RequestException
+
+from common.rate_limit import parse_retry_after
+
+TRANSIENT = "transient"
+RATE_LIMITED = "rate_limited"
+FATAL = "fatal"
+# Registry answers that will not change by trying again
+FATAL_STATUS_CODES = (400, 401, 403, 404, 405)
+FATAL_MESSAGES = ("not found", "unauthorized", "denied", "manifest unknown")
+
+
+def classify(exc):
+    status_code = getattr(exc, "status_code", None)
+    if status_code == 429:
+        return RATE_LIMITED
+    if status_code in FATAL_STATUS_CODES:
+        return FATAL
+    if status_code is not None:
+        return TRANSIENT
+    retryable = getattr(exc, "retryable", None)
+    if retryable is not None:
+        return TRANSIENT if retryable else FATAL
+    if isinstance(exc, (RequestException, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    # 本地磁盘等错误 (如 ENOSPC) 可能恢复；解析 manifest 和响应头出错重试也一样
+    if isinstance(exc, OSError):
+        return TRANSIENT
+    if isinstance(exc, (ValueError, KeyError)):
+        return FATAL
+    message = str(exc).lower()
+    if any(m in message for m in FATAL_MESSAGES):
+        return FATAL
+    return TRANSIENT
+
+
+def backoff(attempt, base_delay, max_delay):
+    """Exponential backoff with full jitter."""
+    return random.uniform(base_delay, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry_countdown(exc, attempt, base_delay, max_delay):
+    """Seconds to wait before the next attempt, or None to give up."""
+    kind = classify(exc)
+    if kind == FATAL:
+        return None
+    if kind == RATE_LIMITED:
+        hint = parse_retry_after(getattr(exc, "retry_after", None))
+        if hint:
+            return hint + random.uniform(0, base_delay)
+    return backoff(attempt, base_delay, max_delay)
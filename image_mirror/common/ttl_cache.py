@@ -0,0 +1,63 @@
+import time
+import threading
+
+
+class TTLCache(object):
+    """Thread-safe in-process cache whose entries expire after ``ttl`` seconds.
+
+    Entries can be tagged with groups and dropped together with
+    ``invalidate``. When full, the oldest entries are evicted first.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires at, groups, value)，按写入顺序，最早写入的最先过期
+        self._data = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                self._pop(key)
+                return default
+            return entry[2]
+
+    def set(self, key, value, groups=()):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._pop(key)
+            while len(self._data) >= self.max_size:
+                self._pop(next(iter(self._data)))
+            self._data[key] = (time.monotonic() + self.ttl, tuple(groups), value)
+            for group in groups:
+                self._groups.setdefault(group, set()).add(key)
+
+    def invalidate(self, group):
+        with self._lock:
+            for key in list(self._groups.get(group, ())):
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._groups.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for group in entry[1]:
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
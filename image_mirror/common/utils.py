@@ -1,5 +1,6 @@
 import uuid
 import time
+from itertools import islice
 from datetime import datetime
 
 
@@ -16,3 +17,12 @@ def timestamp2datetime(timestamp, need_str=True):
     if need_str:
         return "{}".format(dt.strftime("%Y-%m-%d %H:%M:%S"))
     return dt
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import socket
 import sentry_sdk
 from sentry_sdk.integrations.django import DjangoIntegration
 
@@ -80,6 +81,13 @@ DATABASES = {
         'NAME': os.path.join(BASE_DIR, 'data/db.sqlite3'),
     }
 }
+# Applied to every new SQLite connection. WAL lets the admin read while
+# workers write, and writers wait for the lock instead of failing.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 30 * 1000,
+}
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -129,10 +137,96 @@ if os.getenv("CONTROLLER_SENTRY_DSN"):
 TARGET_CONFIG_FILE = os.path.join(BASE_DIR, "target.yml")
 FLUSH_NAMESPACE_MAX_TIME = 60 * 60 * 24
 FLUSH_PROJECT_MAX_TIME = 60 * 60 * 24
+# Catalog crawler: total threads, threads per registry host, rows per transaction
+FLUSH_CONCURRENCY = 16
+FLUSH_HOST_CONCURRENCY = 4
+FLUSH_WRITE_BATCH = 50
+# Seconds a registry host check (GET /v2/) is trusted when it passed / failed
+REGISTRY_VALID_TTL = 60 * 60 * 24
+REGISTRY_INVALID_TTL = 60 * 5
+# Adaptive token bucket per registry host, requests per second
+REGISTRY_RATE_LIMITS = {
+    "default": {"rate": 5, "min_rate": 0.2, "max_rate": 50, "burst": 10},
+}
 MAX_MIGRATE_TASK_PRE_PROJECT = 15
+# Tags dispatched per migrate_tags run, shared fairly between namespaces and projects
+MIGRATE_BATCH_SIZE = 500
+# Tags created within this window are scheduled before older ones
+NEW_TAG_WINDOW = 60 * 60 * 24 * 3
+# Queued/syncing Tags untouched for this long are assumed lost and sent again
+DISPATCH_LOCK_TIMEOUT = 60 * 60 * 24 * 2
+# Tags whose digest is re-checked on every flush
+MUTABLE_TAGS = ["latest"]
+# Delete Tags that no longer exist in the source registry on flush
+PRUNE_REMOVED_TAGS = False
 TARGET_REGISTRY_URL = "daocloud.io"
+TARGET_REGISTRY_API = os.getenv("TARGET_REGISTRY_API", "https://{}".format(TARGET_REGISTRY_URL))
 TARGET_REGISTRY_NAMESPACE = "gcr-mirror"
 TARGET_REGISTRY_USERNAME = os.getenv("TARGET_REGISTRY_USERNAME")
 TARGET_REGISTRY_PASSWORD = os.getenv("TARGET_REGISTRY_PASSWORD")
+# registry: copy through the Registry v2 API; docker: pull/tag/push via docker.sock
+SYNC_ENGINE = os.getenv("SYNC_ENGINE", "registry")
+# Platforms copied from multi-arch images when a Project sets none, "all" for every one
+MIRROR_PLATFORMS = os.getenv("MIRROR_PLATFORMS", "linux/amd64")
+WORKER_NODE = os.getenv("WORKER_NODE", socket.gethostname())
+# Docker engine: pulled images are removed in LRU order once the daemon's
+# layers pass the high-water mark, until usage is back under the low-water mark
+DOCKER_DISK_HIGH_WATER = int(os.getenv("DOCKER_DISK_HIGH_WATER", 50 * 1024 ** 3))
+DOCKER_DISK_LOW_WATER = int(os.getenv("DOCKER_DISK_LOW_WATER", 40 * 1024 ** 3))
+# Local blob cache shared by the worker processes of a host, 0 disables it.
+# Kept outside the source tree by default. Set BLOB_CACHE_SHARED when the
+# directory is a volume shared by all the fetch and publish workers.
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "gcr-mirror", "blobs"))
+BLOB_CACHE_MAX_SIZE = int(os.getenv("BLOB_CACHE_MAX_SIZE", 20 * 1024 ** 3))
+BLOB_CACHE_SHARED = str(os.getenv("BLOB_CACHE_SHARED")).upper() in ["T", "TRUE", "1"]
+# Failed syncs are rescheduled by Celery with exponential backoff and jitter
+SYNC_MAX_RETRIES = 10
+SYNC_RETRY_BASE_DELAY = 30
+SYNC_RETRY_MAX_DELAY = 60 * 60
+# Registry engine: split each sync into a fetch stage (source -> BLOB_CACHE_DIR)
+# and a publish stage (BLOB_CACHE_DIR -> target), consumed from separate queues.
+# Needs BLOB_CACHE_SHARED, otherwise each sync runs in a single task.
+SYNC_PIPELINE = str(os.getenv("SYNC_PIPELINE")).upper() in ["T", "TRUE", "1"]
+SYNC_FETCH_QUEUE = os.getenv("SYNC_FETCH_QUEUE", "fetch")
+SYNC_PUBLISH_QUEUE = os.getenv("SYNC_PUBLISH_QUEUE", "publish")
+# Route the sync tasks of a "project", or of a source "namespace", to the same
+# node through its "<queue>.<WORKER_NODE>" queue, so its layers and cached blobs
+# are reused; empty disables routing. Nodes are the workers consuming node
+# queues, looked up every SYNC_ROUTING_REFRESH seconds, or set per queue with
+# SYNC_ROUTING_NODES="celery=n1,n2;fetch=n1;publish=n3".
+SYNC_ROUTING = os.getenv("SYNC_ROUTING", "")
+SYNC_ROUTING_NODES = {
+    queue.strip(): [n.strip() for n in nodes.split(",") if n.strip()]
+    for queue, _, nodes in (item.partition("=")
+                            for item in os.getenv("SYNC_ROUTING_NODES", "").split(";"))
+    if queue.strip()
+}
+SYNC_ROUTING_REFRESH = 60
+SYNC_ROUTING_REPLICAS = 128
+# Processes store their metric counters at most this often, /metrics merges them;
+# snapshots of processes that stopped reporting are folded into a "retired"
+# total after the TTL, so the merged counters never go down
+METRICS_FLUSH_INTERVAL = 15
+METRICS_SNAPSHOT_TTL = 60 * 60 * 24
+# Image lookup API: seconds results are cached in-process and by proxies
+# (Cache-Control max-age), cached results per process, images per bulk request.
+# Changes made by other processes (workers) and bulk updates are only seen
+# once the cached result expires, so results may be up to the TTL old.
+LOOKUP_CACHE_TTL = int(os.getenv("LOOKUP_CACHE_TTL", 30))
+LOOKUP_CACHE_SIZE = 10000
+LOOKUP_BULK_MAX = 1000
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+CELERY_TASK_QUEUE_MAX_PRIORITY = 9
+CELERY_TASK_DEFAULT_PRIORITY = 4
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    # redis: emulate priorities with one list per level
+    "priority_steps": list(range(CELERY_TASK_QUEUE_MAX_PRIORITY + 1)),
+    "queue_order_strategy": "priority",
+}
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ROUTES = {
+    "worker.fetch_image": {"queue": SYNC_FETCH_QUEUE},
+    "worker.publish_image": {"queue": SYNC_PUBLISH_QUEUE},
+}
@@ -16,6 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from project import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', views.prometheus_metrics, name='metrics'),
+    path('api/images', views.lookup_images, name='lookup-images'),
+    path('api/images/<path:image>', views.lookup_image, name='lookup-image'),
 ]
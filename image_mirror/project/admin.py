@@ -1,8 +1,9 @@
 import threading
 import logging
 from django.contrib import admin
+from django.db.models import Count
 
-from .models import Namespace, Project, Tag
+from .models import Namespace, Project, RegistryHost, Tag, TAG_COUNT_FIELDS
 
 LOG = logging.getLogger(__name__)
 
@@ -33,19 +34,23 @@ def flush_project(modeladmin, request, queryset):
 
 def try_migrate_image(modeladmin, request, queryset):
     def _async_flush(tags):
-        for t in tags:
-            try:
-                t.migrate()
-            except Exception as e:
-                LOG.error(e, exec_info=True)
+        try:
+            Tag.objects.dispatch(tags)
+        except Exception as e:
+            LOG.error(e, exec_info=True)
 
     _tags = queryset.all()
     threading.Thread(target=_async_flush, args=(_tags,)).start()
 
 
+def revalidate_registry(modeladmin, request, queryset):
+    RegistryHost.objects.validate_hosts(queryset.values_list("host", flat=True), force=True)
+
+
 flush_namespace.short_description = "Flush selected namespace projects"
 flush_project.short_description = "Flush selected project tags"
 try_migrate_image.short_description = "Try send migrate task to worker"
+revalidate_registry.short_description = "Check selected registries again"
 
 
 class NamespaceAdmin(admin.ModelAdmin):
@@ -58,15 +63,26 @@ class NamespaceAdmin(admin.ModelAdmin):
         }],
     )
     readonly_fields = ["id", "create_time", "update_time"]
-    list_display = ["id", "name", "registry_host", "update_time"]
+    list_display = ["id", "name", "registry_host", "project_count", "update_time"]
     actions = [flush_namespace]
 
+    def get_queryset(self, request):
+        return super(NamespaceAdmin, self).get_queryset(request) \
+            .annotate(project_count=Count("projects"))
+
+    def project_count(self, obj):
+        return obj.project_count
+
+    project_count.short_description = "Project 数量"
+    project_count.admin_order_field = "project_count"
+
 
 class ProjectAdmin(admin.ModelAdmin):
     fieldsets = (
         ["基本信息", {"fields": ("id", ("create_time", "update_time"))}],
-        ["项目信息", {"fields": (("name", "project_name"),)}],
-        ["镜像", {"fields": ("source_image", "target_image", "tag_count")}],
+        ["项目信息", {"fields": (("name", "project_name"), "namespace")}],
+        ["镜像", {"fields": ("source_image", "target_image", "platforms")}],
+        ["Tag 统计", {"fields": (tuple(TAG_COUNT_FIELDS),)}],
         ["镜像仓库", {
             "fields":
                 (
@@ -75,9 +91,11 @@ class ProjectAdmin(admin.ModelAdmin):
                 )
         }],
     )
-    readonly_fields = ["id", "source_image", "target_image", "tag_count",
-                       "create_time", "update_time"]
-    list_display = ["name", "source_image", "target_image", "tag_count", "update_time"]
+    readonly_fields = ["id", "source_image", "target_image", "namespace",
+                       "create_time", "update_time"] + TAG_COUNT_FIELDS
+    list_display = ["name", "namespace", "source_image", "target_image", "tag_count",
+                    "synced_count", "error_count", "update_time"]
+    list_select_related = ("namespace",)
     search_fields = ["name", "source_image", "target_image"]
     actions = [flush_project]
     ordering = ("registry_namespace", "name")
@@ -87,15 +105,25 @@ class TagAdmin(admin.ModelAdmin):
     fieldsets = (
         ["基本信息", {"fields": ("id", ("create_time", "update_time"))}],
         ["项目信息", {"fields": ("project", "name")}],
-        ["镜像信息", {"fields": ("image_url",)}],
+        ["镜像信息", {"fields": ("image_url", "source_digest", "target_digest")}],
         ["同步任务", {"fields": ("status", "error_message")}],
+        ["传输统计", {"fields": (("transfer_bytes", "sync_duration", "transfer_rate"),
+                             "sync_stats")}],
     )
-    list_display = ["project", "name", "image_url", "status", "create_time"]
+    readonly_fields = ["transfer_rate"]
+    list_display = ["project", "name", "image_url", "status", "transfer_bytes",
+                    "sync_duration", "create_time"]
     search_fields = ["image_url"]
     list_filter = ["status"]
+    list_select_related = ("project",)
     actions = [try_migrate_image]
     ordering = ("-updated_at",)
 
+    def delete_queryset(self, request, queryset):
+        project_ids = set(queryset.values_list("project_id", flat=True))
+        super(TagAdmin, self).delete_queryset(request, queryset)
+        Project.objects.refresh_tag_counts(project_ids)
+
     def has_change_permission(self, request, obj=None):
         return False
 
@@ -106,6 +134,20 @@ class TagAdmin(admin.ModelAdmin):
         return False
 
 
+class RegistryHostAdmin(admin.ModelAdmin):
+    list_display = ["host", "is_valid", "error", "check_time"]
+    list_filter = ["is_valid"]
+    actions = [revalidate_registry]
+    ordering = ("host",)
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(Namespace, NamespaceAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(Tag, TagAdmin)
+admin.site.register(RegistryHost, RegistryHostAdmin)
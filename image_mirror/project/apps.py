@@ -1,5 +1,31 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+
+
+def setup_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
 
 
 class ProjectConfig(AppConfig):
     name = 'project'
+
+    def ready(self):
+        from common import rate_limit
+        rate_limit.configure(settings.REGISTRY_RATE_LIMITS)
+        connection_created.connect(setup_sqlite, dispatch_uid="project.setup_sqlite")
+
+        from . import lookup
+        from .models import Project, Tag
+        # Tag 不接 post_delete，否则批量删除 Tag 不能走 fast delete；
+        # 随 Project 级联删除的 Tag 由 Project 的 post_delete 失效
+        post_save.connect(lookup.invalidate_tag, sender=Tag,
+                          dispatch_uid="project.lookup.tag")
+        for signal in (post_save, post_delete):
+            signal.connect(lookup.invalidate_project, sender=Project,
+                           dispatch_uid="project.lookup.project")
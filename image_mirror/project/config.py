@@ -0,0 +1,180 @@
+import logging
+
+import yaml
+from django.db import transaction
+
+from common import utils
+from .models import Namespace, Project, Tag, BULK_BATCH_SIZE
+
+LOG = logging.getLogger(__name__)
+NAMESPACE_FIELDS = ["registry_username", "registry_password"]
+PROJECT_FIELDS = ["project_name", "registry_host", "registry_namespace",
+                  "registry_username", "registry_password", "platforms"]
+SUPPORTED_NAMESPACE_HOSTS = ("https://gcr.io",)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def parse_platforms_option(value):
+    if isinstance(value, (list, tuple)):
+        return ",".join(value)
+    return value or ""
+
+
+class TargetConfig(object):
+    """The namespaces and projects declared in target.yml.
+
+    Namespaces are identified by (name, registry_host) and projects by
+    name. ``diff`` compares them with the database in a few queries.
+    """
+
+    def __init__(self, content):
+        content = content or {}
+        self.namespaces = {}
+        self.projects = {}
+        try:
+            for name, namespace in (content.get("namespaces") or {}).items():
+                name = str(name).strip()
+                registry_host = str(namespace["registry_host"]).strip()
+                if registry_host not in SUPPORTED_NAMESPACE_HOSTS:
+                    raise ConfigError("Namespace {}: do not support registry {}"
+                                      .format(name, registry_host))
+                self.namespaces[(name, registry_host)] = {
+                    "registry_username": namespace.get("registry_username") or "",
+                    "registry_password": namespace.get("registry_password") or "",
+                }
+            for name, project in (content.get("projects") or {}).items():
+                self.projects[str(name).strip()] = {
+                    "project_name": project["project_name"],
+                    "registry_host": str(project["registry_host"]).strip(),
+                    "registry_namespace": project.get("registry_namespace") or "",
+                    "registry_username": project.get("registry_username") or "",
+                    "registry_password": project.get("registry_password") or "",
+                    "platforms": parse_platforms_option(project.get("platforms")),
+                }
+        except KeyError as e:
+            raise ConfigError("Config error, miss key: {}".format(e))
+        except (AttributeError, TypeError) as e:
+            raise ConfigError("Config error: {}".format(e))
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r") as f:
+                content = yaml.safe_load(f)
+        except OSError as e:
+            raise ConfigError("Can not get config file: {}.".format(e))
+        except yaml.YAMLError as e:
+            raise ConfigError("Load config file error: {}.".format(e))
+        if content is not None and not isinstance(content, dict):
+            raise ConfigError("Config error: expected a mapping")
+        return cls(content)
+
+    def diff(self):
+        result = ConfigDiff()
+        existing = {(n.name, n.registry_host): n for n in Namespace.objects.all()}
+        for key, fields in self.namespaces.items():
+            namespace = existing.pop(key, None)
+            if namespace is None:
+                result.namespaces["create"].append(
+                    Namespace(name=key[0], registry_host=key[1], **fields))
+            elif set_changed_fields(namespace, fields):
+                result.namespaces["update"].append(namespace)
+        result.namespaces["delete"] = list(existing.values())
+
+        existing = {p.name: p for p in Project.objects.all()}
+        for name, fields in self.projects.items():
+            project = existing.pop(name, None)
+            if project is None:
+                result.projects["create"].append(Project(name=name, **fields))
+            elif set_changed_fields(project, fields):
+                result.projects["update"].append(project)
+        # Namespace 下的 Project 由 flush 维护，不在配置文件里
+        result.projects["delete"] = [p for p in existing.values() if p.namespace_id is None]
+        return result
+
+
+def set_changed_fields(obj, fields):
+    """Copy ``fields`` onto ``obj``, return True if any value changed."""
+    changed = False
+    for field, value in fields.items():
+        if (getattr(obj, field) or "") != value:
+            setattr(obj, field, value)
+            changed = True
+    return changed
+
+
+class ConfigDiff(object):
+    """Namespaces and projects to create, update and delete."""
+
+    def __init__(self):
+        self.namespaces = {"create": [], "update": [], "delete": []}
+        self.projects = {"create": [], "update": [], "delete": []}
+
+    @property
+    def hosts(self):
+        """Registry hosts of the new and changed entries."""
+        return {obj.registry_host for objs in (self.namespaces, self.projects)
+                for action in ("create", "update") for obj in objs[action]}
+
+    def is_empty(self, prune=False):
+        actions = ("create", "update", "delete") if prune else ("create", "update")
+        return not any(objs[action] for objs in (self.namespaces, self.projects)
+                       for action in actions)
+
+    def summary(self, prune=False):
+        lines = []
+        for kind, objs in (("Namespaces", self.namespaces), ("Projects", self.projects)):
+            line = "{}: {} to create, {} to update, {} to delete".format(
+                kind, len(objs["create"]), len(objs["update"]),
+                len(objs["delete"]) if prune else 0)
+            if objs["delete"] and not prune:
+                line += " ({} not in config, kept without --prune)".format(
+                    len(objs["delete"]))
+            lines.append(line)
+            for action in ("create", "update", "delete"):
+                if action == "delete" and not prune:
+                    continue
+                names = sorted(obj.name for obj in objs[action])
+                if names:
+                    lines.append("  {}: {}{}".format(
+                        action, ", ".join(names[:20]),
+                        " ..." if len(names) > 20 else ""))
+        return lines
+
+    def apply(self, prune=False):
+        """Write the diff in one transaction."""
+        with transaction.atomic():
+            Namespace.objects.bulk_create(self.namespaces["create"],
+                                          batch_size=BULK_BATCH_SIZE)
+            Namespace.objects.bulk_update(self.namespaces["update"], NAMESPACE_FIELDS,
+                                          batch_size=BULK_BATCH_SIZE)
+
+            for project in self.projects["create"]:
+                project.update_images()
+            Project.objects.bulk_create(self.projects["create"],
+                                        batch_size=BULK_BATCH_SIZE)
+            moved = []
+            for project in self.projects["update"]:
+                if project.update_images():
+                    # 更换了镜像，Tag 删掉重新同步，下一轮 flush 重新拉取
+                    project.updated_at = 0
+                    moved.append(project.id)
+            for ids in utils.chunked(moved, BULK_BATCH_SIZE):
+                Tag.objects.filter(project_id__in=ids).delete()
+            # 计数是 diff() 时读到的，只重新统计 Tag 被删掉的 Project，
+            # 其他 Project 的计数可能已经被 worker 修改
+            Project.objects.bulk_update(
+                self.projects["update"],
+                PROJECT_FIELDS + ["source_image", "target_image", "tags_etag", "updated_at"],
+                batch_size=BULK_BATCH_SIZE)
+            Project.objects.refresh_tag_counts(moved)
+
+            if prune:
+                for objs, model in ((self.projects, Project), (self.namespaces, Namespace)):
+                    ids = [obj.id for obj in objs["delete"]]
+                    for chunk in utils.chunked(ids, BULK_BATCH_SIZE):
+                        model.objects.filter(id__in=chunk).delete()
+        LOG.info("Applied config:\n{}".format("\n".join(self.summary(prune))))
@@ -0,0 +1,76 @@
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import transaction
+
+LOG = logging.getLogger(__name__)
+
+
+class CatalogCrawler(object):
+    """Fetch registry catalogs concurrently and write results in batches.
+
+    ``fetch(obj)`` runs in a bounded thread pool and must only talk to
+    the registry. ``apply(obj, result)`` runs in the calling thread, so
+    all database writes stay on one connection and are committed every
+    ``batch_size`` results.
+    """
+
+    def __init__(self, concurrency=None, host_concurrency=None,
+                 batch_size=None):
+        self.concurrency = concurrency or settings.FLUSH_CONCURRENCY
+        self.host_concurrency = host_concurrency or settings.FLUSH_HOST_CONCURRENCY
+        self.batch_size = batch_size or settings.FLUSH_WRITE_BATCH
+        self._lock = threading.Lock()
+        self._host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(self.host_concurrency))
+
+    def host_slot(self, registry_host):
+        host = urlparse(str(registry_host)).netloc or str(registry_host)
+        with self._lock:
+            return self._host_slots[host]
+
+    def _fetch(self, fetch, obj):
+        # 请求速率由 GcrClient 的令牌桶控制
+        with self.host_slot(obj.registry_host):
+            return fetch(obj)
+
+    def crawl(self, objects, fetch, apply):
+        done = failed = 0
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self._fetch, fetch, obj): obj
+                       for obj in objects}
+            for future in as_completed(futures):
+                obj = futures[future]
+                try:
+                    batch.append((obj, future.result()))
+                except Exception as e:
+                    failed += 1
+                    LOG.error("Flush {} error: {}".format(obj, e), exc_info=True)
+                    continue
+                if len(batch) >= self.batch_size:
+                    failed += self._apply(batch, apply)
+                    done += len(batch)
+                    batch = []
+        if batch:
+            failed += self._apply(batch, apply)
+            done += len(batch)
+        LOG.info("Crawled {} objects, {} failed".format(done, failed))
+        return done, failed
+
+    @classmethod
+    def _apply(cls, batch, apply):
+        failed = 0
+        with transaction.atomic():
+            for obj, result in batch:
+                try:
+                    with transaction.atomic():
+                        apply(obj, result)
+                except Exception as e:
+                    failed += 1
+                    LOG.error("Save {} error: {}".format(obj, e), exc_info=True)
+        return failed
@@ -0,0 +1,113 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Q
+
+from common import utils
+from common.ttl_cache import TTLCache
+from .models import Project, Tag
+
+LOG = logging.getLogger(__name__)
+# 每批查询的镜像数，Tag 查询的参数个数约为它的两倍
+BATCH_SIZE = 200
+
+# 只在本进程内失效：worker 等其他进程的修改以及 bulk_create/update 不发信号，
+# 最多 LOOKUP_CACHE_TTL 秒后可见。响应本身也允许代理缓存同样长的时间，
+# 所以查询结果最多落后 LOOKUP_CACHE_TTL 秒，这是有意的取舍
+CACHE = TTLCache(settings.LOOKUP_CACHE_TTL, settings.LOOKUP_CACHE_SIZE)
+
+
+def parse_reference(reference):
+    """Split "registry/repository:tag" or "registry/repository@digest".
+
+    Returns (repository, tag, digest), the tag defaults to "latest".
+    """
+    reference = reference.strip()
+    if "://" in reference:
+        reference = reference.split("://", 1)[1]
+    if "@" in reference:
+        repository, digest = reference.split("@", 1)
+        return repository, "", digest
+    # 最后一段里的冒号才是 tag，前面的可能是端口
+    if ":" in reference.rsplit("/", 1)[-1]:
+        repository, tag = reference.rsplit(":", 1)
+        return repository, tag, ""
+    return reference, "latest", ""
+
+
+def tag_result(reference, tag):
+    if tag is None:
+        return {"image": reference, "found": False}
+    return {
+        "image": reference,
+        "found": True,
+        "mirrored": tag.status == "synced",
+        "status": tag.status,
+        "target_image": tag.image_url,
+        "source_digest": tag.source_digest,
+        "target_digest": tag.target_digest,
+        "updated_at": tag.updated_at,
+    }
+
+
+def query(references):
+    """Look ``references`` up in two queries, return {reference: (result, project ids)}."""
+    parsed = {ref: parse_reference(ref) for ref in references}
+    projects = defaultdict(list)
+    rows = Project.objects.filter(source_image__in={p[0] for p in parsed.values()}) \
+        .values_list("id", "source_image")
+    for project_id, source_image in rows:
+        projects[source_image].append(project_id)
+
+    tags = defaultdict(list)
+    project_ids = [i for ids in projects.values() for i in ids]
+    if project_ids:
+        names = {p[1] for p in parsed.values() if p[1]}
+        digests = {p[2] for p in parsed.values() if p[2]}
+        rows = Tag.objects.filter(project_id__in=project_ids) \
+            .filter(Q(name__in=names) | Q(source_digest__in=digests)) \
+            .only("name", "project_id", "image_url", "status",
+                  "source_digest", "target_digest", "updated_at")
+        for t in rows:
+            tags[(t.project_id, t.name)].append(t)
+            if t.source_digest:
+                tags[(t.project_id, t.source_digest)].append(t)
+
+    results = {}
+    for ref, (repository, name, digest) in parsed.items():
+        ids = projects.get(repository, [])
+        candidates = [t for i in ids for t in tags.get((i, name or digest), ())]
+        # 同一个源镜像在多个 Project 中时，优先已同步、最近更新的
+        best = max(candidates, key=lambda t: (t.status == "synced", t.updated_at),
+                   default=None)
+        results[ref] = (tag_result(ref, best), ids or [None])
+    return results
+
+
+def lookup(references):
+    """Return the result of each reference, in order, from the cache when possible."""
+    references = [str(ref).strip() for ref in references]
+    results = {}
+    misses = []
+    for ref in dict.fromkeys(references):
+        cached = CACHE.get(ref)
+        if cached is None:
+            misses.append(ref)
+        else:
+            results[ref] = cached
+    for chunk in utils.chunked(misses, BATCH_SIZE):
+        for ref, (result, project_ids) in query(chunk).items():
+            CACHE.set(ref, result, groups=project_ids)
+            results[ref] = result
+    return [results[ref] for ref in references]
+
+
+def invalidate_tag(sender, instance, **kwargs):
+    CACHE.invalidate(instance.project_id)
+
+
+def invalidate_project(sender, instance, **kwargs):
+    CACHE.invalidate(instance.id)
+    # 新的 Project 可能匹配之前查不到的镜像
+    CACHE.invalidate(None)
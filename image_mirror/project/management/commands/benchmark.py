@@ -0,0 +1,76 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmark.runner import Benchmark, compare
+
+
+class Command(BaseCommand):
+    help = 'Benchmark flush, dispatch and copy against a local fake registry.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--namespaces', type=int, default=1)
+        parser.add_argument('--projects', type=int, default=100,
+                            help='Projects per namespace.')
+        parser.add_argument('--tags', type=int, default=100,
+                            help='Tags per project.')
+        parser.add_argument('--layers', type=int, default=1,
+                            help='Layers unique to each image.')
+        parser.add_argument('--shared-layers', type=int, default=2,
+                            help='Layers shared by every image.')
+        parser.add_argument('--layer-size', type=int, default=1024 * 1024,
+                            help='Bytes per layer.')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds added to every registry request.')
+        parser.add_argument('--concurrency', type=int, default=None)
+        parser.add_argument('--host-concurrency', type=int, default=None)
+        parser.add_argument('--dispatch-budget', type=int, default=None)
+        parser.add_argument('--copy-tags', type=int, default=50,
+                            help='Number of tags copied end to end.')
+        parser.add_argument('--copy-concurrency', type=int, default=4)
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Keep REGISTRY_RATE_LIMITS instead of disabling them.')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON result to this file.')
+        parser.add_argument('--compare', default=None,
+                            help='A previous JSON result to compare with.')
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            # 每个 Project/Tag 都会打 INFO 日志
+            logging.disable(logging.INFO)
+        benchmark = Benchmark(
+            namespaces=options['namespaces'], projects=options['projects'],
+            tags=options['tags'], layers=options['layers'],
+            shared_layers=options['shared_layers'], layer_size=options['layer_size'],
+            latency=options['latency'], concurrency=options['concurrency'],
+            host_concurrency=options['host_concurrency'],
+            dispatch_budget=options['dispatch_budget'],
+            copy_tags=options['copy_tags'],
+            copy_concurrency=options['copy_concurrency'],
+            rate_limits=options['rate_limits'])
+        try:
+            result = benchmark.run()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        output = json.dumps(result, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        for stage, data in result['stages'].items():
+            self.stdout.write("{:<18} {:>10.3f}s {:>8} queries {:>8} requests".format(
+                stage, data['seconds'], data['queries'], data['registry_requests']))
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError("Read {} error: {}".format(options['compare'], e))
+            for stage, metric, before, after, ratio in compare(baseline, result):
+                self.stdout.write("{:<18} {:<18} {:>12} -> {:<12} x{}".format(
+                    stage, metric, before, after, ratio))
@@ -1,15 +1,19 @@
 from django.core.management.base import BaseCommand, CommandError
 
-from project.models import Project, Tag
+from project.models import Tag
+from project.scheduler import MigrationScheduler
 
 
 class Command(BaseCommand):
     help = 'Send SYNC task to worker.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Maximum number of tags to send.')
+
     def handle(self, *args, **options):
-        all_projects = Project.objects.all()
-        for p in all_projects:
-            Tag.objects.migrate_project_images(p.id)
-            self.stdout.write(self.style.NOTICE(
-                'send project[{}] task finish.'.format(p.name)))
-        self.stdout.write(self.style.SUCCESS('Successfully.'))
+        Tag.objects.release_stale_locks()
+        count = MigrationScheduler(budget=options['limit']).dispatch()
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully send {} task.'.format(count)))
@@ -1,48 +1,48 @@
-import yaml
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from project.models import Namespace, Project
+from project.config import ConfigError, TargetConfig
+from project.models import RegistryHost
 
 
 class Command(BaseCommand):
     help = 'Reload sync source config.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--config', default=settings.TARGET_CONFIG_FILE,
+                            help='Config file, defaults to TARGET_CONFIG_FILE.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only print what would change.')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete namespaces and projects missing from the config.')
+        parser.add_argument('--skip-validation', action='store_true',
+                            help='Do not check the registry hosts.')
+        parser.add_argument('--force-validation', action='store_true',
+                            help='Check the registry hosts even if a recent result is cached.')
+
     def handle(self, *args, **options):
-        config_path = settings.TARGET_CONFIG_FILE
-        try:
-            with open(config_path, "r") as f:
-                payload = f.read()
-            content = yaml.load(payload)
-        except OSError as e:
-            raise CommandError(
-                'Can not get config file: {}.'.format(e))
-        except ValueError as e:
-            raise CommandError(
-                'Load config file error: {}.'.format(e))
-        namespaces = content.get("namespaces", {})
-        projects = content.get("projects", {})
         try:
-            for p_name, project in projects.items():
-                Project.objects.create_project(
-                    name=p_name,
-                    project_name=project['project_name'],
-                    registry_host=project['registry_host'],
-                    registry_namespace=project.get("registry_namespace", ""),
-                    registry_username=project.get("registry_username", ""),
-                    registry_password=project.get("registry_password", ""),
-                )
-
-            for n_name, namespace in namespaces.items():
-                if namespace['registry_host'] != "https://gcr.io":
-                    raise CommandError("Do not support others.")
-                Namespace.objects.create_namespace(
-                    name=n_name,
-                    registry_host=namespace['registry_host'],
-                    registry_username=namespace.get("registry_username", ""),
-                    registry_password=namespace.get("registry_password", ""),
-                )
-        except KeyError as e:
-            raise CommandError("Config error, miss key: {}".format(e))
+            diff = TargetConfig.load(options['config']).diff()
+        except ConfigError as e:
+            raise CommandError(e)
+
+        for line in diff.summary(prune=options['prune']):
+            self.stdout.write(line)
+        if diff.is_empty(prune=options['prune']):
+            self.stdout.write(self.style.SUCCESS('Config not changed.'))
+            return
+
+        if not options['skip_validation']:
+            # 只检查新增和修改的条目用到的 Registry，每个 host 一次；dry run 不写库
+            errors = RegistryHost.objects.validate_hosts(
+                diff.hosts, force=options['force_validation'], save=not options['dry_run'])
+            if errors:
+                raise CommandError("Invalid registry hosts, nothing applied:\n{}".format(
+                    "\n".join("  {}: {}".format(host, error)
+                              for host, error in sorted(errors.items()))))
 
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Dry run, nothing applied.'))
+            return
+        diff.apply(prune=options['prune'])
         self.stdout.write(self.style.SUCCESS('Load config successfully.'))
@@ -6,9 +6,19 @@ from project.models import Namespace
 class Command(BaseCommand):
     help = 'Update namespace project.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Number of registry requests in flight.')
+        parser.add_argument(
+            '--host-concurrency', type=int, default=None,
+            help='Number of requests in flight per registry host.')
+
     def handle(self, *args, **options):
         try:
-            Namespace.objects.flush_namespace_project()
+            Namespace.objects.flush_namespace_project(
+                concurrency=options['concurrency'],
+                host_concurrency=options['host_concurrency'])
         except Exception as e:
             raise CommandError(e)
         self.stdout.write(self.style.SUCCESS('Successfully.'))
@@ -6,9 +6,23 @@ from project.models import Project
 class Command(BaseCommand):
     help = 'Update projects tags'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune', action='store_true', default=None,
+            help='Delete tags that were removed from the source registry.')
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Number of registry requests in flight.')
+        parser.add_argument(
+            '--host-concurrency', type=int, default=None,
+            help='Number of requests in flight per registry host.')
+
     def handle(self, *args, **options):
         try:
-            Project.objects.flush_projects_tag()
+            Project.objects.flush_projects_tag(
+                prune=options['prune'],
+                concurrency=options['concurrency'],
+                host_concurrency=options['host_concurrency'])
         except Exception as e:
             raise CommandError(e)
         self.stdout.write(self.style.SUCCESS('Successfully.'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from project.models import Namespace, Project, RegistryHost
+
+
+class Command(BaseCommand):
+    help = 'Check the source registries and cache the results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'hosts', nargs='*',
+            help='Registry hosts, defaults to every host used by a namespace or project.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Check again even if a recent result is cached.')
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Number of hosts checked at the same time.')
+
+    def handle(self, *args, **options):
+        hosts = set(options['hosts'])
+        if not hosts:
+            hosts.update(Namespace.objects.values_list("registry_host", flat=True).distinct())
+            hosts.update(Project.objects.values_list("registry_host", flat=True).distinct())
+        errors = RegistryHost.objects.validate_hosts(
+            hosts, force=options['force'], concurrency=options['concurrency'])
+        for host in sorted(hosts):
+            if host in errors:
+                self.stdout.write(self.style.ERROR("{}: {}".format(host, errors[host])))
+            else:
+                self.stdout.write("{}: ok".format(host))
+        if errors:
+            raise CommandError("{} of {} registry hosts are invalid.".format(
+                len(errors), len(hosts)))
+        self.stdout.write(self.style.SUCCESS('Successfully.'))
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='source_digest',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='target_digest',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+    ]
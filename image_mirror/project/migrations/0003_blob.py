@@ -0,0 +1,26 @@
+# Generated by Django 2.1.5 on 2026-10-17 21:20
+
+import common.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0002_tag_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.CharField(default=common.utils.gen_uuid, max_length=36, primary_key=True, serialize=False)),
+                ('digest', models.CharField(db_index=True, max_length=128)),
+                ('repository', models.CharField(max_length=256)),
+                ('created_at', models.BigIntegerField(default=common.utils.get_time)),
+            ],
+            options={
+                'unique_together': {('digest', 'repository')},
+            },
+        ),
+    ]
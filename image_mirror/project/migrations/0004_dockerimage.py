@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:10
+
+import common.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0003_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DockerImage',
+            fields=[
+                ('id', models.CharField(default=common.utils.gen_uuid, max_length=36, primary_key=True, serialize=False)),
+                ('node', models.CharField(max_length=256)),
+                ('reference', models.CharField(max_length=512)),
+                ('in_use', models.BooleanField(default=False)),
+                ('last_used_at', models.BigIntegerField(default=common.utils.get_time)),
+            ],
+            options={
+                'unique_together': {('node', 'reference')},
+                'index_together': {('node', 'last_used_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0004_dockerimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='platforms',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0005_project_platforms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='dispatch_token',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=36),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='status',
+            field=models.CharField(choices=[('pending', '等待同步'), ('queued', '已发送任务'), ('syncing', '正在同步'), ('synced', '同步完成'), ('error', '异常')], db_index=True, default='pending', max_length=128),
+        ),
+    ]
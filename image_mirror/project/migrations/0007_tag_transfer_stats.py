@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-17 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0006_tag_dispatch_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='transfer_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='sync_duration',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='sync_stats',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-17 23:58
+
+from django.db import migrations, models
+import common.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0007_tag_transfer_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSnapshot',
+            fields=[
+                ('source', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('data', models.TextField()),
+                ('updated_at', models.BigIntegerField(default=common.utils.get_time)),
+            ],
+        ),
+    ]
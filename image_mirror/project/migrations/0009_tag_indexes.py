@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 00:20
+
+from django.db import migrations, models
+
+# 同名 Tag 只保留一个：优先已同步的，其次最近更新的
+STATUS_RANK = {"synced": 0, "syncing": 1, "queued": 2, "pending": 3, "error": 4}
+
+
+def remove_duplicate_tags(apps, schema_editor):
+    Tag = apps.get_model("project", "Tag")
+    duplicates = Tag.objects.values("project_id", "name") \
+        .annotate(count=models.Count("id")).filter(count__gt=1).order_by()
+    for duplicate in duplicates:
+        tags = sorted(
+            Tag.objects.filter(project_id=duplicate["project_id"], name=duplicate["name"]),
+            key=lambda t: (STATUS_RANK.get(t.status, len(STATUS_RANK)), -t.updated_at))
+        Tag.objects.filter(id__in=[t.id for t in tags[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0008_metricsnapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_tags, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='project_id',
+            field=models.CharField(max_length=36),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='status',
+            field=models.CharField(choices=[('pending', '等待同步'), ('queued', '已发送任务'), ('syncing', '正在同步'), ('synced', '同步完成'), ('error', '异常')], default='pending', max_length=128),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tag',
+            unique_together={('project_id', 'name')},
+        ),
+        migrations.AlterIndexTogether(
+            name='tag',
+            index_together={('project_id', 'status'), ('status', 'updated_at')},
+        ),
+    ]
@@ -0,0 +1,120 @@
+# Generated by Django 2.2.28 on 2026-10-18 01:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+STATUSES = ("pending", "queued", "syncing", "synced", "error")
+
+
+def remove_orphans(apps, schema_editor):
+    Namespace = apps.get_model("project", "Namespace")
+    Project = apps.get_model("project", "Project")
+    Tag = apps.get_model("project", "Tag")
+    # 加外键约束前清理已经悬空的引用
+    Tag.objects.exclude(project_id__in=Project.objects.values("id")).delete()
+    Project.objects.exclude(namespace_id__in=Namespace.objects.values("id")) \
+        .update(namespace_id=None)
+
+
+def count_tags(apps, schema_editor):
+    Project = apps.get_model("project", "Project")
+    Tag = apps.get_model("project", "Tag")
+    counts = {}
+    rows = Tag.objects.order_by().values_list("project_id", "status") \
+        .annotate(count=models.Count("id"))
+    for project_id, status, count in rows:
+        counts.setdefault(project_id, {})[status] = count
+    for project_id, project_counts in counts.items():
+        values = {"{}_count".format(s): project_counts.get(s, 0) for s in STATUSES}
+        Project.objects.filter(id=project_id) \
+            .update(tag_count=sum(project_counts.values()), **values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0009_tag_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_orphans, migrations.RunPython.noop),
+        # 列名不变 (project_id / namespace_id)，只改模型状态
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterUniqueTogether(
+                name='tag',
+                unique_together=set(),
+            ),
+            migrations.AlterIndexTogether(
+                name='tag',
+                index_together=set(),
+            ),
+            migrations.RemoveField(
+                model_name='tag',
+                name='project_id',
+            ),
+            migrations.AddField(
+                model_name='tag',
+                name='project',
+                field=models.ForeignKey(db_constraint=False, db_index=False, default='', on_delete=django.db.models.deletion.CASCADE, related_name='tags', to='project.Project'),
+                preserve_default=False,
+            ),
+            migrations.AlterUniqueTogether(
+                name='tag',
+                unique_together={('project', 'name')},
+            ),
+            migrations.AlterIndexTogether(
+                name='tag',
+                index_together={('project', 'status'), ('status', 'updated_at')},
+            ),
+            migrations.RemoveField(
+                model_name='project',
+                name='namespace_id',
+            ),
+            migrations.AddField(
+                model_name='project',
+                name='namespace',
+                field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='projects', to='project.Namespace'),
+            ),
+        ]),
+        migrations.AlterField(
+            model_name='tag',
+            name='project',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tags', to='project.Project'),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='namespace',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='projects', to='project.Namespace'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='tag_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='pending_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='queued_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='syncing_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='synced_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='error_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
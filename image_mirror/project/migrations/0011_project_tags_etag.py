@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0010_foreign_keys_and_tag_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='tags_etag',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('project', '0011_project_tags_etag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistryHost',
+            fields=[
+                ('host', models.CharField(max_length=256, primary_key=True, serialize=False)),
+                ('is_valid', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True, default='')),
+                ('checked_at', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,36 +1,51 @@
+import os
+import json
 import time
 import logging
-from django.db import models
+from concurrent.futures import ThreadPoolExecutor
+from django.db import models, transaction
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
-from common import utils
-from common.registry_client import GcrClient
+from common import metrics, utils
+from common.image_copier import parse_platforms
+from common.registry_client import get_client
 
 LOG = logging.getLogger(__name__)
 FLUSH_NAMESPACE_MAX_TIME = settings.FLUSH_NAMESPACE_MAX_TIME
 FLUSH_PROJECT_MAX_TIME = settings.FLUSH_PROJECT_MAX_TIME
 MAX_MIGRATE_TASK_PRE_PROJECT = settings.MAX_MIGRATE_TASK_PRE_PROJECT
+MUTABLE_TAGS = settings.MUTABLE_TAGS
+MIRROR_PLATFORMS = settings.MIRROR_PLATFORMS
+PRUNE_REMOVED_TAGS = settings.PRUNE_REMOVED_TAGS
+BULK_BATCH_SIZE = 500
+DOCKER_IMAGE_IN_USE_TIMEOUT = 60 * 60 * 6
+DISPATCH_LOCK_TIMEOUT = settings.DISPATCH_LOCK_TIMEOUT
+METRICS_FLUSH_INTERVAL = settings.METRICS_FLUSH_INTERVAL
+METRICS_SNAPSHOT_TTL = settings.METRICS_SNAPSHOT_TTL
+# 已停止进程的计数器累加到这一行
+RETIRED_METRICS_SOURCE = "retired"
+REGISTRY_VALID_TTL = settings.REGISTRY_VALID_TTL
+REGISTRY_INVALID_TTL = settings.REGISTRY_INVALID_TTL
+# 可以发送同步任务的状态
+DISPATCHABLE_STATUS = ("pending", "error")
 TARGET_REGISTRY_URL = settings.TARGET_REGISTRY_URL
 TARGET_REGISTRY_NAMESPACE = settings.TARGET_REGISTRY_NAMESPACE
 PROJECT_TAG_STATUS = [
     ("pending", "等待同步"),
+    ("queued", "已发送任务"),
     ("syncing", "正在同步"),
     ("synced", "同步完成"),
     ("error", "异常"),
 ]
+# Project 上的 Tag 计数字段
+TAG_COUNT_FIELDS = ["tag_count"] + ["{}_count".format(s) for s, _ in PROJECT_TAG_STATUS]
 
 
 def registry_validate(registry_host):
-    if not registry_host:
-        raise ValidationError("registry host can not set null.")
-    if not (str(registry_host).startswith("https://")
-            or str(registry_host).startswith("http://")):
-        raise ValidationError("registry host must start with http(s)://")
-
-    gcr_client = GcrClient(registry_host)
-    if not gcr_client.is_valid():
-        raise ValidationError("registry host error.")
+    error = RegistryHost.objects.validate(registry_host)
+    if error:
+        raise ValidationError(error)
 
 
 class NamespaceManager(models.Manager):
@@ -47,19 +62,19 @@ class NamespaceManager(models.Manager):
                     registry_username=registry_username,
                     registry_password=registry_password)
 
-    def flush_namespace_project(self):
+    def flush_namespace_project(self, concurrency=None, host_concurrency=None):
+        from .crawler import CatalogCrawler
+
         LOG.debug("Start namespace flush.")
         last_flush_at = int(time.time() - FLUSH_NAMESPACE_MAX_TIME)
         LOG.debug("Last flush at: {}".format(last_flush_at))
         _namespaces = self.filter(updated_at__lte=last_flush_at).all()
-        for n in _namespaces:
-            try:
-                n.update_projects()
-                # 防止 ban
-                time.sleep(1)
-            except Exception as e:
-                LOG.error("Flush namespaces[{}] error: {}"
-                          .format(n.id, e), exc_info=True)
+        crawler = CatalogCrawler(concurrency=concurrency,
+                                 host_concurrency=host_concurrency)
+        crawler.crawl(_namespaces,
+                      fetch=lambda n: n.fetch_projects(),
+                      apply=lambda n, projects: n.apply_projects(projects))
+        MetricSnapshot.objects.flush(force=True)
         LOG.debug("Flush namespace finish.")
 
 
@@ -79,10 +94,21 @@ class Namespace(models.Model):
     objects = NamespaceManager()
 
     def update_projects(self):
+        self.apply_projects(self.fetch_projects())
+
+    def fetch_projects(self):
         registry_host = str(self.registry_host)
 
-        gcr_client = GcrClient(registry_host)
-        projects = gcr_client.get_project_by_namespace(self.name)
+        gcr_client = get_client(registry_host, self.registry_username,
+                                self.registry_password)
+        started_at = time.monotonic()
+        try:
+            return gcr_client.get_project_by_namespace(self.name)
+        finally:
+            metrics.FLUSH_DURATION.observe(time.monotonic() - started_at,
+                                           namespace=self.name)
+
+    def apply_projects(self, projects):
         for p in projects:
             name = "{namespace}-{project_name}" \
                 .format(namespace=self.name, project_name=p)
@@ -95,10 +121,6 @@ class Namespace(models.Model):
         self.updated_at = int(time.time())
         super(Namespace, self).save(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        Project.objects.filter(namespace_id=self.id).delete()
-        super(Namespace, self).delete(*args, **kwargs)
-
     @property
     def create_time(self):
         return utils.timestamp2datetime(self.created_at)
@@ -114,7 +136,8 @@ class Namespace(models.Model):
 class ProjectManager(models.Manager):
 
     def create_project(self, name, project_name, registry_host,
-                       registry_namespace, registry_username, registry_password):
+                       registry_namespace, registry_username, registry_password,
+                       platforms=""):
         name = str(name).strip()
         registry_host = str(registry_host).strip()
         try:
@@ -126,7 +149,8 @@ class ProjectManager(models.Manager):
                     registry_host=registry_host,
                     registry_namespace=registry_namespace,
                     registry_username=registry_username,
-                    registry_password=registry_password)
+                    registry_password=registry_password,
+                    platforms=platforms)
 
     def create_project_by_namespace(self, name, namespace, project_name):
         try:
@@ -135,25 +159,48 @@ class ProjectManager(models.Manager):
         except models.ObjectDoesNotExist:
             LOG.debug("Project[{}] not found, try create.".format(name))
         self.create(name=name, project_name=project_name,
-                    namespace_id=namespace.id,
+                    namespace=namespace,
                     registry_host=namespace.registry_host,
                     registry_namespace=namespace.name,
                     registry_username=namespace.registry_username,
                     registry_password=namespace.registry_password)
         LOG.info("Created Project: {}".format(name))
 
-    def flush_projects_tag(self):
+    def flush_projects_tag(self, prune=None, concurrency=None, host_concurrency=None):
+        from .crawler import CatalogCrawler
+
         LOG.debug("Start project flush.")
         last_flush_at = int(time.time() - FLUSH_NAMESPACE_MAX_TIME)
         LOG.debug("Last flush at: {}".format(last_flush_at))
         _projects = self.filter(updated_at__lte=last_flush_at).all()
-        for p in _projects:
-            # 防止 ban
-            time.sleep(1)
-            p.update_project_tags()
-
+        crawler = CatalogCrawler(concurrency=concurrency,
+                                 host_concurrency=host_concurrency)
+        crawler.crawl(_projects,
+                      fetch=lambda p: p.fetch_remote_tags(),
+                      apply=lambda p, remote: p.apply_remote_tags(remote, prune=prune))
+        MetricSnapshot.objects.flush(force=True)
         LOG.debug("Flush project finish.")
 
+    def refresh_tag_counts(self, project_ids):
+        """Recount the Tags of ``project_ids`` by status.
+
+        Counting again instead of incrementing keeps the counters right
+        after conditional and bulk updates whose effect is not known.
+        """
+        for ids in utils.chunked(set(project_ids), BULK_BATCH_SIZE):
+            counts = {project_id: {} for project_id in ids}
+            rows = Tag.objects.filter(project_id__in=ids).order_by() \
+                .values_list("project_id", "status").annotate(count=models.Count("id"))
+            for project_id, status, count in rows:
+                counts[project_id][status] = count
+            projects = []
+            for project_id, project_counts in counts.items():
+                project = self.model(id=project_id)
+                project.set_tag_counts(project_counts)
+                projects.append(project)
+            # 不走 save()，避免刷新 updated_at
+            self.bulk_update(projects, TAG_COUNT_FIELDS)
+
     def get_namespace_projects(self, namespace_id):
         return self.filter(namespace_id=namespace_id).all()
 
@@ -163,7 +210,8 @@ class Project(models.Model):
     name = models.CharField(max_length=256, null=False, blank=False, unique=True)
     # 源 Registry 中的项目名
     project_name = models.CharField(max_length=256, null=False, blank=False)
-    namespace_id = models.CharField(max_length=36, db_index=True, null=True, blank=True)
+    namespace = models.ForeignKey(Namespace, on_delete=models.CASCADE, null=True,
+                                  blank=True, related_name="projects")
 
     # 需要同步的镜像
     source_image = models.CharField(max_length=256, null=False, blank=False, db_index=True)
@@ -176,28 +224,89 @@ class Project(models.Model):
     registry_namespace = models.CharField(max_length=128, null=False, blank=True, default="")
     registry_username = models.CharField(max_length=256, null=True, blank=True, default="")
     registry_password = models.CharField(max_length=128, null=True, blank=True, default="")
+    # 多架构镜像要同步的平台，如 linux/amd64,linux/arm64，为空时使用 MIRROR_PLATFORMS
+    platforms = models.CharField(max_length=256, null=False, blank=True, default="")
+    # 各状态的 Tag 数量，由 ProjectManager.refresh_tag_counts 维护
+    tag_count = models.IntegerField(default=0)
+    pending_count = models.IntegerField(default=0)
+    queued_count = models.IntegerField(default=0)
+    syncing_count = models.IntegerField(default=0)
+    synced_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    # 上次 flush 时 Tag 列表的 ETag，列表未变化时跳过 flush
+    tags_etag = models.CharField(max_length=256, null=False, blank=True, default="")
 
     created_at = models.BigIntegerField(default=utils.get_time)
     updated_at = models.BigIntegerField(default=0)
 
     objects = ProjectManager()
 
-    def update_project_tags(self):
-        gcr_client = GcrClient(self.registry_host)
-        tags = gcr_client.get_project_tags(
-            self.project_name, namespace=self.registry_namespace or None)
-        for t in tags:
-            Tag.objects.create_tag_by_project(self, t)
-        try:
-            latest = Tag.objects.get(project_id=self.id, name="latest")
-            latest.status = "pending"
-            latest.save()
-        except models.ObjectDoesNotExist:
-            pass
+    def get_registry_client(self):
+        return get_client(self.registry_host, self.registry_username,
+                          self.registry_password)
+
+    def update_project_tags(self, prune=None):
+        self.apply_remote_tags(self.fetch_remote_tags(), prune=prune)
+
+    def fetch_remote_tags(self):
+        """Request the remote tag listing, every page of it.
+
+        Returns None if the listing is unchanged since the last flush,
+        otherwise a dict of the tag ``names``, the ``digests`` of the
+        mutable tags and the ``etag``. All network I/O happens here, so
+        apply_remote_tags only writes to the database.
+        """
+        gcr_client = self.get_registry_client()
+        listing = gcr_client.list_project_tags(
+            self.project_name, namespace=self.registry_namespace or None,
+            etag=self.tags_etag or None)
+        if listing is None:
+            return None
+        names, digests = [], {}
+        for page in listing["pages"]:
+            for digest, manifest in (page.get("manifest") or {}).items():
+                for name in manifest.get("tag") or []:
+                    if name in MUTABLE_TAGS:
+                        digests[name] = digest
+            names.extend(page.get("tags") or [])
+        if not listing["gcr"]:
+            # 没有 manifest map 时逐个 HEAD，不存在的 Tag 返回 None
+            for name in MUTABLE_TAGS:
+                digests[name] = gcr_client.head_manifest(self.source_repository, name)
+        return {
+            "names": names,
+            "digests": digests,
+            # 没有 manifest map 时，列表不变可变 Tag 也可能已经移动，不能跳过
+            "etag": listing["etag"] if listing["gcr"] else "",
+        }
+
+    def apply_remote_tags(self, remote, prune=None):
+        if prune is None:
+            prune = PRUNE_REMOVED_TAGS
+        if remote is None:
+            self.save()
+            LOG.info("Project {} tags not changed".format(self.name))
+            return
+
+        Tag.objects.reconcile_project_tags(self, remote["names"], prune=prune)
+        self.check_mutable_tags(remote["digests"])
+        self.tags_etag = remote["etag"]
         self.save()
         LOG.info("Updated project: {}".format(self.name))
 
-    def save(self, *args, **kwargs):
+    def check_mutable_tags(self, digests):
+        # 只有 digest 变化的可变 Tag 才重新同步
+        mutable_tags = Tag.objects.filter(
+            project_id=self.id, name__in=list(digests), status="synced")
+        for t in mutable_tags:
+            digest = digests[t.name]
+            if digest and digest != t.source_digest:
+                LOG.info("Tag {}:{} moved to {}".format(self.name, t.name, digest))
+                t.status = "pending"
+                t.save()
+
+    def build_images(self):
+        """Return the (source_image, target_image) of the current names."""
         _, registry = str(self.registry_host).split("//")
         if self.registry_namespace:
             source_image = "{registry}/{namespace}/{project_name}" \
@@ -210,24 +319,60 @@ class Project(models.Model):
             .format(registry=TARGET_REGISTRY_URL,
                     namespace=TARGET_REGISTRY_NAMESPACE,
                     project_name=self.name)
-        if (self.source_image and self.source_image != source_image) \
-                or (self.target_image and self.target_image != target_image):
-            # 更换名称，Tag 删掉重新同步
-            Tag.objects.filter(project_id=self.id).delete()
-
+        return source_image, target_image
+
+    def update_images(self):
+        """Set source/target image, return True if they changed.
+
+        The Tags of a changed project must be deleted by the caller and
+        synced again.
+        """
+        source_image, target_image = self.build_images()
+        changed = bool((self.source_image and self.source_image != source_image)
+                       or (self.target_image and self.target_image != target_image))
+        if changed:
+            self.set_tag_counts({})
+            self.tags_etag = ""
         self.source_image = source_image
         self.target_image = target_image
+        return changed
+
+    def save(self, *args, **kwargs):
+        moved = self.update_images()
+        if moved:
+            # 更换名称，Tag 删掉重新同步
+            Tag.objects.filter(project_id=self.id).delete()
 
         self.updated_at = int(time.time())
+        if not self._state.adding and not kwargs.get("force_insert") \
+                and kwargs.get("update_fields") is None:
+            # 计数只由 refresh_tag_counts 写入，内存中的值可能已经过期
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in TAG_COUNT_FIELDS]
         super(Project, self).save(*args, **kwargs)
+        if moved:
+            Project.objects.refresh_tag_counts([self.id])
 
-    def delete(self, *args, **kwargs):
-        Tag.objects.filter(project_id=self.id).delete()
-        super(Project, self).delete(*args, **kwargs)
+    @property
+    def source_repository(self):
+        if self.registry_namespace:
+            return "{}/{}".format(self.registry_namespace, self.project_name)
+        return self.project_name
 
     @property
-    def tag_count(self):
-        return Tag.objects.filter(project_id=self.id).count()
+    def mirror_platforms(self):
+        return parse_platforms(self.platforms or MIRROR_PLATFORMS)
+
+    @property
+    def target_repository(self):
+        return "{}/{}".format(TARGET_REGISTRY_NAMESPACE, self.name)
+
+    def set_tag_counts(self, counts):
+        """Set the counters from a {status: count} dict."""
+        for status, _ in PROJECT_TAG_STATUS:
+            setattr(self, "{}_count".format(status), counts.get(status, 0))
+        self.tag_count = sum(counts.values())
 
     @property
     def create_time(self):
@@ -242,36 +387,145 @@ class Project(models.Model):
 
 
 class TagManager(models.Manager):
-    def create_tag_by_project(self, project, name):
-        image_url = "{}:{}".format(project.target_image, name)
-        try:
-            tag = self.get(project_id=project.id, name=name)
-            tag.image_url = image_url
-            tag.save()
-            return
-        except models.ObjectDoesNotExist:
-            LOG.debug("Tag[{}] not found in Project {}, try create.".format(name, project.name))
-
-        self.create(name=name, project_id=project.id, image_url=image_url)
-        LOG.info("Created Tag: {}:{}".format(project.name, name))
+    def reconcile_project_tags(self, project, names, prune=False):
+        """Bring the project's tags in line with the remote tag list.
+
+        ``names`` may be any iterable, e.g. a paginated listing, and is
+        consumed in chunks. Returns the (created, updated, removed) tag
+        names. Removed tags are only deleted when ``prune`` is set.
+        """
+        now = utils.get_time()
+        created, updated = [], []
+        with transaction.atomic():
+            existing = {
+                name: (tag_id, image_url) for tag_id, name, image_url
+                in self.filter(project_id=project.id)
+                       .values_list("id", "name", "image_url")
+            }
+            seen = set()
+            for chunk in utils.chunked(names, BULK_BATCH_SIZE):
+                new_tags, changed = [], []
+                for name in chunk:
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    image_url = "{}:{}".format(project.target_image, name)
+                    if name not in existing:
+                        new_tags.append(self.model(
+                            name=name, project_id=project.id, image_url=image_url))
+                    elif existing[name][1] != image_url:
+                        changed.append(self.model(
+                            id=existing[name][0], image_url=image_url, updated_at=now))
+                        updated.append(name)
+                # 并发 flush 同一个 Project 时，已存在的 Tag 交给唯一约束去重
+                self.bulk_create(new_tags, ignore_conflicts=True)
+                self.bulk_update(changed, ["image_url", "updated_at"])
+                created.extend(t.name for t in new_tags)
+
+            removed = sorted(existing.keys() - seen)
+            if removed and prune:
+                ids = [existing[name][0] for name in removed]
+                for chunk in utils.chunked(ids, BULK_BATCH_SIZE):
+                    self.filter(id__in=chunk).delete()
+            if created or (removed and prune):
+                Project.objects.refresh_tag_counts([project.id])
+
+        if created:
+            LOG.info("Created {} Tags in Project {}".format(len(created), project.name))
+        if removed:
+            LOG.info("{} {} Tags removed upstream in Project {}: {}".format(
+                "Pruned" if prune else "Found", len(removed), project.name,
+                ", ".join(removed[:20])))
+        return created, updated, removed
+
+    def dispatch(self, tags, priority=None):
+        """Send sync tasks for ``tags`` over one broker connection.
+
+        ``tags`` holds Tags or (priority, Tag) pairs. Each tag is first
+        claimed by moving it from pending/error to queued under a fresh
+        dispatch token, so a tag already queued or syncing is never sent
+        twice, even by concurrent dispatchers. Returns the number sent.
+        """
+        from worker import sync_task
+        from image_mirror.celery import app as celery_app
+        from .routing import ROUTER, routing_keys
+        from .scheduler import PRIORITY_DEFAULT, broker_priority
+
+        priorities = {}
+        for t in tags:
+            p, t = t if isinstance(t, tuple) else (priority, t)
+            priorities[t.id] = PRIORITY_DEFAULT if p is None else p
+        count = 0
+        for ids in utils.chunked(list(priorities), BULK_BATCH_SIZE):
+            token = utils.gen_uuid()
+            self.filter(id__in=ids, status__in=DISPATCHABLE_STATUS) \
+                .update(status="queued", dispatch_token=token,
+                        updated_at=utils.get_time())
+            claimed = list(self.filter(dispatch_token=token).values_list("id", "project_id"))
+            Project.objects.refresh_tag_counts(p for _, p in claimed)
+            task = sync_task()
+            sent = 0
+            try:
+                keys = routing_keys({project_id for _, project_id in claimed})
+                with celery_app.producer_or_acquire() as producer:
+                    for tag_id, project_id in claimed:
+                        options = {"priority": broker_priority(priorities[tag_id])}
+                        queue = ROUTER.queue(task.name, keys[project_id])
+                        if queue:
+                            options["queue"] = queue
+                        task.apply_async((project_id, tag_id), producer=producer, **options)
+                        sent += 1
+            except Exception:
+                self.release_unsent(token, [tag_id for tag_id, _ in claimed[sent:]])
+                raise
+            count += sent
+        return count
+
+    def release_unsent(self, token, ids):
+        """Move claimed tags whose task was not sent back to pending.
+
+        Otherwise they would wait DISPATCH_LOCK_TIMEOUT for release_stale_locks.
+        """
+        unsent = self.filter(id__in=ids, dispatch_token=token, status="queued")
+        project_ids = set(unsent.values_list("project_id", flat=True))
+        count = unsent.update(status="pending", updated_at=utils.get_time())
+        Project.objects.refresh_tag_counts(project_ids)
+        LOG.warning("Dispatch failed, released {} unsent Tags".format(count))
+        return count
+
+    def release_stale_locks(self):
+        """Make tags whose task was lost (broker restart, killed worker) dispatchable again."""
+        stale_at = utils.get_time() - DISPATCH_LOCK_TIMEOUT
+        stale = self.filter(status__in=("queued", "syncing"), updated_at__lt=stale_at)
+        project_ids = set(stale.values_list("project_id", flat=True))
+        count = stale.update(status="pending", updated_at=utils.get_time())
+        Project.objects.refresh_tag_counts(project_ids)
+        if count:
+            LOG.warning("Released {} stale queued/syncing Tags".format(count))
+        return count
+
+    def status_counts(self):
+        counts = dict(self.order_by().values_list("status")
+                      .annotate(count=models.Count("id")))
+        return {status: counts.get(status, 0) for status, _ in PROJECT_TAG_STATUS}
+
+    def backlog_oldest(self):
+        """updated_at of the oldest Tag waiting to be dispatched, or None."""
+        return self.filter(status__in=DISPATCHABLE_STATUS) \
+            .aggregate(oldest=models.Min("updated_at"))["oldest"]
 
     def retry_migrate_tasks(self):
-        tags = self.filter(status="error").all()
-        count = 0
-        for t in tags:
-            t.status = "pending"
-            t.save()
-            t.migrate()
-            count += 1
+        from .scheduler import PRIORITY_RETRY
+
+        tags = self.filter(status="error").only("id")
+        count = self.dispatch(tags, priority=PRIORITY_RETRY)
         LOG.info("Finish send {} SYNC error task to Worker".format(count))
 
     def migrate_project_images(self, project_id):
-        tags = self.filter(project_id=project_id) \
-                   .exclude(status="synced").all()[:MAX_MIGRATE_TASK_PRE_PROJECT]
-        count = 0
-        for t in tags:
-            t.migrate()
-            count += 1
+        from .scheduler import MigrationScheduler
+
+        scheduler = MigrationScheduler(budget=MAX_MIGRATE_TASK_PRE_PROJECT)
+        count = scheduler.dispatch(project_ids=[project_id])
         LOG.info("Finish send {} SYNC Project[{}] task to Worker".format(count, project_id))
 
 
@@ -279,29 +533,88 @@ class Tag(models.Model):
     id = models.CharField(max_length=36, primary_key=True, default=utils.gen_uuid)
     name = models.CharField(max_length=256, null=False, blank=False)
 
-    project_id = models.CharField(max_length=36, null=False, blank=False, db_index=True)
+    # (project, name) 联合索引的前缀已覆盖按 project 的查询
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="tags",
+                                db_index=False)
     # 全量的 image 地址 target_image:tag_name
     image_url = models.CharField(max_length=256, null=False, blank=True, default="")
-
-    status = models.CharField(max_length=128, db_index=True,
+    # 发送任务时的幂等锁，见 TagManager.dispatch
+    dispatch_token = models.CharField(max_length=36, null=False, blank=True, default="",
+                                      db_index=True)
+    # 最近一次同步时源和目标的 manifest digest
+    source_digest = models.CharField(max_length=128, null=False, blank=True, default="")
+    target_digest = models.CharField(max_length=128, null=False, blank=True, default="")
+
+    status = models.CharField(max_length=128,
                               choices=PROJECT_TAG_STATUS, default="pending")
     error_message = models.TextField()
+    # 最近一次同步的传输统计，sync_stats 为各阶段 (pull/push/copy...) 的明细 JSON
+    transfer_bytes = models.BigIntegerField(default=0)
+    sync_duration = models.FloatField(default=0)
+    sync_stats = models.TextField(blank=True, default="")
 
     created_at = models.BigIntegerField(default=utils.get_time)
     updated_at = models.BigIntegerField(default=utils.get_time)
 
     objects = TagManager()
 
-    def migrate(self):
-        if self.status == "synced":
+    class Meta:
+        # (project, name) 查找单个 Tag；(project, status) 查 Project 下未同步的 Tag；
+        # (status, updated_at) 供调度、重试和超时回收使用
+        unique_together = ("project", "name")
+        index_together = [("project", "status"), ("status", "updated_at")]
+
+    def migrate(self, priority=None):
+        if self.status not in DISPATCHABLE_STATUS:
             return
 
-        from worker import sync_image
-        sync_image.delay(self.project_id, self.id)
+        Tag.objects.dispatch([self], priority=priority)
+
+    def is_up_to_date(self, source_digest, target_digest):
+        if not (source_digest and target_digest):
+            return False
+        if source_digest == target_digest:
+            return True
+        # 推送时 manifest 被改写过，比较上次同步记录的 digest
+        return source_digest == self.source_digest \
+            and target_digest == self.target_digest
+
+    def reset_stats(self):
+        self.transfer_bytes = 0
+        self.sync_duration = 0
+        self.sync_stats = ""
+
+    def record_stats(self, stage, stats):
+        """Store the ``TransferStats`` of one sync stage."""
+        stages = self.stats
+        stages[stage] = stats.to_dict()
+        self.sync_stats = json.dumps(stages)
+        self.transfer_bytes = sum(s["bytes"] for s in stages.values())
+        self.sync_duration = round(sum(s["duration"] for s in stages.values()), 3)
+
+    @property
+    def stats(self):
+        try:
+            return json.loads(self.sync_stats) if self.sync_stats else {}
+        except ValueError:
+            return {}
+
+    @property
+    def transfer_rate(self):
+        """Bytes per second of the last sync."""
+        if not self.sync_duration:
+            return 0
+        return int(self.transfer_bytes / self.sync_duration)
 
     def save(self, *args, **kwargs):
         self.updated_at = int(time.time())
         super(Tag, self).save(*args, **kwargs)
+        Project.objects.refresh_tag_counts([self.project_id])
+
+    def delete(self, *args, **kwargs):
+        result = super(Tag, self).delete(*args, **kwargs)
+        Project.objects.refresh_tag_counts([self.project_id])
+        return result
 
     @property
     def create_time(self):
@@ -311,12 +624,205 @@ class Tag(models.Model):
     def update_time(self):
         return utils.timestamp2datetime(self.updated_at)
 
-    @property
-    def project(self):
+    def __str__(self):
+        return "Tag [{}]".format(self.name)
+
+
+class BlobManager(models.Manager):
+    def repositories(self, digest):
+        return list(self.filter(digest=digest).order_by("-created_at")
+                    .values_list("repository", flat=True))
+
+    def add(self, digest, repository):
+        self.get_or_create(digest=digest, repository=repository)
+
+
+class Blob(models.Model):
+    """目标仓库中已存在的 blob，用于跨仓库 mount"""
+    id = models.CharField(max_length=36, primary_key=True, default=utils.gen_uuid)
+    digest = models.CharField(max_length=128, null=False, blank=False, db_index=True)
+    # 目标 Registry 中的仓库名 namespace/project
+    repository = models.CharField(max_length=256, null=False, blank=False)
+
+    created_at = models.BigIntegerField(default=utils.get_time)
+
+    objects = BlobManager()
+
+    class Meta:
+        unique_together = ("digest", "repository")
+
+    def __str__(self):
+        return "Blob [{}@{}]".format(self.repository, self.digest)
+
+
+class DockerImageManager(models.Manager):
+    def touch(self, node, reference, in_use):
+        self.update_or_create(node=node, reference=reference,
+                              defaults={"in_use": in_use,
+                                        "last_used_at": utils.get_time()})
+
+    def lru(self, node):
+        # 超时未释放的视为 worker 异常退出
+        stale_at = utils.get_time() - DOCKER_IMAGE_IN_USE_TIMEOUT
+        return self.filter(node=node) \
+            .filter(models.Q(in_use=False) | models.Q(last_used_at__lt=stale_at)) \
+            .order_by("last_used_at")
+
+
+class DockerImage(models.Model):
+    """docker 引擎模式下 worker 拉取到本地 daemon 的镜像"""
+    id = models.CharField(max_length=36, primary_key=True, default=utils.gen_uuid)
+    # worker 所在节点
+    node = models.CharField(max_length=256, null=False, blank=False)
+    reference = models.CharField(max_length=512, null=False, blank=False)
+    in_use = models.BooleanField(default=False)
+
+    last_used_at = models.BigIntegerField(default=utils.get_time)
+
+    objects = DockerImageManager()
+
+    class Meta:
+        unique_together = ("node", "reference")
+        index_together = ("node", "last_used_at")
+
+    def __str__(self):
+        return "DockerImage [{}@{}]".format(self.reference, self.node)
+
+
+class MetricSnapshotManager(models.Manager):
+    _flushed_at = 0
+
+    @classmethod
+    def source(cls):
+        return "{}:{}".format(settings.WORKER_NODE, os.getpid())
+
+    def flush(self, force=False):
+        """Store the counters of this process, at most every METRICS_FLUSH_INTERVAL."""
+        now = time.time()
+        if not force and now - MetricSnapshotManager._flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        MetricSnapshotManager._flushed_at = now
+        self.update_or_create(source=self.source(), defaults={
+            "data": json.dumps(metrics.REGISTRY.snapshot()),
+            "updated_at": int(now),
+        })
+
+    def collect(self):
+        """Merge the counters of every process."""
+        self.flush(force=True)
+        self.retire(utils.get_time() - METRICS_SNAPSHOT_TTL)
+        return metrics.REGISTRY.merge(
+            json.loads(data) for data in self.values_list("data", flat=True))
+
+    def retire(self, before):
+        """Fold the snapshots not updated since ``before`` into the retired row.
+
+        Dropping them would make the merged counters go down.
+        """
+        stale = self.filter(updated_at__lt=before).exclude(source=RETIRED_METRICS_SOURCE)
+        if not stale.exists():
+            return
+        with transaction.atomic():
+            retired, _ = self.select_for_update().get_or_create(
+                source=RETIRED_METRICS_SOURCE, defaults={"data": "{}"})
+            rows = list(stale.select_for_update().values_list("source", "data"))
+            snapshots = [json.loads(retired.data)] + [json.loads(data) for _, data in rows]
+            self.filter(source__in=[source for source, _ in rows]).delete()
+            retired.data = json.dumps(metrics.REGISTRY.merge(snapshots))
+            retired.updated_at = utils.get_time()
+            retired.save()
+
+
+class MetricSnapshot(models.Model):
+    """各进程 (web、worker、定时任务) 的计数器快照，/metrics 汇总后输出"""
+    # hostname:pid
+    source = models.CharField(max_length=128, primary_key=True)
+    data = models.TextField()
+
+    updated_at = models.BigIntegerField(default=utils.get_time)
+
+    objects = MetricSnapshotManager()
+
+    def __str__(self):
+        return "MetricSnapshot [{}]".format(self.source)
+
+
+class RegistryHostManager(models.Manager):
+    def validate(self, registry_host, force=False):
+        """Return why ``registry_host`` can not be used, or None."""
+        return self.validate_hosts([registry_host], force=force).get(registry_host)
+
+    def validate_hosts(self, hosts, force=False, concurrency=None, save=True):
+        """Check the distinct ``hosts`` concurrently, return {host: error} of the invalid ones.
+
+        Results are shared through the database for REGISTRY_VALID_TTL or
+        REGISTRY_INVALID_TTL seconds, ``force`` checks again anyway.
+        Without ``save`` cached results are used but new ones are not stored.
+        """
+        errors = {}
+        hosts = set(hosts)
+        for host in list(hosts):
+            if not host:
+                errors[host] = "registry host can not set null."
+            elif not (str(host).startswith("https://") or str(host).startswith("http://")):
+                errors[host] = "registry host must start with http(s)://"
+        hosts -= set(errors)
+        if not hosts:
+            return errors
+
+        now = utils.get_time()
+        stale = set(hosts)
+        if not force:
+            for entry in self.filter(host__in=list(hosts)):
+                if entry.expires_at > now:
+                    stale.discard(entry.host)
+                    if not entry.is_valid:
+                        errors[entry.host] = entry.error
+        if stale:
+            concurrency = min(len(stale), concurrency or settings.FLUSH_CONCURRENCY)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(self.probe, sorted(stale)))
+            for host, error in results:
+                if error:
+                    errors[host] = error
+                if not save:
+                    continue
+                self.update_or_create(host=host, defaults={
+                    "is_valid": error is None,
+                    "error": error or "",
+                    "checked_at": now,
+                })
+        return errors
+
+    @classmethod
+    def probe(cls, host):
         try:
-            return Project.objects.get(id=self.project_id)
-        except models.ObjectDoesNotExist:
-            return None
+            if get_client(host).is_valid():
+                return host, None
+            error = "registry host error."
+        except Exception as e:
+            error = "registry host error: {}".format(e)
+        LOG.warning("Registry {} is invalid: {}".format(host, error))
+        return host, error
+
+
+class RegistryHost(models.Model):
+    """源 Registry 的检查结果，各进程共享，避免每次校验都请求 /v2/"""
+    host = models.CharField(max_length=256, primary_key=True)
+    is_valid = models.BooleanField(default=False)
+    error = models.TextField(blank=True, default="")
+
+    checked_at = models.BigIntegerField(default=0)
+
+    objects = RegistryHostManager()
+
+    @property
+    def expires_at(self):
+        return self.checked_at + (REGISTRY_VALID_TTL if self.is_valid else REGISTRY_INVALID_TTL)
+
+    @property
+    def check_time(self):
+        return utils.timestamp2datetime(self.checked_at)
 
     def __str__(self):
-        return "Tag [{}]".format(self.name)
+        return "RegistryHost [{}]".format(self.host)
@@ -0,0 +1,129 @@
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+from common.hash_ring import HashRing
+from .models import Project
+
+LOG = logging.getLogger(__name__)
+DISCOVER_TIMEOUT = 1
+
+
+def default_queue():
+    from image_mirror.celery import app as celery_app
+
+    return celery_app.conf.task_default_queue
+
+
+def routed_queues():
+    """Queues of the sync tasks, each node consumes "<queue>.<node>" of them."""
+    return list(dict.fromkeys(
+        [default_queue(), settings.SYNC_FETCH_QUEUE, settings.SYNC_PUBLISH_QUEUE]))
+
+
+def task_queue(task_name):
+    route = settings.CELERY_TASK_ROUTES.get(task_name) or {}
+    return route.get("queue") or default_queue()
+
+
+def routing_key(project):
+    if settings.SYNC_ROUTING == "namespace" and project.registry_namespace:
+        return project.registry_namespace
+    return project.id
+
+
+def routing_keys(project_ids):
+    """Return {project id: routing key}, only queries in "namespace" mode."""
+    keys = {project_id: project_id for project_id in project_ids}
+    if settings.SYNC_ROUTING == "namespace" and keys:
+        rows = Project.objects.filter(id__in=list(keys)) \
+            .exclude(registry_namespace="").values_list("id", "registry_namespace")
+        keys.update(rows)
+    return keys
+
+
+class SyncRouter(object):
+    """Send the tasks of a project, or source namespace, to the same node.
+
+    Each routed queue has a consistent hash ring of the nodes consuming
+    "<queue>.<node>". Nodes are discovered from the queues the workers
+    actually consume every SYNC_ROUTING_REFRESH seconds, or configured per
+    queue in SYNC_ROUTING_NODES, so a node only gets the tasks of its
+    roles and a node joining or leaving only moves its share of the keys.
+    Without a node the default queue is used.
+    """
+
+    def __init__(self):
+        self._rings = {}
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def discover(cls):
+        """Return {queue: set of nodes}."""
+        from image_mirror.celery import app as celery_app
+
+        queues = routed_queues()
+        nodes = {queue: set() for queue in queues}
+        if settings.SYNC_ROUTING_NODES:
+            for queue in queues:
+                nodes[queue].update(settings.SYNC_ROUTING_NODES.get(queue, []))
+            return nodes
+        replies = celery_app.control.inspect(timeout=DISCOVER_TIMEOUT).active_queues() or {}
+        for consumed in replies.values():
+            for name in (q["name"] for q in consumed):
+                for queue in queues:
+                    # 节点名可能带点，按前缀匹配
+                    if name.startswith(queue + "."):
+                        nodes[queue].add(name[len(queue) + 1:])
+        return nodes
+
+    def rings(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed_at is None \
+                    or now - self._refreshed_at >= settings.SYNC_ROUTING_REFRESH:
+                self._refreshed_at = now
+                try:
+                    discovered = self.discover()
+                except Exception as e:
+                    LOG.warning("Discover sync nodes error: {}".format(e))
+                    discovered = {}
+                for queue, nodes in discovered.items():
+                    ring = self._rings.setdefault(
+                        queue, HashRing(replicas=settings.SYNC_ROUTING_REPLICAS))
+                    for node in set(ring.nodes) - nodes:
+                        LOG.info("Sync node {} left queue {}".format(node, queue))
+                        ring.remove(node)
+                    for node in nodes - set(ring.nodes):
+                        LOG.info("Sync node {} joined queue {}".format(node, queue))
+                        ring.add(node)
+            return self._rings
+
+    def queue(self, task_name, key):
+        """Return the node queue of the task for ``key``, or None for the default route."""
+        if not settings.SYNC_ROUTING:
+            return None
+        queue = task_queue(task_name)
+        ring = self.rings().get(queue)
+        node = ring.get(key) if ring else None
+        return "{}.{}".format(queue, node) if node else None
+
+    def node_queues(self):
+        if not settings.SYNC_ROUTING:
+            return []
+        return ["{}.{}".format(queue, node)
+                for queue, ring in sorted(self.rings().items()) for node in ring.nodes]
+
+
+ROUTER = SyncRouter()
+
+
+def add_node_queues(queues, node):
+    """Make a worker consume "<queue>.<node>" of each routed queue it consumes."""
+    consumed = list(queues.consume_from)
+    for queue in routed_queues():
+        if queue in consumed:
+            queues.select_add("{}.{}".format(queue, node))
@@ -0,0 +1,112 @@
+import re
+import logging
+from collections import defaultdict, deque, OrderedDict
+
+from django.conf import settings
+
+from common import utils
+from .models import Project, Tag, MUTABLE_TAGS, DISPATCHABLE_STATUS
+
+LOG = logging.getLogger(__name__)
+# Celery priorities, higher runs first (AMQP semantics)
+PRIORITY_MUTABLE = 9
+PRIORITY_NEW = 8
+PRIORITY_NEWEST_VERSION = 7
+PRIORITY_DEFAULT = 4
+PRIORITY_RETRY = 1
+SEMVER = re.compile(r"^v?(\d+)\.(\d+)(?:\.(\d+))?(?:[-+.]?(.*))?$")
+
+
+def parse_version(name):
+    """Return a sortable key for semver-like tag names, or None."""
+    match = SEMVER.match(name)
+    if not match:
+        return None
+    major, minor, patch, suffix = match.groups()
+    # Releases sort above their pre-releases
+    return int(major), int(minor), int(patch or 0), not suffix, suffix or ""
+
+
+def broker_priority(priority):
+    # The redis transport treats 0 as the highest priority
+    if str(settings.CELERY_BROKER_URL or "").startswith("redis"):
+        return settings.CELERY_TASK_QUEUE_MAX_PRIORITY - priority
+    return priority
+
+
+class MigrationScheduler(object):
+    """Pick which unsynced tags to send to the workers, and in which order.
+
+    Within a project, mutable tags, tags that appeared recently and the
+    highest versions come first. Across projects the dispatch budget is
+    shared round-robin, first between namespaces and then between the
+    projects of each namespace, so one large project cannot fill the
+    queue.
+    """
+
+    def __init__(self, budget=None, per_project=None, new_tag_window=None):
+        self.budget = budget or settings.MIGRATE_BATCH_SIZE
+        self.per_project = per_project or settings.MAX_MIGRATE_TASK_PRE_PROJECT
+        self.new_tag_window = new_tag_window or settings.NEW_TAG_WINDOW
+        self.now = utils.get_time()
+
+    def rank_project(self, tags):
+        """Return [(priority, tag)] for one project, best first."""
+        versions = sorted((v for v in (parse_version(t.name) for t in tags) if v),
+                          reverse=True)
+        newest = set(versions[:self.per_project])
+        ranked = []
+        for t in tags:
+            version = parse_version(t.name)
+            if t.status == "error":
+                priority = PRIORITY_RETRY
+            elif t.name in MUTABLE_TAGS:
+                priority = PRIORITY_MUTABLE
+            elif t.created_at >= self.now - self.new_tag_window:
+                priority = PRIORITY_NEW
+            elif version in newest:
+                priority = PRIORITY_NEWEST_VERSION
+            else:
+                priority = PRIORITY_DEFAULT
+            ranked.append(((priority, version or (), t.created_at), priority, t))
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        return [(priority, t) for _, priority, t in ranked[:self.per_project]]
+
+    def plan(self, project_ids=None):
+        tags = Tag.objects.filter(status__in=DISPATCHABLE_STATUS) \
+            .only("id", "name", "project_id", "status", "created_at")
+        projects = Project.objects.all()
+        if project_ids is not None:
+            tags = tags.filter(project_id__in=project_ids)
+            projects = projects.filter(id__in=project_ids)
+        namespace_of = dict(projects.values_list("id", "namespace_id"))
+
+        by_project = defaultdict(list)
+        for t in tags:
+            by_project[t.project_id].append(t)
+
+        # namespace -> deque of per-project ranked queues
+        namespaces = OrderedDict()
+        for project_id in sorted(by_project):
+            key = namespace_of.get(project_id) or project_id
+            queue = deque(self.rank_project(by_project[project_id]))
+            namespaces.setdefault(key, deque()).append(queue)
+
+        plan = []
+        while namespaces and len(plan) < self.budget:
+            for key in list(namespaces):
+                projects_queue = namespaces[key]
+                queue = projects_queue.popleft()
+                plan.append(queue.popleft())
+                if queue:
+                    projects_queue.append(queue)
+                if not projects_queue:
+                    del namespaces[key]
+                if len(plan) >= self.budget:
+                    break
+        return plan
+
+    def dispatch(self, project_ids=None):
+        count = Tag.objects.dispatch(self.plan(project_ids))
+        LOG.info("Finish send {} SYNC task to Worker".format(count))
+        return count
@@ -1,3 +1,1169 @@
-from django.test import TestCase
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from celery.exceptions import Retry
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from benchmark.fake_registry import FakeRegistry, SyntheticCatalog
+from benchmark.runner import UNLIMITED_RATE
+from common import metrics, rate_limit, retry
+from common.blob_cache import LOW_WATER, BlobCache
+from common.hash_ring import HashRing
+from common.image_copier import CopyError, ImageCopier
+from common.progress import DockerProgress, DockerStreamError, TransferStats
+from common.rate_limit import TokenBucket
+from common.registry_client import (
+    MANIFEST_LIST_V2, MANIFEST_V1_SIGNED, ClientError, GcrClient, get_client,
+)
+from . import lookup
+from .config import TargetConfig
+from .routing import SyncRouter, add_node_queues
+from .models import (
+    Blob, DockerImage, MetricSnapshot, Namespace, Project, RegistryHost, Tag,
+    registry_validate,
+)
+from .scheduler import PRIORITY_MUTABLE, PRIORITY_RETRY, MigrationScheduler, broker_priority
+
+PROJECTS = 3
+TAGS_PER_PROJECT = 2000
+STATUSES = ["synced", "synced", "synced", "pending", "error"]
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return " ".join(str(row[-1]) for row in cursor.fetchall())
+
+
+class TagQueryTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.projects = []
+        for i in range(PROJECTS):
+            project = Project.objects.create(
+                name="project{}".format(i), project_name="project{}".format(i),
+                registry_host="https://gcr.io")
+            cls.projects.append(project)
+            Tag.objects.bulk_create(
+                Tag(name="v{}".format(j), project_id=project.id,
+                    image_url="{}:v{}".format(project.target_image, j),
+                    status=STATUSES[j % len(STATUSES)])
+                for j in range(TAGS_PER_PROJECT))
+        Project.objects.refresh_tag_counts(p.id for p in cls.projects)
+        cls.project = cls.projects[0]
+
+    @skipUnless(connection.vendor == "sqlite", "query plans are SQLite specific")
+    def test_query_plans(self):
+        project_id = self.project.id
+        self.assertIn("USING INDEX project_tag_project_id_name",
+                      explain(Tag.objects.filter(project_id=project_id, name="v1")))
+        self.assertIn("USING INDEX project_tag_project_id",
+                      explain(Tag.objects.filter(project_id=project_id)
+                              .exclude(status="synced")))
+        self.assertIn("USING INDEX project_tag_status_updated_at",
+                      explain(Tag.objects.filter(status="error")))
+        self.assertIn("USING INDEX project_tag_status_updated_at",
+                      explain(Tag.objects.filter(status__in=("queued", "syncing"),
+                                                 updated_at__lt=0)))
+
+    def test_unique_project_tag(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Tag.objects.create(name="v1", project_id=self.project.id)
+
+    def test_reconcile_query_count(self):
+        names = ["v{}".format(j) for j in range(TAGS_PER_PROJECT)]
+        # 无变化：SAVEPOINT、读取已有 Tag、RELEASE
+        with self.assertNumQueries(3):
+            Tag.objects.reconcile_project_tags(self.project, names)
+        created, _, _ = Tag.objects.reconcile_project_tags(
+            self.project, names + ["new{}".format(j) for j in range(1000)])
+        self.assertEqual(len(created), 1000)
+        # 重复 flush 不会产生重复的 Tag
+        Tag.objects.bulk_create([Tag(name="v1", project_id=self.project.id)],
+                                ignore_conflicts=True)
+        self.assertEqual(Tag.objects.filter(project_id=self.project.id).count(),
+                         TAGS_PER_PROJECT + 1000)
+
+    def test_scheduler_query_count(self):
+        with self.assertNumQueries(2):
+            plan = MigrationScheduler(budget=100).plan()
+        self.assertEqual(len(plan), min(100, PROJECTS * settings.MAX_MIGRATE_TASK_PRE_PROJECT))
+
+    def test_status_counts_query_count(self):
+        with self.assertNumQueries(1):
+            counts = Tag.objects.status_counts()
+        self.assertEqual(sum(counts.values()), PROJECTS * TAGS_PER_PROJECT)
+
+    def test_tag_counts(self):
+        project = Project.objects.get(id=self.project.id)
+        self.assertEqual(project.tag_count, TAGS_PER_PROJECT)
+        self.assertEqual(project.synced_count, TAGS_PER_PROJECT * 3 // len(STATUSES))
+        self.assertEqual(project.error_count, TAGS_PER_PROJECT // len(STATUSES))
+
+        names = ["v{}".format(j) for j in range(TAGS_PER_PROJECT)]
+        Tag.objects.reconcile_project_tags(self.project, names + ["new"])
+        tag = Tag.objects.get(project_id=self.project.id, name="new")
+        project.refresh_from_db()
+        self.assertEqual((project.tag_count, project.pending_count),
+                         (TAGS_PER_PROJECT + 1, TAGS_PER_PROJECT // len(STATUSES) + 1))
+        tag.status = "synced"
+        tag.save()
+        project.refresh_from_db()
+        self.assertEqual(project.pending_count, TAGS_PER_PROJECT // len(STATUSES))
+        tag.delete()
+        project.refresh_from_db()
+        self.assertEqual(project.tag_count, TAGS_PER_PROJECT)
+
+    def test_tag_counts_after_flush(self):
+        project = Project.objects.create(
+            name="counted", project_name="counted", registry_host="https://gcr.io")
+        remote = {"names": ["a", "b", "c"], "digests": {}, "etag": ""}
+        project.apply_remote_tags(remote, prune=False)
+        project.refresh_from_db()
+        self.assertEqual((project.tag_count, project.pending_count), (3, 3))
+
+        # 保存时不会用内存里过期的计数覆盖数据库
+        stale = Project.objects.get(id=project.id)
+        Tag.objects.reconcile_project_tags(project, ["a", "b", "c", "d"])
+        stale.save()
+        project.refresh_from_db()
+        self.assertEqual(project.tag_count, 4)
+
+        # 更换镜像后 Tag 删掉，计数清零
+        stale.project_name = "renamed"
+        stale.save()
+        project.refresh_from_db()
+        self.assertEqual((project.tag_count, project.pending_count), (0, 0))
+
+    def test_incremental_flush(self):
+        project = Project.objects.get(id=self.project.id)
+        names = ["v{}".format(j) for j in range(TAGS_PER_PROJECT)]
+        latest = Tag.objects.create(name="latest", project=project, status="synced",
+                                    source_digest="sha256:old")
+        remote = {"names": names + ["latest"], "digests": {"latest": "sha256:new"},
+                  "etag": '"1"'}
+        project.apply_remote_tags(remote, prune=False)
+        self.assertEqual(project.tags_etag, '"1"')
+        latest.refresh_from_db()
+        self.assertEqual(latest.status, "pending")
+
+        # 给旧 digest 新加的 Tag 也会登记
+        Tag.objects.get(project_id=project.id, name="v1").delete()
+        project.apply_remote_tags({"names": names + ["latest", "promoted"], "digests": {},
+                                   "etag": ""}, prune=False)
+        tags = Tag.objects.filter(project_id=project.id)
+        self.assertTrue(tags.filter(name="promoted").exists())
+        self.assertTrue(tags.filter(name="v1").exists())
+        project.refresh_from_db()
+        self.assertEqual(project.tag_count, TAGS_PER_PROJECT + 2)
+
+        # 304：列表未变化，只刷新 updated_at
+        with self.assertNumQueries(1):
+            project.apply_remote_tags(None)
+
+    def test_lookup_queries(self):
+        project = Project.objects.get(id=self.project.id)
+        references = ["{}:v{}".format(project.source_image, j) for j in range(lookup.BATCH_SIZE)]
+        lookup.CACHE.clear()
+        # 一批镜像两次查询，与镜像数无关；耗时在 benchmark 的 lookup 阶段统计
+        with self.assertNumQueries(2):
+            results = lookup.lookup(references)
+        self.assertTrue(all(r["found"] for r in results))
+        with self.assertNumQueries(0):
+            self.assertEqual(lookup.lookup(references), results)
+
+
+class AdminQueryTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        namespace = Namespace.objects.create(name="ns", registry_host="https://gcr.io")
+        for i in range(50):
+            project = Project.objects.create(
+                name="ns.project{}".format(i), project_name="project{}".format(i),
+                namespace=namespace, registry_host="https://gcr.io",
+                registry_namespace="ns")
+            Tag.objects.bulk_create(Tag(name="v{}".format(j), project=project)
+                                    for j in range(5))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def assertChangelistQueries(self, model, num):
+        # 查询数与行数无关：会话、用户、两次计数、当前页数据
+        with self.assertNumQueries(num):
+            response = self.client.get(reverse("admin:project_{}_changelist".format(model)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_changelist_queries(self):
+        self.assertChangelistQueries("namespace", 5)
+        self.assertChangelistQueries("project", 5)
+        self.assertChangelistQueries("tag", 5)
+
+
+class LookupApiTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(
+            name="k8s-pause", project_name="pause", registry_host="https://k8s.gcr.io")
+        cls.tag = Tag.objects.create(name="3.1", project=cls.project,
+                                     image_url="{}:3.1".format(cls.project.target_image),
+                                     source_digest="sha256:abc", status="synced")
+
+    def setUp(self):
+        lookup.CACHE.clear()
+
+    def get(self, image, **headers):
+        return self.client.get(reverse("lookup-image", args=[image]), **headers)
+
+    def test_parse_reference(self):
+        self.assertEqual(lookup.parse_reference("k8s.gcr.io/pause:3.1"),
+                         ("k8s.gcr.io/pause", "3.1", ""))
+        self.assertEqual(lookup.parse_reference("localhost:5000/pause"),
+                         ("localhost:5000/pause", "latest", ""))
+        self.assertEqual(lookup.parse_reference("https://k8s.gcr.io/pause@sha256:abc"),
+                         ("k8s.gcr.io/pause", "", "sha256:abc"))
+
+    def test_lookup(self):
+        response = self.get("k8s.gcr.io/pause:3.1")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data["mirrored"])
+        self.assertEqual(data["target_image"], self.tag.image_url)
+        self.assertIn("max-age={}".format(settings.LOOKUP_CACHE_TTL),
+                      response["Cache-Control"])
+        self.assertEqual(self.get("k8s.gcr.io/pause@sha256:abc").json()["target_image"],
+                         self.tag.image_url)
+        self.assertEqual(self.get("k8s.gcr.io/pause:missing").status_code, 404)
+
+        # 命中缓存不查库，带 ETag 的重复请求返回 304
+        with self.assertNumQueries(0):
+            cached = self.get("k8s.gcr.io/pause:3.1", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_invalidate_on_tag_change(self):
+        self.assertTrue(self.get("k8s.gcr.io/pause:3.1").json()["mirrored"])
+        self.assertEqual(self.get("k8s.gcr.io/pause:3.2").status_code, 404)
+        self.tag.status = "pending"
+        self.tag.save()
+        Tag.objects.create(name="3.2", project=self.project)
+        self.assertFalse(self.get("k8s.gcr.io/pause:3.1").json()["mirrored"])
+        self.assertEqual(self.get("k8s.gcr.io/pause:3.2").status_code, 200)
+
+    def test_bulk_lookup(self):
+        images = ["k8s.gcr.io/pause:3.1", "k8s.gcr.io/pause:missing", "gcr.io/unknown:v1",
+                  "k8s.gcr.io/pause:3.1"]
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse("lookup-images"),
+                                        json.dumps({"images": images}),
+                                        content_type="application/json")
+        results = response.json()["images"]
+        self.assertEqual([r["image"] for r in results], images)
+        self.assertEqual([r["found"] for r in results], [True, False, False, True])
+        response = self.client.post(reverse("lookup-images"), "{}",
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class MetricsTest(TestCase):
+    SYNCED = json.dumps(["test", "synced"])
+    DURATION = json.dumps(["test"])
+
+    def snapshot(self, source, synced, durations):
+        buckets = [0] * len(metrics.DURATION_BUCKETS)
+        for value in durations:
+            buckets[metrics.DURATION_BUCKETS.index(value)] += 1
+        MetricSnapshot.objects.create(source=source, data=json.dumps({
+            "mirror_syncs_total": {self.SYNCED: synced},
+            "mirror_sync_duration_seconds": {self.DURATION: {
+                "buckets": buckets, "sum": sum(durations), "count": len(durations)}},
+        }))
+
+    def scrape(self):
+        # 不连接 broker
+        with mock.patch("project.views.queue_depths", return_value=[]):
+            response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return response.content.decode().splitlines()
+
+    def test_metrics(self):
+        self.snapshot("n1:1", 2, [1, 10])
+        self.snapshot("n2:2", 3, [10])
+        lines = self.scrape()
+        self.assertIn("# HELP mirror_syncs_total {}".format(metrics.SYNCS.documentation), lines)
+        self.assertIn("# TYPE mirror_syncs_total counter", lines)
+        self.assertIn("# TYPE mirror_sync_duration_seconds histogram", lines)
+        self.assertIn("# TYPE mirror_tags gauge", lines)
+        # 各进程的计数相加
+        self.assertIn('mirror_syncs_total{task="test",result="synced"} 5', lines)
+        self.assertIn('mirror_sync_duration_seconds_bucket{engine="test",le="1"} 1', lines)
+        self.assertIn('mirror_sync_duration_seconds_bucket{engine="test",le="10"} 3', lines)
+        self.assertIn('mirror_sync_duration_seconds_bucket{engine="test",le="+Inf"} 3', lines)
+        self.assertIn('mirror_sync_duration_seconds_sum{engine="test"} 21', lines)
+        self.assertIn('mirror_sync_duration_seconds_count{engine="test"} 3', lines)
+
+        # 过期的快照并入 retired，计数不会减少
+        MetricSnapshot.objects.filter(source="n1:1").update(updated_at=0)
+        lines = self.scrape()
+        self.assertIn('mirror_syncs_total{task="test",result="synced"} 5', lines)
+        self.assertIn('mirror_sync_duration_seconds_count{engine="test"} 3', lines)
+        self.assertFalse(MetricSnapshot.objects.filter(source="n1:1").exists())
+        MetricSnapshot.objects.filter(source="n2:2").update(updated_at=0)
+        self.assertIn('mirror_syncs_total{task="test",result="synced"} 5', self.scrape())
+        self.assertEqual(sorted(MetricSnapshot.objects.values_list("source", flat=True)),
+                         sorted(["retired", MetricSnapshot.objects.source()]))
+
+
+class ReloadConfigTest(TestCase):
+
+    def config(self, projects=100, **changes):
+        content = {
+            "namespaces": {"google-containers": {"registry_host": "https://gcr.io"}},
+            "projects": {"p{}".format(i): {"project_name": "p{}".format(i),
+                                           "registry_host": "https://k8s.gcr.io"}
+                         for i in range(projects)},
+        }
+        for name, fields in changes.items():
+            content["projects"][name].update(fields)
+        return TargetConfig(content)
+
+    def test_reload(self):
+        diff = self.config().diff()
+        self.assertEqual(diff.hosts, {"https://gcr.io", "https://k8s.gcr.io"})
+        diff.apply()
+        project = Project.objects.get(name="p1")
+        self.assertEqual(project.source_image, "k8s.gcr.io/p1")
+        Tag.objects.create(name="v1", project=project)
+
+        # 未变化：两次查询读出全部 Namespace 和 Project
+        with self.assertNumQueries(2):
+            self.assertTrue(self.config().diff().is_empty(prune=True))
+
+        diff = self.config(projects=50, p1={"project_name": "pause"},
+                           p2={"platforms": ["linux/amd64"]}).diff()
+        self.assertEqual([len(diff.projects[a]) for a in ("create", "update", "delete")],
+                         [0, 2, 50])
+        # diff() 之后 worker 修改的计数不会被覆盖
+        Tag.objects.create(name="v1", project=Project.objects.get(name="p2"))
+        diff.apply()
+        self.assertEqual(Project.objects.count(), 100)
+        project.refresh_from_db()
+        self.assertEqual(project.source_image, "k8s.gcr.io/pause")
+        self.assertFalse(Tag.objects.filter(project=project).exists())
+        self.assertEqual(project.tag_count, 0)
+        p2 = Project.objects.get(name="p2")
+        self.assertEqual((p2.platforms, p2.tag_count), ("linux/amd64", 1))
+
+        self.config(projects=50).diff().apply(prune=True)
+        self.assertEqual(Project.objects.count(), 50)
+
+    @mock.patch("project.models.get_client")
+    def test_dry_run(self, get_client):
+        get_client.return_value.is_valid.return_value = True
+        path = os.path.join(tempfile.mkdtemp(prefix="reload-config-test-"), "target.yml")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        with open(path, "w") as f:
+            json.dump({
+                "namespaces": {"google-containers": {"registry_host": "https://gcr.io"}},
+                "projects": {"pause": {"project_name": "pause",
+                                       "registry_host": "https://k8s.gcr.io"}},
+            }, f)
+        out = io.StringIO()
+        call_command("reload_config", config=path, dry_run=True, stdout=out)
+        self.assertIn("Dry run", out.getvalue())
+        # dry run 会检查 Registry，但不写入任何数据
+        self.assertEqual(get_client.return_value.is_valid.call_count, 2)
+        self.assertFalse(RegistryHost.objects.exists())
+        self.assertFalse(Namespace.objects.exists())
+        self.assertFalse(Project.objects.exists())
+
+        call_command("reload_config", config=path, stdout=out)
+        self.assertEqual(Project.objects.count(), 1)
+        self.assertEqual(RegistryHost.objects.count(), 2)
+
+
+@mock.patch("project.models.get_client")
+class RegistryHostTest(TestCase):
+
+    def test_validation_cached(self, get_client):
+        get_client.return_value.is_valid.return_value = True
+        registry_validate("https://gcr.io")
+        with self.assertNumQueries(1):
+            registry_validate("https://gcr.io")
+        self.assertEqual(get_client.call_count, 1)
+        with self.assertRaises(ValidationError):
+            registry_validate("gcr.io")
+
+    def test_invalid_host_expires(self, get_client):
+        get_client.return_value.is_valid.side_effect = ConnectionError("timed out")
+        errors = RegistryHost.objects.validate_hosts(["https://a.io", "https://b.io"])
+        self.assertEqual(sorted(errors), ["https://a.io", "https://b.io"])
+        self.assertIn("timed out", errors["https://a.io"])
+
+        get_client.return_value.is_valid.side_effect = None
+        get_client.return_value.is_valid.return_value = True
+        self.assertIsNotNone(RegistryHost.objects.validate("https://a.io"))
+        self.assertIsNone(RegistryHost.objects.validate("https://a.io", force=True))
+        RegistryHost.objects.filter(host="https://b.io").update(
+            checked_at=time.time() - settings.REGISTRY_INVALID_TTL - 1)
+        self.assertEqual(RegistryHost.objects.validate_hosts(["https://a.io", "https://b.io"]),
+                         {})
+        self.assertEqual(get_client.call_count, 4)
+
+
+class SchedulerTest(TestCase):
+
+    def test_rank_project(self):
+        scheduler = MigrationScheduler(per_project=10, new_tag_window=100)
+        old = scheduler.now - 1000
+        tags = [Tag(name=name, status=status, created_at=old) for name, status in (
+            ("v1.0.0", "pending"), ("v1.2.0", "pending"), ("v1.10.0", "pending"),
+            ("v2.0.0", "error"), ("v2.0.0-rc1", "pending"), ("misc", "pending"),
+            ("latest", "pending"))]
+        tags.append(Tag(name="nightly", status="pending", created_at=scheduler.now))
+        ranked = [(priority, t.name) for priority, t in scheduler.rank_project(tags)]
+        # 可变 > 新增 > 版本号从高到低 (按数字比较) > 其他 > 重试
+        self.assertEqual(ranked, [
+            (9, "latest"), (8, "nightly"), (7, "v2.0.0-rc1"), (7, "v1.10.0"),
+            (7, "v1.2.0"), (7, "v1.0.0"), (4, "misc"), (1, "v2.0.0")])
+
+        # 只有最高的 per_project 个版本加权，每个 Project 最多 per_project 个
+        scheduler.per_project = 4
+        ranked = [(priority, t.name) for priority, t in scheduler.rank_project(tags)]
+        self.assertEqual(ranked, [(9, "latest"), (8, "nightly"), (7, "v2.0.0-rc1"),
+                                  (7, "v1.10.0")])
+
+    def test_round_robin(self):
+        ns_a = Namespace.objects.create(name="a", registry_host="https://gcr.io")
+        ns_b = Namespace.objects.create(name="b", registry_host="https://gcr.io")
+        names = {}
+        for name, namespace, count in (("a1", ns_a, 20), ("a2", ns_a, 20),
+                                       ("b1", ns_b, 20), ("c1", None, 1)):
+            project = Project.objects.create(name=name, project_name=name, namespace=namespace,
+                                             registry_host="https://gcr.io")
+            names[project.id] = name
+            Tag.objects.bulk_create(Tag(name="v1.{}.0".format(i), project=project)
+                                    for i in range(count))
+
+        plan = MigrationScheduler(budget=9, per_project=5).plan()
+        picked = [names[t.project_id] for _, t in plan]
+        self.assertEqual(len(picked), 9)
+        # 每轮每个 namespace 一个，namespace 内的 Project 轮流
+        self.assertEqual(sorted(p[0] for p in picked[:3]), ["a", "b", "c"])
+        self.assertEqual({p: picked.count(p) for p in set(picked)},
+                         {"a1": 2, "a2": 2, "b1": 4, "c1": 1})
+        a_order = [p for p in picked if p.startswith("a")]
+        self.assertNotEqual(a_order[0], a_order[1])
+
+        # 单个 Project 不超过 per_project
+        plan = MigrationScheduler(budget=100, per_project=5).plan()
+        picked = [names[t.project_id] for _, t in plan]
+        self.assertEqual({p: picked.count(p) for p in set(picked)},
+                         {"a1": 5, "a2": 5, "b1": 5, "c1": 1})
+
+    def test_broker_priority(self):
+        with override_settings(CELERY_BROKER_URL="redis://localhost:6379/0"):
+            # redis 里 0 最先执行
+            self.assertEqual(broker_priority(PRIORITY_MUTABLE), 0)
+            self.assertEqual(broker_priority(PRIORITY_RETRY),
+                             settings.CELERY_TASK_QUEUE_MAX_PRIORITY - PRIORITY_RETRY)
+        for url in ("amqp://localhost", None):
+            with override_settings(CELERY_BROKER_URL=url):
+                self.assertEqual(broker_priority(PRIORITY_MUTABLE), PRIORITY_MUTABLE)
+
+
+class DispatchTest(TestCase):
+
+    def test_release_unsent_on_broker_error(self):
+        project = Project.objects.create(
+            name="dispatch", project_name="dispatch", registry_host="https://gcr.io")
+        Tag.objects.bulk_create(Tag(name="v{}".format(i), project=project) for i in range(5))
+        task = mock.Mock()
+        task.name = "worker.sync_image"
+        task.apply_async.side_effect = [None, None, ConnectionError("broker down")]
+        with mock.patch("worker.sync_task", return_value=task), \
+                self.assertRaises(ConnectionError):
+            Tag.objects.dispatch(Tag.objects.filter(project=project))
+        # 已发送的保持 queued，其余退回 pending 可以马上重新发送
+        statuses = sorted(Tag.objects.filter(project=project).values_list("status", flat=True))
+        self.assertEqual(statuses, ["pending"] * 3 + ["queued"] * 2)
+        project.refresh_from_db()
+        self.assertEqual((project.pending_count, project.queued_count), (3, 2))
+
+        task.apply_async.side_effect = None
+        with mock.patch("worker.sync_task", return_value=task):
+            self.assertEqual(Tag.objects.dispatch(Tag.objects.filter(project=project)), 3)
+
+
+class SyncTaskTest(TestCase):
+
+    def setUp(self):
+        self.project = Project.objects.create(
+            name="sync", project_name="sync", registry_host="https://gcr.io")
+        self.tag = Tag.objects.create(name="v1", project=self.project, status="queued")
+
+    def sync(self, error):
+        from worker import sync_image
+
+        # 测试中的 retry 会立即同步执行，这里只记录
+        with mock.patch("worker.copy_image", side_effect=error), \
+                mock.patch.object(sync_image, "retry", side_effect=Retry()):
+            result = sync_image.apply(args=(self.project.id, self.tag.id))
+        self.tag.refresh_from_db()
+        return result
+
+    def test_unexpected_errors(self):
+        # 缓存盘写满：重试
+        result = self.sync(OSError(28, "No space left on device"))
+        self.assertEqual((result.state, self.tag.status), ("RETRY", "queued"))
+        # manifest 或响应头解析出错：不重试
+        result = self.sync(KeyError("location"))
+        self.assertEqual(self.tag.status, "error")
+        self.assertIn("KeyError", self.tag.error_message)
+        self.assertNotEqual(result.state, "RETRY")
+
+
+@override_settings(WORKER_NODE="n1", DOCKER_DISK_HIGH_WATER=100, DOCKER_DISK_LOW_WATER=60)
+class DockerReclaimTest(TestCase):
+
+    def setUp(self):
+        self.docker = mock.Mock()
+        patcher = mock.patch("worker.get_docker_client", return_value=self.docker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now = int(time.time())
+        # (reference, 最后使用时间, 使用中, 独占大小)
+        images = [("a:1", 1, False, 30), ("a:2", 2, False, 0), ("b", 3, False, 20),
+                  ("c", 4, True, 50), ("d", 5, False, 30), ("e", 6, False, 10)]
+        for reference, used, in_use, _ in images:
+            DockerImage.objects.create(node="n1", reference=reference, in_use=in_use,
+                                       last_used_at=now - 100 + used)
+        DockerImage.objects.create(node="n2", reference="other", last_used_at=0)
+        self.docker.df.return_value = {"LayersSize": 140, "Images": [
+            {"Id": "sha256:a", "RepoTags": ["a:1", "a:2"], "Size": 40, "SharedSize": 10},
+            {"Id": "sha256:b", "RepoTags": ["b"], "Size": 20, "SharedSize": -1},
+            {"Id": "sha256:c", "RepoTags": ["c"], "Size": 50, "SharedSize": 0},
+            {"Id": "sha256:d", "RepoTags": ["d"], "Size": 40, "SharedSize": 10},
+            {"Id": "sha256:e", "RepoTags": ["e"], "Size": 10, "SharedSize": 0},
+        ]}
+
+    def removed(self):
+        return [c[0][0] for c in self.docker.api.remove_image.call_args_list]
+
+    def test_reclaim_lru(self):
+        from worker import reclaim_docker_disk
+
+        reclaim_docker_disk()
+        # 按最近最少使用删除，跳过使用中的；a 的两个 tag 都删掉才释放 30，
+        # 140 - 30 - 20 - 30 = 60 回到低水位后停止
+        self.assertEqual(self.removed(), ["a:1", "a:2", "b", "d"])
+        self.assertEqual(self.docker.df.call_count, 1)
+        self.assertEqual(sorted(DockerImage.objects.values_list("reference", flat=True)),
+                         ["c", "e", "other"])
+
+    def test_under_high_water(self):
+        from worker import reclaim_docker_disk
+
+        self.docker.df.return_value["LayersSize"] = 100
+        reclaim_docker_disk()
+        self.assertEqual(self.removed(), [])
+
+
+class FakeRegistryTestCase(TestCase):
+    """Runs against a local source registry serving ``catalog`` and an empty target."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(FakeRegistryTestCase, cls).setUpClass()
+        cls.catalog = SyntheticCatalog(projects=2, tags=3, layers=1, shared_layers=1,
+                                       layer_size=64 * 1024)
+        cls.source = FakeRegistry(cls.catalog).start()
+        cls.target = FakeRegistry().start()
+        rate_limit.configure({"default": UNLIMITED_RATE})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.source.stop()
+        cls.target.stop()
+        rate_limit.configure(settings.REGISTRY_RATE_LIMITS)
+        super(FakeRegistryTestCase, cls).tearDownClass()
+
+    def target_blobs(self, repository):
+        return {digest for repo, digest in self.target.store.blobs if repo == repository}
+
+
+class ImageCopierTest(FakeRegistryTestCase):
+
+    def copier(self, **kwargs):
+        return ImageCopier(get_client(self.source.url), get_client(self.target.url),
+                           stats=TransferStats(), **kwargs)
+
+    @classmethod
+    def statuses(cls, copier):
+        return [layer["status"] for layer in copier.stats.layers.values()]
+
+    def image(self, repository, reference):
+        content, _ = self.catalog.manifest(repository, reference)
+        return "sha256:" + hashlib.sha256(content).hexdigest(), json.loads(content.decode())
+
+    def test_copy(self):
+        copier = self.copier()
+        digest = copier.copy("ns0/project0", "mirror/plain", "latest")
+        source_digest, manifest = self.image("ns0/project0", "latest")
+        self.assertEqual(digest, source_digest)
+        self.assertIn(("mirror/plain", "latest"), self.target.store.manifests)
+        self.assertEqual(self.target_blobs("mirror/plain"), set(ImageCopier.blob_digests(manifest)))
+        self.assertEqual(self.statuses(copier), ["uploaded"] * 3)
+
+        # 目标中已有的 blob 不再传输
+        copier = self.copier()
+        copier.copy("ns0/project0", "mirror/plain", "latest")
+        self.assertEqual(self.statuses(copier), ["exists"] * 3)
+
+    def test_mount_from_blob_index(self):
+        self.copier(blob_index=Blob.objects).copy("ns0/project0", "mirror/a", "latest")
+        copier = self.copier(blob_index=Blob.objects)
+        copier.copy("ns0/project1", "mirror/b", "latest")
+        # config 和自有的层上传，共享层从 mirror/a mount
+        self.assertEqual(self.statuses(copier), ["uploaded", "mounted", "uploaded"])
+        shared = self.image("ns0/project1", "latest")[1]["layers"][0]["digest"]
+        self.assertEqual(sorted(Blob.objects.repositories(shared)), ["mirror/a", "mirror/b"])
+
+    def test_refused_mounts(self):
+        index = mock.Mock(repositories=lambda digest: ["mirror/x", "mirror/y", "mirror/z"])
+        copier = self.copier(blob_index=index)
+        uploads = dict(self.target.store.uploads)
+        scopes = []
+        authorization = copier.target.authorization
+        with mock.patch.object(copier.target, "authorization",
+                               side_effect=lambda scope: scopes.append(scope) or
+                               authorization(scope)):
+            copier.copy("ns0/project0", "mirror/refused", "latest")
+        self.assertEqual(self.statuses(copier), ["uploaded"] * 3)
+        # mount 需要目标仓库的 push 和源仓库的 pull
+        self.assertIn("repository:mirror/refused:pull,push repository:mirror/x:pull", scopes)
+        # 被拒绝的 mount 打开的上传会话都已关闭
+        self.assertEqual(self.target.store.uploads, uploads)
+
+    def test_manifest_list(self):
+        children = []
+        for reference, arch in (("v1.0.0", "amd64"), ("v1.0.1", "arm64")):
+            content, media_type = self.catalog.manifest("ns0/project0", reference)
+            children.append({"mediaType": media_type, "size": len(content),
+                             "digest": self.image("ns0/project0", reference)[0],
+                             "platform": {"os": "linux", "architecture": arch}})
+        digest = self.catalog.add_manifest(json.dumps({
+            "schemaVersion": 2, "mediaType": MANIFEST_LIST_V2, "manifests": children,
+        }).encode(), MANIFEST_LIST_V2)
+
+        self.copier().copy("ns0/project0", "mirror/multi", digest, target_reference="multi",
+                           platforms=["linux/arm64"])
+        content, media_type = self.target.store.manifests[("mirror/multi", "multi")]
+        self.assertEqual(media_type, MANIFEST_LIST_V2)
+        # 只保留并传输 arm64
+        self.assertEqual(json.loads(content.decode())["manifests"], children[1:])
+        self.assertIn(("mirror/multi", children[1]["digest"]), self.target.store.manifests)
+        self.assertNotIn(("mirror/multi", children[0]["digest"]), self.target.store.manifests)
+        with self.assertRaises(CopyError):
+            self.copier().copy("ns0/project0", "mirror/multi", digest, platforms=["windows"])
+
+    def test_schema1(self):
+        manifest = self.image("ns0/project1", "latest")[1]
+        layers = [layer["digest"] for layer in manifest["layers"]]
+        schema1 = {
+            "schemaVersion": 1, "name": "ns0/project1", "tag": "legacy",
+            "fsLayers": [{"blobSum": d} for d in reversed(layers + layers[:1])],
+            "history": [{"v1Compatibility": "{}"}] * (len(layers) + 1),
+            "signatures": [{"header": {"alg": "ES256"}, "signature": "c2ln", "protected": "e30"}],
+        }
+        digest = self.catalog.add_manifest(json.dumps(schema1, indent=3).encode(),
+                                           MANIFEST_V1_SIGNED)
+
+        copier = self.copier()
+        copier.copy("ns0/project1", "mirror/legacy", digest, target_reference="legacy")
+        _, media_type = self.target.store.manifests[("mirror/legacy", "legacy")]
+        self.assertEqual(media_type, MANIFEST_V1_SIGNED)
+        # fsLayers 去重后上传，没有 config
+        self.assertEqual(self.target_blobs("mirror/legacy"), set(layers))
+        self.assertEqual(self.statuses(copier), ["uploaded"] * len(layers))
+
+    def test_digest_mismatch(self):
+        own = self.image("ns0/project1", "v1.0.1")[1]["layers"][-1]["digest"]
+        blob = self.catalog.blob
+        root = tempfile.mkdtemp(prefix="blob-cache-test-")
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        cache = BlobCache(root, 10 * 1024 ** 2)
+        with mock.patch.object(self.catalog, "blob",
+                               side_effect=lambda d: b"corrupted" if d == own else blob(d)), \
+                self.assertRaises(CopyError) as error:
+            self.copier(blob_cache=cache).copy("ns0/project1", "mirror/corrupted", "v1.0.1")
+        self.assertTrue(error.exception.retryable)
+        self.assertEqual(retry.classify(error.exception), retry.TRANSIENT)
+        self.assertFalse(cache.has(own))
+        self.assertNotIn(own, self.target_blobs("mirror/corrupted"))
+        # 上传会话已取消
+        self.assertEqual(self.target.store.uploads, {})
+
+    def test_blob_cache(self):
+        root = tempfile.mkdtemp(prefix="blob-cache-test-")
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        cache = BlobCache(root, 10 * 1024 ** 2)
+        self.copier(blob_cache=cache).copy("ns0/project0", "mirror/c1", "v1.0.0")
+        requests = self.source.requests
+        self.copier(blob_cache=cache).copy("ns0/project0", "mirror/c2", "v1.0.0")
+        # 只请求了 manifest，blob 都从缓存读取
+        self.assertEqual(self.source.requests - requests, 1)
+        self.assertEqual(self.target_blobs("mirror/c2"), self.target_blobs("mirror/c1"))
+
+    def test_read_ahead(self):
+        content = os.urandom(4 * 1024)
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        second_read = threading.Event()
+        overlapped = []
+
+        def iter_content(chunk_size):
+            for i in range(0, len(content), chunk_size):
+                if i == chunk_size:
+                    second_read.set()
+                yield content[i:i + chunk_size]
+
+        copier = self.copier(chunk_size=1024)
+        upload_chunk = copier.target.upload_chunk
+
+        def slow_upload(location, chunk, offset):
+            if offset == 0:
+                # 第一块还在上传时，下一块已经在下载
+                overlapped.append(second_read.wait(5))
+            return upload_chunk(location, chunk, offset)
+
+        rsp = mock.Mock(iter_content=iter_content)
+        with mock.patch.object(copier.source, "get_blob", return_value=rsp), \
+                mock.patch.object(copier.target, "upload_chunk", side_effect=slow_upload):
+            self.assertEqual(copier.copy_blob("ns0/project0", "mirror/overlap", digest),
+                             len(content))
+        self.assertEqual(overlapped, [True])
+        self.assertIn(digest, self.target_blobs("mirror/overlap"))
+
+    def test_pagination(self):
+        client = get_client(self.source.url)
+        requests = self.source.requests
+        pages = list(client.iter_pages("/v2/ns0/tags/list", page_size=1))
+        self.assertEqual([page["child"] for page in pages], [["project0"], ["project1"]])
+        self.assertEqual(self.source.requests - requests, 2)
+
+        # 只请求第一页，后面的页在读取时请求
+        listing = client.list_project_tags("project0", namespace="ns0", page_size=2)
+        self.assertEqual(self.source.requests - requests, 3)
+        self.assertEqual(listing["etag"], "")
+        self.assertEqual([n for page in listing["pages"] for n in page["tags"]],
+                         self.catalog.tags)
+        self.assertEqual(self.source.requests - requests, 4)
+
+        listing = client.list_project_tags("project0", namespace="ns0")
+        self.assertTrue(listing["gcr"])
+        self.assertIsNone(client.list_project_tags("project0", namespace="ns0",
+                                                   etag=listing["etag"]))
+
+
+class FlushTest(FakeRegistryTestCase):
+
+    def test_fetch_remote_tags(self):
+        project = Project.objects.create(
+            name="ns0-project0", project_name="project0", registry_namespace="ns0",
+            registry_host=self.source.url)
+        client = get_client(self.source.url)
+        list_tags = client.list_project_tags
+        with mock.patch.object(project, "get_registry_client", return_value=client), \
+                mock.patch.object(client, "list_project_tags",
+                                  side_effect=lambda *a, **kw: list_tags(*a, page_size=2, **kw)):
+            requests = self.source.requests
+            remote = project.fetch_remote_tags()
+        # 3 个 Tag 分两页
+        self.assertEqual(self.source.requests - requests, 2)
+        self.assertEqual(remote["names"], self.catalog.tags)
+        self.assertIn("latest", remote["digests"])
+
+        # 所有页都在 fetch 阶段读取，apply 不再访问网络
+        requests = self.source.requests
+        project.apply_remote_tags(remote, prune=False)
+        self.assertEqual(self.source.requests, requests)
+        self.assertEqual(sorted(project.tags.values_list("name", flat=True)),
+                         sorted(self.catalog.tags))
+
+
+    def test_crawler(self):
+        catalog = SyntheticCatalog(namespaces=4, projects=3, tags=4, layer_size=1024)
+        hosts = [FakeRegistry(catalog, latency=0.02).start() for _ in range(2)]
+        for host in hosts:
+            self.addCleanup(host.stop)
+        for i, name in enumerate(catalog.namespaces):
+            Namespace.objects.create(name=name, registry_host=hosts[i % 2].url)
+        Namespace.objects.update(updated_at=0)
+
+        lock = threading.Lock()
+        running, peaks = {}, {}
+
+        def tracked(fetch):
+            def wrapper(obj):
+                host = obj.registry_host
+                with lock:
+                    running[host] = running.get(host, 0) + 1
+                    running["all"] = running.get("all", 0) + 1
+                    for key in (host, "all"):
+                        peaks[key] = max(peaks.get(key, 0), running[key])
+                try:
+                    return fetch(obj)
+                finally:
+                    with lock:
+                        running[host] -= 1
+                        running["all"] -= 1
+            return wrapper
+
+        with mock.patch.object(Namespace, "fetch_projects", tracked(Namespace.fetch_projects)):
+            Namespace.objects.flush_namespace_project(concurrency=3, host_concurrency=1)
+        # 线程池限制总并发，每个 host 的信号量限制单个 Registry 的并发
+        self.assertEqual(peaks[hosts[0].url], 1)
+        self.assertEqual(peaks[hosts[1].url], 1)
+        self.assertEqual(peaks["all"], 2)
+        self.assertEqual(Project.objects.count(), 12)
+
+        Project.objects.update(updated_at=0)
+        peaks.clear()
+        with mock.patch.object(Project, "fetch_remote_tags",
+                               tracked(Project.fetch_remote_tags)):
+            Project.objects.flush_projects_tag(concurrency=3, host_concurrency=2)
+        self.assertLessEqual(max(peaks[host.url] for host in hosts), 2)
+        self.assertEqual(peaks["all"], 3)
+        for project in Project.objects.all():
+            self.assertEqual(sorted(project.tags.values_list("name", flat=True)), catalog.tags)
+            self.assertEqual(project.tag_count, len(catalog.tags))
+            self.assertTrue(project.updated_at)
+
+
+class TokenAuthTest(FakeRegistryTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TokenAuthTest, cls).setUpClass()
+        cls.secured = FakeRegistry(cls.catalog, token_auth=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.secured.stop()
+        super(TokenAuthTest, cls).tearDownClass()
+
+    def counters(self):
+        return self.secured.challenges, self.secured.token_requests
+
+    def test_token_flow(self):
+        client = GcrClient(self.secured.url)
+        challenges, tokens = self.counters()
+        # 401 -> 取 token -> 重试
+        self.assertTrue(client.head_manifest("ns0/project0", "latest"))
+        self.assertEqual(self.counters(), (challenges + 1, tokens + 1))
+
+        # 同一个 scope 的 token 被复用
+        self.assertTrue(client.blob_exists(
+            "ns0/project0", ImageCopier.blob_digests(json.loads(
+                self.catalog.manifest("ns0/project0", "latest")[0].decode()))[0]))
+        self.assertEqual(self.counters(), (challenges + 1, tokens + 1))
+        # 其他仓库需要新的 token
+        client.head_manifest("ns0/project1", "latest")
+        self.assertEqual(self.counters(), (challenges + 2, tokens + 2))
+        self.assertEqual(len(client._tokens), 2)
+
+        # 过期的 token 重新申请，过期的缓存被清掉
+        client._tokens = {scope: (header, time.time() - 1)
+                          for scope, (header, _) in client._tokens.items()}
+        client.head_manifest("ns0/project0", "latest")
+        self.assertEqual(self.counters(), (challenges + 3, tokens + 3))
+        self.assertEqual(list(client._tokens), ["repository:ns0/project0:pull"])
+
+    def test_token_cache_bound(self):
+        client = GcrClient(self.secured.url)
+        with mock.patch("common.registry_client.MAX_CACHED_TOKENS", 2):
+            for reference in ("latest", "v1.0.0"):
+                for project in ("project0", "project1"):
+                    client.head_manifest("ns0/" + project, reference)
+                client.get_manifest("ns0/project0", reference)
+        self.assertEqual(len(client._tokens), 2)
+
+    def test_mount_scopes(self):
+        target = FakeRegistry(token_auth=True).start()
+        self.addCleanup(target.stop)
+        client = GcrClient(target.url)
+        content = b"layer"
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        location = client.start_upload("mirror/a")
+        client.finish_upload(client.upload_chunk(location, content, 0), digest)
+        # token 同时包含 mirror/b 的 push 和 mirror/a 的 pull，mount 才会成功
+        self.assertEqual(client.mount_blob("mirror/b", digest, "mirror/a"), (True, None))
+
+
+class SyncPipelineTest(FakeRegistryTestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix="blob-cache-test-")
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.override = override_settings(
+            TARGET_REGISTRY_API=self.target.url, SYNC_PIPELINE=True, SYNC_ENGINE="registry",
+            BLOB_CACHE_DIR=root, BLOB_CACHE_MAX_SIZE=10 * 1024 ** 2, BLOB_CACHE_SHARED=True)
+        self.override.enable()
+        patcher = mock.patch("worker._blob_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.project = Project.objects.create(
+            name="ns0-project0", project_name="project0", registry_namespace="ns0",
+            registry_host=self.source.url)
+        self.tag = Tag.objects.create(name="latest", project=self.project, status="queued")
+
+    def tearDown(self):
+        self.override.disable()
+
+    def test_sync_task(self):
+        from worker import fetch_image, sync_image, sync_task
+
+        self.assertIs(sync_task(), fetch_image)
+        # 没有共享缓存时不拆分
+        with override_settings(BLOB_CACHE_SHARED=False):
+            self.assertIs(sync_task(), sync_image)
+
+    def test_fetch_then_publish(self):
+        from worker import fetch_image, get_blob_cache, publish_image
+
+        with mock.patch.object(publish_image, "apply_async") as handoff:
+            fetch_image.apply(args=(self.project.id, self.tag.id))
+        args = handoff.call_args[0][0]
+        repository = self.project.target_repository
+        # 交接时 blob 在共享缓存里，目标仓库还是空的
+        self.assertEqual(len([d for d in args[2]["manifests"][0]["blobs"]
+                              if get_blob_cache().has(d)]), 3)
+        self.assertEqual(self.target_blobs(repository), set())
+
+        # 过期的消息不能认领
+        publish_image.apply(args=args[:-1] + ("stale",))
+        self.tag.refresh_from_db()
+        self.assertEqual(self.tag.status, "syncing")
+
+        source_requests = self.source.requests
+        publish_image.apply(args=args)
+        self.tag.refresh_from_db()
+        self.assertEqual(self.tag.status, "synced")
+        self.assertIn((repository, "latest"), self.target.store.manifests)
+        self.assertEqual(len(self.target_blobs(repository)), 3)
+        # publish 从缓存上传 blob，不再读取源仓库
+        self.assertEqual(self.source.requests, source_requests)
+
+        # Tag 重新发送后，之前的 publish 消息被丢弃
+        Tag.objects.filter(id=self.tag.id).update(status="queued", dispatch_token="new")
+        publish_image.apply(args=args)
+        self.tag.refresh_from_db()
+        self.assertEqual(self.tag.status, "queued")
+
+
+class BlobCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="blob-cache-test-")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    @classmethod
+    def put(cls, cache, content):
+        writer = cache.writer("sha256:" + hashlib.sha256(content).hexdigest())
+        writer.write(content)
+        return writer.commit()
+
+    def test_evict_on_estimate(self):
+        cache = BlobCache(self.root, max_size=100 * 1024)
+        with mock.patch.object(cache, "evict", wraps=cache.evict) as evict:
+            for i in range(3):
+                self.assertTrue(self.put(cache, bytes([i]) * 30 * 1024))
+            # 只有第一次 (大小未知) 遍历缓存
+            self.assertEqual(evict.call_count, 1)
+            self.assertTrue(self.put(cache, b"x" * 30 * 1024))
+            self.assertEqual(evict.call_count, 2)
+        self.assertLessEqual(cache.update_size(), 100 * 1024 * LOW_WATER)
+        # 最早的 blob 被清理
+        self.assertFalse(cache.has("sha256:" + hashlib.sha256(bytes([0]) * 30 * 1024).hexdigest()))
+
+        writer = cache.writer("sha256:" + "0" * 64)
+        writer.write(b"corrupted")
+        self.assertFalse(writer.commit())
+        self.assertEqual(os.listdir(cache.tmp_dir), [])
+
+
+class RetryTest(SimpleTestCase):
+
+    def test_classify(self):
+        cases = [
+            (ClientError("", status_code=429), retry.RATE_LIMITED),
+            (ClientError("", status_code=404), retry.FATAL),
+            (ClientError("", status_code=503), retry.TRANSIENT),
+            (CopyError("mismatch", retryable=True), retry.TRANSIENT),
+            (CopyError("unsupported"), retry.FATAL),
+            (requests.ConnectionError("reset"), retry.TRANSIENT),
+            (OSError(28, "No space left on device"), retry.TRANSIENT),
+            (ValueError("bad manifest"), retry.FATAL),
+            (KeyError("location"), retry.FATAL),
+            (Exception("manifest unknown"), retry.FATAL),
+            (Exception("something"), retry.TRANSIENT),
+        ]
+        for exc, kind in cases:
+            self.assertEqual(retry.classify(exc), kind, repr(exc))
+
+    def test_retry_countdown(self):
+        self.assertIsNone(retry.retry_countdown(ClientError("", status_code=404), 0, 1, 60))
+        throttled = ClientError("", status_code=429, retry_after="30")
+        self.assertGreaterEqual(retry.retry_countdown(throttled, 0, 1, 60), 30)
+        for attempt in range(10):
+            self.assertLessEqual(retry.retry_countdown(OSError(), attempt, 1, 60), 60)
+
+
+class DockerProgressTest(SimpleTestCase):
+
+    def test_feed(self):
+        progress = DockerProgress()
+        progress.consume([
+            {"status": "Pulling from team/error-pages", "id": "latest"},
+            {"status": "Downloading", "id": "error", "progressDetail": {"current": 10}},
+            {"status": "Downloading", "id": "error", "progressDetail": {"current": 30}},
+            {"status": "Download complete", "id": "error"},
+            {"status": "Already exists", "id": "base"},
+            "not an event",
+        ])
+        self.assertEqual(progress.stats.bytes, 30)
+        self.assertEqual([layer["status"] for layer in progress.stats.layers.values()],
+                         ["Download complete", "Already exists"])
+        with self.assertRaises(DockerStreamError) as error:
+            progress.feed({"errorDetail": {"message": "denied"}, "error": "denied"})
+        self.assertEqual(str(error.exception), "denied")
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_backoff(self):
+        bucket = TokenBucket(rate=8, min_rate=1, max_rate=9, burst=5)
+        bucket.feedback(429)
+        self.assertEqual((bucket.rate, bucket.tokens), (4, 0))
+        bucket.feedback(503, retry_after="5")
+        self.assertEqual(bucket.rate, 2)
+        self.assertGreater(bucket.paused_until, time.monotonic() + 4)
+        bucket.feedback(None)
+        bucket.feedback(None)
+        self.assertEqual(bucket.rate, 1)
+        # 连续成功后逐步恢复
+        for _ in range(rate_limit.INCREASE_AFTER):
+            bucket.feedback(200)
+        self.assertEqual(bucket.rate, 1 + rate_limit.INCREASE_STEP)
+
+
+class HashRingTest(SimpleTestCase):
+
+    def test_minimal_movement(self):
+        keys = ["project{}".format(i) for i in range(10000)]
+        ring = HashRing(["a", "b", "c", "d"])
+        before = {key: ring.get(key) for key in keys}
+        counts = {node: list(before.values()).count(node) for node in ring.nodes}
+        self.assertLess(max(counts.values()) / min(counts.values()), 1.5)
+
+        ring.add("e")
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        # 只有新节点分走的 Key 会移动
+        self.assertTrue(all(ring.get(key) == "e" for key in moved))
+        self.assertLess(len(moved), len(keys) / 5 * 1.3)
+
+        ring.remove("e")
+        self.assertEqual({key: ring.get(key) for key in keys}, before)
+        self.assertIsNone(HashRing().get("project0"))
+
+
+class SyncRoutingTest(SimpleTestCase):
+
+    @override_settings(SYNC_ROUTING="project", SYNC_ROUTING_NODES={
+        "celery": ["n1", "n2"], "fetch": ["n1", "n2"], "publish": ["n1", "n2"]})
+    def test_route(self):
+        router = SyncRouter()
+        queues = {router.queue("worker.sync_image", "project{}".format(i)) for i in range(100)}
+        self.assertEqual(queues, {"celery.n1", "celery.n2"})
+        # 同一个 key 的 fetch 和 publish 落在同一个节点
+        for i in range(100):
+            fetch = router.queue("worker.fetch_image", "project{}".format(i))
+            publish = router.queue("worker.publish_image", "project{}".format(i))
+            self.assertEqual(fetch.split(".", 1)[1], publish.split(".", 1)[1])
+        self.assertIn("publish.n2", router.node_queues())
+
+    @override_settings(SYNC_ROUTING="project", SYNC_ROUTING_NODES={"fetch": ["n1"]})
+    def test_nodes_per_queue(self):
+        router = SyncRouter()
+        self.assertEqual(router.queue("worker.fetch_image", "project0"), "fetch.n1")
+        # 没有配置节点的队列走默认路由
+        self.assertIsNone(router.queue("worker.publish_image", "project0"))
+        self.assertEqual(router.node_queues(), ["fetch.n1"])
+
+    @override_settings(SYNC_ROUTING="project")
+    def test_route_to_consumers(self):
+        from image_mirror.celery import app as celery_app
+
+        # n1 只下载，n2 只上传，n3 同步
+        replies = {
+            "worker@n1": [{"name": "fetch"}, {"name": "fetch.n1"}],
+            "worker@n2": [{"name": "publish"}, {"name": "publish.n2"}],
+            "worker@n3": [{"name": "celery"}, {"name": "celery.n3"}],
+        }
+        consumed = {q["name"] for queues in replies.values() for q in queues}
+        inspect = mock.Mock(**{"active_queues.return_value": replies})
+        with mock.patch.object(celery_app.control, "inspect", return_value=inspect):
+            router = SyncRouter()
+            for task in ("worker.sync_image", "worker.fetch_image", "worker.publish_image"):
+                for i in range(50):
+                    queue = router.queue(task, "project{}".format(i))
+                    self.assertIn(queue, consumed)
+        self.assertEqual(router.node_queues(), ["celery.n3", "fetch.n1", "publish.n2"])
+
+    def test_disabled(self):
+        self.assertIsNone(SyncRouter().queue("worker.sync_image", "project0"))
+
+    def test_add_node_queues(self):
+        from image_mirror.celery import app as celery_app
+
+        queues = celery_app.amqp.Queues([])
+        queues.select_add("celery")
+        queues.select_add("fetch")
+        queues.select(["fetch"])
+        add_node_queues(queues, "n1")
+        self.assertEqual(sorted(queues.consume_from), ["fetch", "fetch.n1"])
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite only")
+class SqlitePragmaTest(TestCase):
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA {}".format(name))
+            return cursor.fetchone()[0]
+
+    def test_connection_pragmas(self):
+        self.assertEqual(self.pragma("busy_timeout"), settings.SQLITE_PRAGMAS["busy_timeout"])
+        # NORMAL
+        self.assertEqual(self.pragma("synchronous"), 1)
+        # 测试库在内存中时不支持 WAL
+        self.assertIn(self.pragma("journal_mode"), ("wal", "memory"))
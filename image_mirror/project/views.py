@@ -1,3 +1,89 @@
-from django.shortcuts import render
+import json
+import logging
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, \
+    set_response_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST, require_safe
+
+from common import metrics, utils
+from . import lookup
+from .routing import ROUTER
+from .models import Tag, MetricSnapshot
+
+LOG = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def gauge(name, documentation, samples):
+    lines = ["# HELP {} {}".format(name, documentation),
+             "# TYPE {} gauge".format(name)]
+    for labels, value in samples:
+        lines.append(metrics.sample_line(name, labels, value))
+    return lines
+
+
+def queue_depths():
+    from image_mirror.celery import app as celery_app
+
+    queues = ["celery"]
+    if settings.SYNC_PIPELINE:
+        queues += [settings.SYNC_FETCH_QUEUE, settings.SYNC_PUBLISH_QUEUE]
+    queues += ROUTER.node_queues()
+    depths = []
+    try:
+        with celery_app.connection_for_write() as conn:
+            conn.ensure_connection(max_retries=1)
+            for queue in queues:
+                # 队列不存在时 broker 会关闭 channel，每个队列单独开
+                try:
+                    with conn.channel() as channel:
+                        count = channel.queue_declare(queue, passive=True).message_count
+                except conn.channel_errors:
+                    count = 0
+                depths.append(([("queue", queue)], count))
+    except Exception as e:
+        LOG.warning("Read queue depth error: {}".format(e))
+    return depths
+
+
+@require_GET
+def prometheus_metrics(request):
+    lines = metrics.REGISTRY.render(MetricSnapshot.objects.collect())
+    lines += gauge("mirror_tags", "Tags by sync status",
+                   [([("status", status)], count)
+                    for status, count in Tag.objects.status_counts().items()])
+    oldest = Tag.objects.backlog_oldest()
+    lines += gauge("mirror_dispatch_backlog_oldest_seconds",
+                   "Age of the oldest pending or failed Tag waiting for dispatch",
+                   [([], utils.get_time() - oldest if oldest else 0)])
+    lines += gauge("mirror_queue_messages", "Sync tasks waiting in the broker",
+                   queue_depths())
+    return HttpResponse("\n".join(lines) + "\n", content_type=CONTENT_TYPE)
+
+
+@require_safe
+def lookup_image(request, image):
+    result = lookup.lookup([image])[0]
+    response = JsonResponse(result, status=200 if result["found"] else 404)
+    # 让代理缓存，重复的查询用 If-None-Match 换 304
+    patch_cache_control(response, public=True, max_age=settings.LOOKUP_CACHE_TTL)
+    set_response_etag(response)
+    return get_conditional_response(request, etag=response["ETag"], response=response)
+
+
+@csrf_exempt
+@require_POST
+def lookup_images(request):
+    try:
+        images = json.loads(request.body)["images"]
+    except (ValueError, KeyError, TypeError) as e:
+        return JsonResponse({"error": "Invalid request body: {}".format(e)}, status=400)
+    if not isinstance(images, list) or not all(isinstance(i, str) for i in images):
+        return JsonResponse({"error": "images must be a list of strings"}, status=400)
+    if len(images) > settings.LOOKUP_BULK_MAX:
+        return JsonResponse({"error": "At most {} images per request"
+                            .format(settings.LOOKUP_BULK_MAX)}, status=400)
+    return JsonResponse({"images": lookup.lookup(images)})
@@ -1,24 +1,33 @@
 from __future__ import absolute_import, unicode_literals
-import time
 import docker
 from docker.errors import DockerException
+from requests import RequestException
+from celery.signals import celeryd_after_setup, task_postrun
 from django.conf import settings
 import logging
 
-from project.models import Tag, Project, models
+from common import metrics, retry, utils
+from common.blob_cache import BlobCache
+from common.image_copier import ImageCopier, CopyError
+from common.progress import DockerProgress, DockerStreamError, TransferStats
+from common.registry_client import get_client, ClientError
+from project.models import Tag, Project, Blob, DockerImage, MetricSnapshot, models
+from project.routing import ROUTER, add_node_queues, routing_key
 from image_mirror.celery import app as celery_app
 
 DOCKER_SOCK = "unix://var/run/docker.sock"
-docker_client = docker.DockerClient(base_url=DOCKER_SOCK)
 LOG = logging.getLogger(__name__)
-TASK_RETRY_DELAY_TIME = 60
+_docker_client = None
+_blob_cache = None
 
 
 class ImageError(Exception):
     error_id = "IMAGE_ERROR"
 
-    def __init__(self, msg):
+    def __init__(self, msg, cause=None):
         self.error_msg = msg
+        # 原始异常，用于判断是否值得重试
+        self.cause = cause
 
 
 class ImagePullError(ImageError):
@@ -33,62 +42,386 @@ class ImageTagError(ImageError):
     error_id = "IMAGE_TAG_ERROR"
 
 
-@celery_app.task(bind=True, default_retry_delay=TASK_RETRY_DELAY_TIME, max_retries=10)
-def sync_image(self, project_id, tag_id):
+class ImageCopyError(ImageError):
+    error_id = "IMAGE_COPY_ERROR"
+
+
+def get_docker_client():
+    # Only the docker engine needs the daemon, connect on first use
+    global _docker_client
+    if _docker_client is None:
+        _docker_client = docker.DockerClient(base_url=DOCKER_SOCK)
+    return _docker_client
+
+
+def get_blob_cache():
+    global _blob_cache
+    if _blob_cache is None and settings.BLOB_CACHE_MAX_SIZE > 0:
+        _blob_cache = BlobCache(settings.BLOB_CACHE_DIR, settings.BLOB_CACHE_MAX_SIZE)
+    return _blob_cache
+
+
+def claim_tag(project_id, tag_id, status=("queued", "pending"), token=None):
+    """Move the Tag to syncing, return (project, tag) or (None, None).
+
+    Only Tags in ``status``, and holding ``token`` when given, are claimed,
+    so duplicated and stale messages are dropped.
+    """
     try:
         project = Project.objects.get(id=project_id)
         tag = Tag.objects.get(id=tag_id, project_id=project_id)
     except models.ObjectDoesNotExist as e:
         LOG.error(e, exc_info=True)
-        return
-    try_time = 50
+        return None, None
+    claimed = Tag.objects.filter(id=tag.id, status__in=status)
+    if token:
+        claimed = claimed.filter(dispatch_token=token)
+    claimed = claimed.update(status="syncing", updated_at=utils.get_time())
+    if not claimed:
+        LOG.info("Project {} Tag {} is {}, skip duplicate task"
+                 .format(project.name, tag.name, tag.status))
+        return None, None
     tag.status = "syncing"
-    tag.save()
-    try:
-        while True:
-            try:
-                try_time -= 1
-                time.sleep(TASK_RETRY_DELAY_TIME)
-                pull_image_from_source(project, tag)
-                tag_image(project, tag)
-                push_image_to_target(project, tag)
-                tag.status = "synced"
-                LOG.info("Project {} Tag {} synced".format(project.name, tag.name))
-                break
-            except Exception as e:
-                if try_time:
-                    continue
-                raise e
+    Project.objects.refresh_tag_counts([project.id])
+    return project, tag
+
+
+def sync_failed(task, project, tag, exc, retry_status="queued"):
+    tag.status = "error"
+    tag.error_message = exc.error_msg
+    countdown = retry.retry_countdown(
+        exc.cause or exc, task.request.retries,
+        settings.SYNC_RETRY_BASE_DELAY, settings.SYNC_RETRY_MAX_DELAY)
+    if countdown is None:
+        LOG.warning("Project {} Tag {} failed, not retrying: {}"
+                    .format(project.name, tag.name, exc.error_msg))
+    elif task.request.retries < task.max_retries:
+        # 交给 Celery 延时重新调度，不占用 worker
+        tag.status = retry_status
+        metrics.SYNCS.inc(task=task.name, result="retry")
+        raise task.retry(countdown=countdown, exc=exc)
+    metrics.SYNCS.inc(task=task.name, result="error")
+
+
+def sync_error(project, tag, exc):
+    """Wrap an exception the sync helpers did not convert into an ImageError."""
+    LOG.error("Project {} Tag {} sync error: {!r}".format(project.name, tag.name, exc),
+              exc_info=True)
+    return ImageError("Sync error: {!r}".format(exc), exc)
+
+
+def sync_succeeded(task, project, tag):
+    tag.status = "synced"
+    tag.error_message = ""
+    metrics.SYNCS.inc(task=task.name, result="synced")
+    if tag.sync_stats:
+        metrics.SYNC_DURATION.observe(tag.sync_duration, engine=settings.SYNC_ENGINE)
+        metrics.SYNC_BYTES.observe(tag.transfer_bytes, engine=settings.SYNC_ENGINE)
+    LOG.info("Project {} Tag {} synced".format(project.name, tag.name))
+
+
+def sync_task():
+    """The task that starts a sync, depending on SYNC_PIPELINE."""
+    if not settings.SYNC_PIPELINE or settings.SYNC_ENGINE == "docker":
+        return sync_image
+    if not settings.BLOB_CACHE_SHARED or get_blob_cache() is None:
+        # 没有共享缓存时 publish 只能重新从源下载，不如一次完成
+        LOG.warning("SYNC_PIPELINE needs a shared blob cache, sync in one task")
+        return sync_image
+    return fetch_image
+
+
+@celeryd_after_setup.connect
+def consume_node_queues(sender, instance, **kwargs):
+    if settings.SYNC_ROUTING:
+        add_node_queues(instance.app.amqp.queues, settings.WORKER_NODE)
+
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    try:
+        MetricSnapshot.objects.flush()
+    except Exception as e:
+        LOG.warning("Flush metrics error: {}".format(e))
+
+
+@celery_app.task(bind=True, max_retries=settings.SYNC_MAX_RETRIES)
+def sync_image(self, project_id, tag_id):
+    project, tag = claim_tag(project_id, tag_id)
+    if tag is None:
+        return
+    tag.reset_stats()
+    try:
+        copy_image(project, tag)
+        sync_succeeded(self, project, tag)
+    except ImageError as exc:
+        sync_failed(self, project, tag, exc)
+    except Exception as exc:
+        # 其他异常同样按类型重试，否则 Tag 会停在 syncing 直到超时
+        sync_failed(self, project, tag, sync_error(project, tag, exc))
+    finally:
+        tag.save()
+
+
+@celery_app.task(bind=True, max_retries=settings.SYNC_MAX_RETRIES)
+def fetch_image(self, project_id, tag_id):
+    """Pipeline stage 1: download the blobs into the shared cache, then hand
+    the manifests to ``publish_image`` on the publish queue."""
+    project, tag = claim_tag(project_id, tag_id)
+    if tag is None:
+        return
+    tag.reset_stats()
+    image = None
+    try:
+        image = fetch_image_to_cache(project, tag)
+        if image is None:
+            sync_succeeded(self, project, tag)
+        else:
+            # 本次交接的令牌，过期或重复的 publish 消息不能认领重新发送过的 Tag
+            tag.dispatch_token = utils.gen_uuid()
     except ImageError as exc:
-        tag.status = "error"
-        tag.error_message = exc.error_msg
-        self.retry(countdown=TASK_RETRY_DELAY_TIME, exc=exc)
+        sync_failed(self, project, tag, exc)
+    except Exception as exc:
+        # 其他异常同样按类型重试，否则 Tag 会停在 syncing 直到超时
+        sync_failed(self, project, tag, sync_error(project, tag, exc))
+    finally:
+        tag.save()
+    if image is None:
+        return
+    # 先保存再投递，避免覆盖 publish 阶段写入的状态；保持原有优先级
+    options = {"priority": (self.request.delivery_info or {}).get("priority")}
+    queue = ROUTER.queue(publish_image.name, routing_key(project))
+    if queue:
+        options["queue"] = queue
+    try:
+        publish_image.apply_async(
+            (project_id, tag_id, image, tag.source_digest, tag.dispatch_token), **options)
+    except Exception as exc:
+        try:
+            sync_failed(self, project, tag, sync_error(project, tag, exc))
+        finally:
+            tag.save()
+
+
+@celery_app.task(bind=True, max_retries=settings.SYNC_MAX_RETRIES)
+def publish_image(self, project_id, tag_id, image, source_digest, token=None):
+    """Pipeline stage 2: upload the blobs cached by ``fetch_image`` and push
+    the manifests."""
+    project, tag = claim_tag(project_id, tag_id, status=("syncing",), token=token)
+    if tag is None:
+        return
+    try:
+        publish_image_to_target(project, tag, image, source_digest)
+        sync_succeeded(self, project, tag)
+    except ImageError as exc:
+        # 重试期间保持 syncing，fetch 的重复消息不能认领
+        sync_failed(self, project, tag, exc, retry_status="syncing")
+    except Exception as exc:
+        sync_failed(self, project, tag, sync_error(project, tag, exc),
+                    retry_status="syncing")
     finally:
         tag.save()
 
 
+def target_client():
+    return get_client(settings.TARGET_REGISTRY_API,
+                      username=settings.TARGET_REGISTRY_USERNAME,
+                      password=settings.TARGET_REGISTRY_PASSWORD)
+
+
+def copy_image(project, tag):
+    tag_name = tag.name or "latest"
+    image_url = "{}:{}".format(project.target_image, tag_name)
+    source = project.get_registry_client()
+    target = target_client()
+    try:
+        source_digest = source.head_manifest(project.source_repository, tag_name)
+        target_digest = target.head_manifest(project.target_repository, tag_name)
+    except (ClientError, RequestException) as e:
+        raise ImageCopyError("Image {} check digest error: {}".format(image_url, e), e)
+
+    if tag.is_up_to_date(source_digest, target_digest):
+        LOG.info("Image {} is up to date, skip".format(image_url))
+        tag.image_url = image_url
+        return
+
+    if settings.SYNC_ENGINE == "docker":
+        copy_image_with_docker(project, tag)
+        try:
+            target_digest = target.head_manifest(project.target_repository, tag_name)
+        except (ClientError, RequestException) as e:
+            raise ImageCopyError("Image {} check digest error: {}".format(image_url, e), e)
+    else:
+        target_digest = copy_image_to_target(project, tag, source, target)
+    tag.source_digest = source_digest or ""
+    tag.target_digest = target_digest or ""
+
+
+def get_copier(source, target, stats=None):
+    return ImageCopier(source, target, blob_index=Blob.objects,
+                       blob_cache=get_blob_cache(), stats=stats)
+
+
+def copy_image_to_target(project, tag, source, target):
+    tag_name = tag.name or "latest"
+    image_url = "{}:{}".format(project.target_image, tag_name)
+    LOG.info("Copy image: {}:{} -> {}".format(project.source_image, tag_name, image_url))
+    stats = TransferStats()
+    try:
+        digest = get_copier(source, target, stats).copy(
+            project.source_repository, project.target_repository, tag_name,
+            platforms=project.mirror_platforms)
+    except (CopyError, ClientError, RequestException) as e:
+        raise ImageCopyError("Image {} copy error: {}".format(image_url, e), e)
+    finally:
+        stats.finish()
+        tag.record_stats("copy", stats)
+    tag.image_url = image_url
+    return digest
+
+
+def fetch_image_to_cache(project, tag):
+    """Resolve the image and cache its blobs, None when already up to date."""
+    tag_name = tag.name or "latest"
+    source_ref = "{}:{}".format(project.source_image, tag_name)
+    source = project.get_registry_client()
+    target = target_client()
+    stats = TransferStats()
+    try:
+        source_digest = source.head_manifest(project.source_repository, tag_name)
+        target_digest = target.head_manifest(project.target_repository, tag_name)
+        if tag.is_up_to_date(source_digest, target_digest):
+            LOG.info("Image {} is up to date, skip".format(source_ref))
+            tag.image_url = "{}:{}".format(project.target_image, tag_name)
+            return None
+        copier = get_copier(source, target, stats)
+        image = copier.resolve(project.source_repository, tag_name,
+                               platforms=project.mirror_platforms)
+        size = copier.fetch(image, project.source_repository, project.target_repository)
+        LOG.info("Fetched image {}, {} bytes".format(source_ref, size))
+    except (CopyError, ClientError, RequestException) as e:
+        raise ImagePullError("Image {} fetch error: {}".format(source_ref, e), e)
+    finally:
+        stats.finish()
+        if stats.layers:
+            tag.record_stats("fetch", stats)
+    tag.source_digest = source_digest or ""
+    return image
+
+
+def publish_image_to_target(project, tag, image, source_digest):
+    tag_name = tag.name or "latest"
+    image_url = "{}:{}".format(project.target_image, tag_name)
+    LOG.info("Publish image: {}:{} -> {}".format(project.source_image, tag_name, image_url))
+    stats = TransferStats()
+    try:
+        copier = get_copier(project.get_registry_client(), target_client(), stats)
+        digest = copier.publish(image, project.source_repository,
+                                project.target_repository)
+    except (CopyError, ClientError, RequestException) as e:
+        raise ImagePushError("Image {} publish error: {}".format(image_url, e), e)
+    finally:
+        stats.finish()
+        tag.record_stats("publish", stats)
+    tag.image_url = image_url
+    tag.source_digest = source_digest or ""
+    tag.target_digest = digest or ""
+
+
+def copy_image_with_docker(project, tag):
+    tag_name = tag.name or "latest"
+    source_ref = "{}:{}".format(project.source_image, tag_name)
+    target_ref = "{}:{}".format(project.target_image, tag_name)
+    # 同步期间锁定，避免被其他 worker 进程回收
+    DockerImage.objects.touch(settings.WORKER_NODE, source_ref, in_use=True)
+    try:
+        pull_image_from_source(project, tag)
+        tag_image(project, tag)
+        push_image_to_target(project, tag)
+    finally:
+        DockerImage.objects.touch(settings.WORKER_NODE, source_ref, in_use=False)
+        remove_docker_image(target_ref, noprune=True)
+    reclaim_docker_disk()
+
+
+def remove_docker_image(reference, noprune=False):
+    try:
+        get_docker_client().api.remove_image(reference, noprune=noprune)
+    except docker.errors.ImageNotFound:
+        pass
+    except DockerException as e:
+        LOG.warning("Remove image {} error: {}".format(reference, e))
+        return False
+    return True
+
+
+def docker_image_sizes(df):
+    """Return ({reference: image id}, {image id: bytes freed}, {image id: tags})."""
+    ids, sizes, tags = {}, {}, {}
+    for image in df.get("Images") or []:
+        size = image.get("Size") or 0
+        shared = image.get("SharedSize") or 0
+        # 共享的层只有最后一个镜像删除时才释放，SharedSize 未知时为 -1
+        sizes[image["Id"]] = size - shared if shared > 0 else size
+        tags[image["Id"]] = set(image.get("RepoTags") or [])
+        for reference in tags[image["Id"]]:
+            ids[reference] = image["Id"]
+    return ids, sizes, tags
+
+
+def reclaim_docker_disk():
+    """Remove least recently used images once the daemon passes the high-water mark.
+
+    The daemon is asked for its disk usage once per pass, the space freed
+    by each removal is estimated from the image sizes it listed.
+    """
+    try:
+        df = get_docker_client().df()
+        usage = df.get("LayersSize") or 0
+        if usage <= settings.DOCKER_DISK_HIGH_WATER:
+            return
+        LOG.info("Docker disk usage {} over high-water mark, reclaiming".format(usage))
+        ids, sizes, tags = docker_image_sizes(df)
+        for image in DockerImage.objects.lru(settings.WORKER_NODE):
+            if not remove_docker_image(image.reference):
+                continue
+            image.delete()
+            image_id = ids.get(image.reference)
+            if image_id is None:
+                continue
+            tags[image_id].discard(image.reference)
+            # 镜像的最后一个 tag 删除后才释放空间
+            if not tags[image_id]:
+                usage -= sizes[image_id]
+            if usage <= settings.DOCKER_DISK_LOW_WATER:
+                break
+        LOG.info("Docker disk usage after reclaim: about {}".format(usage))
+    except DockerException as e:
+        LOG.warning("Reclaim docker disk error: {}".format(e))
+
+
 def tag_image(project, tag):
     tag_name = tag.name or "latest"
     image_url = "{}:{}".format(project.source_image, tag_name)
     try:
-        docker_client.api.tag(image_url, project.target_image, tag=tag_name)
+        get_docker_client().api.tag(image_url, project.target_image, tag=tag_name)
     except DockerException as e:
-        raise ImageTagError("Tag image error: {}".format(e))
+        raise ImageTagError("Tag image error: {}".format(e), e)
 
 
 def pull_image_from_source(project, tag):
     tag_name = tag.name or "latest"
     image_url = "{}:{}".format(project.source_image, tag_name)
     LOG.info("Pull image: {}".format(image_url))
+    progress = DockerProgress()
     try:
-        for line in docker_client.api.pull(image_url, stream=True):
-            if isinstance(line, bytes):
-                line = line.decode()
-            LOG.debug(line)
-            if "error" in line:
-                raise ImagePullError("Pull image {} get error log: {}".format(image_url, line))
+        progress.consume(get_docker_client().api.pull(image_url, stream=True, decode=True))
+    except DockerStreamError as e:
+        raise ImagePullError("Pull image {} get error log: {}".format(image_url, e), e)
     except Exception as e:
-        raise ImagePullError("Image {} pull error: {}".format(image_url, e))
+        raise ImagePullError("Image {} pull error: {}".format(image_url, e), e)
+    finally:
+        tag.record_stats("pull", progress.stats)
 
 
 def push_image_to_target(project, tag):
@@ -99,13 +432,14 @@ def push_image_to_target(project, tag):
     }
     image_url = "{}:{}".format(project.target_image, tag_name)
     LOG.info("Push image: {}".format(image_url))
+    progress = DockerProgress()
     try:
-        for line in docker_client.api.push(image_url, auth_config=auth, stream=True):
-            if isinstance(line, bytes):
-                line = line.decode()
-            LOG.debug(line)
-            if "error" in line:
-                raise ImagePushError("Push image {} get error log: {}".format(image_url, line))
+        progress.consume(get_docker_client().api.push(
+            image_url, auth_config=auth, stream=True, decode=True))
+    except DockerStreamError as e:
+        raise ImagePushError("Push image {} get error log: {}".format(image_url, e), e)
     except Exception as e:
-        raise ImagePushError("Image {} push error: {}".format(image_url, e))
+        raise ImagePushError("Image {} push error: {}".format(image_url, e), e)
+    finally:
+        tag.record_stats("push", progress.stats)
     tag.image_url = image_url